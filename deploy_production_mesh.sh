@@ -79,9 +79,18 @@ declare -A ROLES=(
 echo "Encoding cloud-init configuration..."
 CLOUD_INIT_B64=$(base64 -w 0 cloud-init-with-service-discovery.yaml)
 
+# Service discovery API used to pre-register the new instances
+DISCOVERY_API="http://149.248.2.74:5000"
+
+# External IPs of instances created in this wave, and each one's region and
+# instance id (external_ip -> {region, instance_id}) so registration puts
+# every IP in its own region's slot whatever order the instances came up in
+NEW_IPS=()
+NEW_NODES='{}'
+
 echo "=== BGP Anycast Mesh Production Deployment ==="
 echo "Deploying service discovery-driven BGP mesh"
-echo "Service Discovery API: http://149.248.2.74:5000"
+echo "Service Discovery API: $DISCOVERY_API"
 echo
 
 # Get current instance config for each node
@@ -158,12 +167,17 @@ for node in ord mia ewr; do
     
     # Wait for instance to be active
     for i in {1..60}; do
-        status=$(curl -s -H "Authorization: Bearer $VULTR_API_KEY" \
-                 "https://api.vultr.com/v2/instances/$new_instance_id" | \
-                 jq -r '.instance.status')
+        instance_json=$(curl -s -H "Authorization: Bearer $VULTR_API_KEY" \
+                        "https://api.vultr.com/v2/instances/$new_instance_id")
+        status=$(echo "$instance_json" | jq -r '.instance.status')
         
         if [ "$status" = "active" ]; then
             echo "Instance is active (attempt $i/60)"
+            # main_ip is only final once the instance is active
+            new_instance_ip=$(echo "$instance_json" | jq -r '.instance.main_ip')
+            NEW_IPS+=("$new_instance_ip")
+            NEW_NODES=$(echo "$NEW_NODES" | jq --arg ip "$new_instance_ip" --arg region "$region" \
+                        --arg id "$new_instance_id" '. + {($ip): {region: $region, instance_id: $id}}')
             break
         fi
         
@@ -178,10 +192,21 @@ for node in ord mia ewr; do
 done
 
 echo "=== All nodes deployed ==="
+
+# Register the whole wave with service discovery in one round-trip.
+# Nodes still self-register from cloud-init; that becomes a no-op update.
+if [ ${#NEW_IPS[@]} -gt 0 ]; then
+    echo "Registering ${#NEW_IPS[@]} instances with service discovery..."
+    curl -s -X POST -H "Content-Type: application/json" \
+         "$DISCOVERY_API/api/v1/nodes/register:batch" \
+         -d "$(jq -n --argjson nodes "$NEW_NODES" '{external_ips: ($nodes | keys_unsorted), nodes: $nodes}')" | \
+         jq -r '.results[] | "\(.external_ip): \(.status // .error) \(.node_id // "")"'
+    echo
+fi
 echo "Waiting for cloud-init to complete (this may take 10-15 minutes)..."
 echo
 echo "Monitor progress with:"
 echo "ssh root@NEW_IP 'tail -f /var/log/bgp-node-bootstrap.log'"
 echo
 echo "Check service discovery API status:"
-echo "curl http://149.248.2.74:5000/api/v1/status"
\ No newline at end of file
+echo "curl $DISCOVERY_API/api/v1/status"
\ No newline at end of file
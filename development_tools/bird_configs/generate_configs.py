@@ -1,8 +1,28 @@
 #\!/usr/bin/env python3
 
+import argparse
+import hashlib
 import json
 import os
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# service_discovery/ lives at the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from service_discovery.bird import OUTPUTS, Fleet, TemplateError, render_output
+from service_discovery.topology import IBGP_TOPOLOGIES
+
+# Bump when rendering changes in a way the template inputs do not capture,
+# so every output is regenerated once
+GENERATOR_VERSION = 3
+
+# Per-output input hashes, kept next to the generated files
+MANIFEST_FILE = ".manifest.json"
+
+# Below this many nodes to render, a process pool costs more than it saves
+PARALLEL_MIN_NODES = 64
 
 def load_config(config_file):
     """Load the BGP configuration from a JSON file."""
@@ -13,122 +33,189 @@ def load_config(config_file):
         print(f"Error loading configuration: {e}")
         sys.exit(1)
 
-def generate_static_config(config):
+def generate_static_config(fleet):
     """Generate the static routes configuration file."""
-    template = config["templates"]["static_routes"]
-    
-    # Replace template variables
-    ipv4_prefix = config["global"]["announcements"]["ipv4"][0]
-    ipv6_prefix = config["global"]["announcements"]["ipv6"][0]
-    
-    static_config = template.replace("{IPV4_PREFIX}", ipv4_prefix)
-    static_config = static_config.replace("{IPV6_PREFIX}", ipv6_prefix)
-    
-    return static_config
+    return render_output(fleet, None, "static.conf")
 
-def generate_vultr_config(config, node_name):
+def generate_vultr_config(fleet, node_name):
     """Generate the Vultr BGP configuration file for a specific node."""
-    template = config["templates"]["vultr_bgp"]
-    node = config["nodes"][node_name]
-    
-    # Replace template variables
-    vultr_config = template.replace("{VULTR_ASN}", str(config["global"]["vultr_asn"]))
-    vultr_config = vultr_config.replace("{OUR_ASN}", str(config["global"]["our_asn"]))
-    vultr_config = vultr_config.replace("{VULTR_IP}", node["vultr_ip"])
-    vultr_config = vultr_config.replace("{VULTR_IPV4_NEIGHBOR}", config["global"]["vultr_bgp"]["ipv4_neighbor"])
-    vultr_config = vultr_config.replace("{VULTR_IPV6_NEIGHBOR}", config["global"]["vultr_bgp"]["ipv6_neighbor"])
-    vultr_config = vultr_config.replace("{VULTR_MULTIHOP}", str(config["global"]["vultr_bgp"]["multihop"]))
-    vultr_config = vultr_config.replace("{VULTR_PASSWORD}", config["global"]["vultr_bgp"]["password"])
-    vultr_config = vultr_config.replace("{IPV4_PREFIX}", config["global"]["announcements"]["ipv4"][0])
-    vultr_config = vultr_config.replace("{IPV6_PREFIX}", config["global"]["announcements"]["ipv6"][0])
-    
-    return vultr_config
+    return render_output(fleet, node_name, "vultr.conf")
 
-def generate_ibgp_config(config, node_name):
+def generate_ibgp_config(fleet, node_name):
     """Generate the iBGP configuration file for a specific node."""
-    node = config["nodes"][node_name]
-    
-    if node["is_route_reflector"]:
-        template = config["templates"]["ibgp_rr"]
-        
-        # Replace template variables
-        ibgp_config = template.replace("{OUR_ASN}", str(config["global"]["our_asn"]))
-        ibgp_config = ibgp_config.replace("{LAX_IP}", config["nodes"]["lax"]["vultr_ip"])
-        ibgp_config = ibgp_config.replace("{ORD_IP}", config["nodes"]["ord"]["vultr_ip"])
-        ibgp_config = ibgp_config.replace("{MIA_IP}", config["nodes"]["mia"]["vultr_ip"])
-        ibgp_config = ibgp_config.replace("{EWR_IP}", config["nodes"]["ewr"]["vultr_ip"])
-    else:
-        template = config["templates"]["ibgp_client"]
-        
-        # Replace template variables
-        ibgp_config = template.replace("{OUR_ASN}", str(config["global"]["our_asn"]))
-        ibgp_config = ibgp_config.replace("{NODE_NAME}", node_name)
-        ibgp_config = ibgp_config.replace("{NODE_NAME_UPPER}", node_name.upper())
-        ibgp_config = ibgp_config.replace("{VULTR_IP}", node["vultr_ip"])
-        ibgp_config = ibgp_config.replace("{LAX_IP}", config["nodes"]["lax"]["vultr_ip"])
-    
-    return ibgp_config
+    return render_output(fleet, node_name, "ibgp.conf")
 
-def generate_bird_config(config, node_name):
+def generate_bird_config(fleet, node_name):
     """Generate the main BIRD configuration file for a specific node."""
-    template = config["templates"]["bird_base"]
-    node = config["nodes"][node_name]
-    
-    # Replace template variables
-    bird_config = template.replace("{NODE_NAME}", node_name.upper())
-    bird_config = bird_config.replace("{NODE_ROLE}", node["role"])
-    bird_config = bird_config.replace("{VULTR_IP}", node["vultr_ip"])
-    
-    return bird_config
+    return render_output(fleet, node_name, "bird.conf")
+
+def generate_filters_config(fleet, node_name):
+    """Generate the route filter configuration file for a specific node."""
+    return render_output(fleet, node_name, "filters.conf")
+
+def input_hash(fleet, node_name, filename):
+    """Hash of everything one output depends on: its template text and the variables it uses."""
+    template_name, values = OUTPUTS[filename](fleet, node_name)
+    template = fleet.templates[template_name]
+    used = {field: values[field] for field in template.fields}
+    payload = json.dumps([GENERATOR_VERSION, template.digest, used], sort_keys=True)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+def write_atomic(path, text):
+    """Replace path with text via a temp file and rename, so readers never see a partial file."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def load_manifest(output_dir):
+    """Output path (relative to output_dir) -> input hash from the last run."""
+    try:
+        with open(os.path.join(output_dir, MANIFEST_FILE)) as f:
+            return json.load(f)["files"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+def save_manifest(output_dir, files):
+    manifest = {"generator_version": GENERATOR_VERSION, "files": dict(sorted(files.items()))}
+    write_atomic(os.path.join(output_dir, MANIFEST_FILE), json.dumps(manifest, indent=2) + "\n")
 
-def generate_all_configs(config, node_name, output_dir):
-    """Generate all configuration files for a specific node and save them to the output directory."""
-    # Create output directory if it doesn't exist
+def plan_generation(fleet, node_names, output_dir, manifest, force=False):
+    """Work out which outputs are stale.
+
+    Returns ({node_name: [filename, ...]} to render, {path: hash} for every
+    output of node_names).
+    """
+    stale = {}
+    hashes = {}
+    for node_name in node_names:
+        for filename in OUTPUTS:
+            path = f"{node_name}/{filename}"
+            digest = input_hash(fleet, node_name, filename)
+            hashes[path] = digest
+            if force or manifest.get(path) != digest or not os.path.exists(os.path.join(output_dir, path)):
+                stale.setdefault(node_name, []).append(filename)
+    return stale, hashes
+
+def prune_outputs(fleet, output_dir, manifest):
+    """Delete outputs in manifest that no node of fleet has any more, and drop their entries.
+
+    Only files the manifest lists are removed, so nothing the generator did
+    not write is touched. Returns the paths removed.
+    """
+    current = {f"{node_name}/{filename}" for node_name in fleet.config["nodes"] for filename in OUTPUTS}
+    orphans = [path for path in manifest if path not in current]
+    for path in orphans:
+        del manifest[path]
+        try:
+            os.unlink(os.path.join(output_dir, path))
+        except FileNotFoundError:
+            pass
+        try:
+            # The node's directory goes with its last output
+            os.rmdir(os.path.dirname(os.path.join(output_dir, path)))
+        except OSError:
+            pass
+    return orphans
+
+def generate_all_configs(fleet, node_name, output_dir, filenames=OUTPUTS):
+    """Generate configuration files for a specific node and write them to the output directory."""
     node_dir = os.path.join(output_dir, node_name)
-    os.makedirs(node_dir, exist_ok=True)
-    
-    # Generate configurations
-    static_config = generate_static_config(config)
-    vultr_config = generate_vultr_config(config, node_name)
-    ibgp_config = generate_ibgp_config(config, node_name)
-    bird_config = generate_bird_config(config, node_name)
-    
-    # Write configurations to files
-    with open(os.path.join(node_dir, "static.conf"), "w") as f:
-        f.write(static_config)
-    
-    with open(os.path.join(node_dir, "vultr.conf"), "w") as f:
-        f.write(vultr_config)
-    
-    with open(os.path.join(node_dir, "ibgp.conf"), "w") as f:
-        f.write(ibgp_config)
-    
-    with open(os.path.join(node_dir, "bird.conf"), "w") as f:
-        f.write(bird_config)
-    
-    print(f"Generated configurations for {node_name} in {node_dir}")
+    for filename in filenames:
+        write_atomic(os.path.join(node_dir, filename), render_output(fleet, node_name, filename))
+    return len(filenames)
+
+# Per-process state for pool workers, set once by _init_worker
+_worker_state = {}
+
+def _init_worker(config, output_dir):
+    _worker_state.update(fleet=Fleet(config), output_dir=output_dir)
+
+def _generate_batch(batch):
+    state = _worker_state
+    return sum(generate_all_configs(state["fleet"], node_name, state["output_dir"], filenames)
+               for node_name, filenames in batch)
+
+def generate_configs(fleet, node_names, output_dir, jobs=1, force=False):
+    """Render and write the outputs of node_names whose inputs changed since the last run.
+
+    Outputs of nodes no longer in the fleet are deleted. Returns (files
+    written, files unchanged, files removed).
+    """
+    manifest = load_manifest(output_dir)
+    stale, hashes = plan_generation(fleet, node_names, output_dir, manifest, force)
+    work = list(stale.items())
+    
+    if jobs > 1 and len(work) >= PARALLEL_MIN_NODES:
+        # The config goes to each worker once; tasks carry only node names
+        batch_size = max(1, len(work) // (jobs * 4))
+        batches = [work[i:i + batch_size] for i in range(0, len(work), batch_size)]
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(fleet.config, output_dir)) as pool:
+            written = sum(pool.map(_generate_batch, batches))
+    else:
+        written = sum(generate_all_configs(fleet, node_name, output_dir, filenames)
+                      for node_name, filenames in work)
+    
+    # Entries for other nodes still in the fleet are kept as they were
+    manifest.update(hashes)
+    removed = prune_outputs(fleet, output_dir, manifest)
+    save_manifest(output_dir, manifest)
+    return written, len(hashes) - written, len(removed)
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: generate_configs.py <config_file> [node_name]")
+    parser = argparse.ArgumentParser(description="Generate BIRD configs for the nodes in a BGP config file")
+    parser.add_argument("config_file")
+    parser.add_argument("node_name", nargs="?", help="only generate this node")
+    parser.add_argument("--output-dir", default="generated_configs")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="worker processes for large fleets")
+    parser.add_argument("--force", action="store_true",
+                        help="rewrite every output even if its inputs are unchanged")
+    parser.add_argument("--ibgp-topology", choices=IBGP_TOPOLOGIES,
+                        help="iBGP session layout (default: global.ibgp.topology, else route-reflector)")
+    args = parser.parse_args()
+    
+    config = load_config(args.config_file)
+    if args.ibgp_topology:
+        config["global"]["ibgp"] = dict(config["global"].get("ibgp", {}), topology=args.ibgp_topology)
+    
+    # Templates are parsed and the iBGP topology built once, before any node is rendered
+    try:
+        fleet = Fleet(config)
+    except TemplateError as e:
+        print(f"Error in templates:\n{e}")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error in iBGP topology: {e}")
         sys.exit(1)
     
-    config_file = sys.argv[1]
-    node_name = sys.argv[2] if len(sys.argv) > 2 else None
-    
-    config = load_config(config_file)
-    output_dir = "generated_configs"
-    
-    if node_name:
-        if node_name in config["nodes"]:
-            generate_all_configs(config, node_name, output_dir)
-        else:
-            print(f"Error: Node '{node_name}' not found in configuration")
+    if args.node_name:
+        if args.node_name not in config["nodes"]:
+            print(f"Error: Node '{args.node_name}' not found in configuration")
             sys.exit(1)
+        node_names = [args.node_name]
     else:
         # Generate configurations for all nodes
-        for node_name in config["nodes"]:
-            generate_all_configs(config, node_name, output_dir)
+        node_names = list(config["nodes"])
+    
+    written, unchanged, removed = generate_configs(fleet, node_names, args.output_dir,
+                                                   jobs=args.jobs, force=args.force)
+    print(f"Generated {written} files for {len(node_names)} nodes in {args.output_dir} "
+          f"({unchanged} unchanged, {removed} removed for nodes no longer configured)")
+    summary = fleet.topology.summary()
+    print(f"iBGP topology {summary['topology']}: sessions {summary['sessions']} "
+          f"(full mesh: {summary['full_mesh_sessions']}), route reflectors {summary['reflectors']}, "
+          f"max sessions per node {summary['max_sessions_per_node']}")
+    for compiled in fleet.route_filters:
+        counts = compiled.prefix_counts
+        print(f"Route filter {compiled.name}: {counts['before']} prefixes in {counts['after']} prefix-set entries")
 
 if __name__ == "__main__":
     main()
@@ -3,6 +3,13 @@
 Test script to verify BIRD configurations for each node
 """
 import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from service_discovery.bird import Fleet, bird_symbol, discovery_fleet_config, render_output
+from service_discovery.filters import compile_route_filters, render_route_filters
+from service_discovery.topology import IBGP_TOPOLOGIES, ROUTE_REFLECTOR, build_ibgp_topology
 
 # Load service discovery config
 with open('service-discovery-schema.json', 'r') as f:
@@ -10,6 +17,23 @@ with open('service-discovery-schema.json', 'r') as f:
 
 nodes = config["wireguard_config"]["node_assignments"]
 
+def check_ibgp_sessions(ibgp_conf, node_id):
+    """Assert ibgp.conf has one session per topology peer of node_id, with the right options"""
+    peers = topology.peers.get(node_id, ())
+    assert ibgp_conf.count("\nprotocol bgp ibgp_") == len(peers), node_id
+    assert f"iBGP sessions: {len(peers)}" in ibgp_conf
+    for peer in peers:
+        symbol = bird_symbol(peer.node_id)
+        assert f"define {symbol}_WG_IP = {nodes[peer.node_id]['ipv4']};" in ibgp_conf
+        block = ibgp_conf.split(f"protocol bgp ibgp_{symbol.lower()} {{", 1)[1].split("\n}\n", 1)[0]
+        assert f"neighbor {symbol}_WG_IP as SELF_ASN;" in block
+        assert f"source address {bird_symbol(node_id)}_WG_IP;" in block
+        # Only a reflector marks its clients, each with the reflector's cluster id
+        assert ("rr client;" in block) == (peer.relation == "client"), (node_id, peer)
+        if peer.relation == "client":
+            assert f"rr cluster id {peer.cluster_id};" in block
+        assert block.count("import filter ibgp_import;") == block.count("export filter ibgp_export;") == 2
+
 def generate_bird_config_for_node(node_id, node_config):
     """Generate what the BIRD config will look like for a given node"""
     
@@ -122,107 +146,10 @@ protocol bgp vultr6 {{
     print("=== /etc/bird/vultr.conf ===")
     print(vultr_conf)
     
-    # iBGP configuration
-    if ROLE == "route_reflector":
-        # LAX is route reflector
-        ibgp_conf = f"""# iBGP Configuration for route reflector (LAX)
-
-define SELF_ASN = 27218;
-define LAX_WG_IP = 10.10.10.1;
-define ORD_WG_IP = 10.10.10.2;
-define MIA_WG_IP = 10.10.10.3;
-define EWR_WG_IP = 10.10.10.4;
-
-protocol bgp ibgp_ord {{
-  local as SELF_ASN;
-  source address LAX_WG_IP;
-  neighbor ORD_WG_IP as SELF_ASN;
-  description "iBGP to ORD via WireGuard";
-  rr client;
-  rr cluster id 1;
-  hold time 240;
-  keepalive time 80;
-  ipv4 {{
-    import filter ibgp_import;
-    export filter ibgp_export;
-    next hop self;
-  }};
-  ipv6 {{
-    import filter ibgp_import;
-    export filter ibgp_export;
-    next hop self;
-  }};
-}}
-
-protocol bgp ibgp_mia {{
-  local as SELF_ASN;
-  source address LAX_WG_IP;
-  neighbor MIA_WG_IP as SELF_ASN;
-  description "iBGP to MIA via WireGuard";
-  rr client;
-  rr cluster id 1;
-  hold time 240;
-  keepalive time 80;
-  ipv4 {{
-    import filter ibgp_import;
-    export filter ibgp_export;
-    next hop self;
-  }};
-  ipv6 {{
-    import filter ibgp_import;
-    export filter ibgp_export;
-    next hop self;
-  }};
-}}
-
-protocol bgp ibgp_ewr {{
-  local as SELF_ASN;
-  source address LAX_WG_IP;
-  neighbor EWR_WG_IP as SELF_ASN;
-  description "iBGP to EWR via WireGuard";
-  rr client;
-  rr cluster id 1;
-  hold time 240;
-  keepalive time 80;
-  ipv4 {{
-    import filter ibgp_import;
-    export filter ibgp_export;
-    next hop self;
-  }};
-  ipv6 {{
-    import filter ibgp_import;
-    export filter ibgp_export;
-    next hop self;
-  }};
-}}
-"""
-    else:
-        # Client nodes connect to LAX
-        ibgp_conf = f"""# iBGP Configuration for client node ({NODE_ID})
-
-define SELF_ASN = 27218;
-define {NODE_ID.upper()}_WG_IP = {WG_IPV4};
-define LAX_WG_IP = 10.10.10.1;
-
-protocol bgp ibgp_lax {{
-  local as SELF_ASN;
-  source address {NODE_ID.upper()}_WG_IP;
-  neighbor LAX_WG_IP as SELF_ASN;
-  description "iBGP to LAX (route reflector) via WireGuard";
-  hold time 240;
-  keepalive time 80;
-  ipv4 {{
-    import filter ibgp_import;
-    export filter ibgp_export;
-    next hop self;
-  }};
-  ipv6 {{
-    import filter ibgp_import;
-    export filter ibgp_export;
-    next hop self;
-  }};
-}}
-"""
+    # iBGP configuration: rendered by the same code as the API and the
+    # generator, then checked against the topology it was laid out from
+    ibgp_conf = render_output(fleet, node_id, "ibgp.conf")
+    check_ibgp_sessions(ibgp_conf, node_id)
     
     print("=== /etc/bird/ibgp.conf ===")
     print(ibgp_conf)
@@ -244,41 +171,27 @@ protocol static {
     print("=== /etc/bird/static.conf ===")
     print(static_conf)
     
-    # BGP filters (same for all) 
-    bgp_filters = """# BGP Import/Export Filters - BLOCK ALL DEFAULT ROUTES
-
-filter ibgp_import {
-  # REJECT any default routes first  
-  if net = 0.0.0.0/0 then reject;
-  if net = ::/0 then reject;
-  
-  # Accept our IPv4 prefix
-  if net = 192.30.120.0/23 then accept;
-  # Accept our IPv6 prefix  
-  if net = 2620:71:4000::/48 then accept;
-  
-  # Reject everything else
-  reject;
-}
-
-filter ibgp_export {
-  # NEVER export default routes
-  if net = 0.0.0.0/0 then reject;
-  if net = ::/0 then reject;
-  
-  # Export our IPv4 prefix
-  if net = 192.30.120.0/23 then accept;
-  # Export our IPv6 prefix
-  if net = 2620:71:4000::/48 then accept;
-  
-  # Reject everything else
-  reject;
-}
-"""
+    # BGP filters (same for all), compiled from bgp_config.route_filters
+    bgp_filters = "# BGP Import/Export Filters - BLOCK ALL DEFAULT ROUTES\n" + \
+        render_route_filters(compile_route_filters(config["bgp_config"]["route_filters"]))
     
     print("=== /etc/bird/bgp_filters.conf ===")
     print(bgp_filters)
 
-# Test all nodes
-for node_id, node_config in nodes.items():
-    generate_bird_config_for_node(node_id, node_config)
\ No newline at end of file
+if __name__ == "__main__":
+    # iBGP layout: route-reflector (default), full-mesh or regional-rr
+    IBGP_TOPOLOGY = sys.argv[1] if len(sys.argv) > 1 else ROUTE_REFLECTOR
+    if IBGP_TOPOLOGY not in IBGP_TOPOLOGIES:
+        sys.exit(f"Unknown iBGP topology {IBGP_TOPOLOGY}; choose from {', '.join(IBGP_TOPOLOGIES)}")
+    topology = build_ibgp_topology(
+        ((node_id, node["region"], node["role"] == "route_reflector") for node_id, node in nodes.items()),
+        IBGP_TOPOLOGY)
+    fleet = Fleet(discovery_fleet_config(config), topology)
+    
+    # Test all nodes
+    for node_id, node_config in nodes.items():
+        generate_bird_config_for_node(node_id, node_config)
+    
+    summary = topology.summary()
+    print(f"\niBGP {summary['topology']}: {summary['sessions']} sessions for {summary['nodes']} nodes "
+          f"(full mesh: {summary['full_mesh_sessions']})")
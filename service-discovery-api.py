@@ -4,47 +4,384 @@ BGP Mesh Service Discovery API
 Provides node configuration, WireGuard configs, and firewall rules
 """
 
+import hmac
 import json
+import math
+import os
 import sys
+import threading
+import time
+
+if sys.argv[1:2] == ['serve'] and os.environ.get('SD_WORKER_CLASS') == 'gevent':
+    # Must run before any locks are created so /watch long-polls wait
+    # cooperatively instead of blocking a whole worker
+    from gevent import monkey
+    monkey.patch_all()
+
 from datetime import datetime
-from flask import Flask, jsonify, request
+from flask import Flask, g, jsonify, request
 from pathlib import Path
 
+from service_discovery.acl import access_list
+from service_discovery.aggregate import aggregated_firewall_config
+from service_discovery.allocator import mesh_allocator
+from service_discovery.bird import OUTPUTS as BIRD_OUTPUTS, render_bundle, render_output, snapshot_fleet
+from service_discovery.cache import ResponseCache
+from service_discovery.encoding import FastJSONProvider, dumps_json
+from service_discovery.liveness import LivenessTable
+from service_discovery.metrics import Metrics
+from service_discovery.profiling import ProfilingMiddleware
+from service_discovery.server import max_watchers
+from service_discovery.shared import SharedSnapshotStore
+from service_discovery.topology import TUNNEL_TOPOLOGIES, build_mesh_topology, mesh_topology, tunnel_peers
+from service_discovery.validation import ConfigValidationError, ConfigValidator
+from service_discovery.vultr import InstanceIndex
+from service_discovery.wgconf import iter_wg_conf, private_key_fields, render_wg_conf
+
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 
 # Load service discovery configuration
 CONFIG_FILE = Path(__file__).parent / "service-discovery-schema.json"
 
-def load_config():
-    with open(CONFIG_FILE, 'r') as f:
-        return json.load(f)
+# Parsed once and shared by all requests; reloaded when the file changes.
+# Registrations are appended to service-discovery-schema.json.journal and
+# periodically compacted back into the schema file. Worker processes share
+# the merged snapshot (and its generation) via service-discovery-schema.json.snapshot.
+config_store = SharedSnapshotStore(CONFIG_FILE)
+
+# service_discovery/config.schema.json, compiled once. Every load is checked
+# in full and every registration write before it is journaled, so handlers
+# can index node fields without defensive lookups.
+config_validator = ConfigValidator.from_file()
+config_store.validator = config_validator
+
+# In-memory heartbeat state; never written to the schema file. Under serve,
+# workers share last-heartbeat times via service-discovery-schema.json.liveness.
+liveness = LivenessTable()
+
+# Vultr instances by main_ip, for region-aware registration (None unless
+# VULTR_API_KEY is set)
+vultr_index = InstanceIndex.from_environment()
+
+# Source access control: SD_ACCESS_GROUPS names the firewall_config.source_groups
+# (plus "registered_nodes") allowed to call the API, "*" for all of them.
+# Unset leaves the API open. SD_ACCESS_CIDRS adds extra networks (e.g. admin
+# ranges); loopback is always allowed.
+ACCESS_GROUPS = [group.strip() for group in os.environ.get('SD_ACCESS_GROUPS', '').split(',')
+                 if group.strip()]
+ACCESS_EXTRA_NETWORKS = ['127.0.0.0/8', '::1/128'] + [
+    cidr.strip() for cidr in os.environ.get('SD_ACCESS_CIDRS', '').split(',') if cidr.strip()]
+
+# Bearer token for destructive admin calls (node deregistration); unset
+# disables them
+ADMIN_TOKEN = os.environ.get('SD_ADMIN_TOKEN', '')
+
+if os.environ.get('SD_PROXY_HOPS'):
+    # Behind a reverse proxy: take the client address from X-Forwarded-For,
+    # trusting only as many hops as there are proxies
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.environ['SD_PROXY_HOPS']))
+
+# Opt-in request profiling (see service_discovery/profiling.py): SD_PROFILE_DIR
+# enables it; nothing is wrapped, and so nothing costs anything, when it is unset
+profiling = ProfilingMiddleware.from_environment(app.wsgi_app)
+if profiling is not None:
+    app.wsgi_app = profiling
+
+# Upper bound on external IPs accepted by the :batch endpoints
+MAX_BATCH_SIZE = 256
+
+# Long-poll limits for /api/v1/nodes/<node_id>/watch, in seconds
+DEFAULT_WATCH_TIMEOUT = 30
+MAX_WATCH_TIMEOUT = 300
 
-def get_node_by_region(region):
+# Long-polls allowed to wait at once per process (see server.max_watchers());
+# further ones get 503 with Retry-After seconds
+MAX_WATCHERS = max_watchers()
+WATCH_RETRY_AFTER = 5
+watch_slots = threading.BoundedSemaphore(MAX_WATCHERS)
+
+def serialize_json(payload):
+    """Serialize a payload as compact jsonify() output (orjson when installed)"""
+    return dumps_json(payload)
+
+# Serialized per-node responses, valid for one config generation
+response_cache = ResponseCache(serialize_json)
+
+# Plain-text BIRD config files, cached the same way
+bird_cache = ResponseCache(str.encode, mimetype="text/plain")
+
+# Request, reload and registration timings, exported at /metrics
+metrics = Metrics()
+config_store.metrics = metrics
+metrics.counter("sd_response_cache_hits_total", "Responses served from the pre-rendered cache",
+                lambda: response_cache.hits + bird_cache.hits)
+metrics.counter("sd_response_cache_misses_total", "Responses rendered on a cache miss",
+                lambda: response_cache.misses + bird_cache.misses)
+metrics.counter("sd_liveness_shared_overflow_total",
+                "Heartbeats not shared between workers because the liveness table was full",
+                lambda: liveness.shared.overflows if liveness.shared is not None else 0)
+
+@app.before_request
+def start_request_timer():
+    # Registered first so rejected requests are timed too
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        rule = request.url_rule
+        metrics.observe_request(rule.rule if rule is not None else 'unmatched',
+                                response.status_code, time.perf_counter() - started)
+        metrics.maybe_flush()
+    return response
+
+@app.before_request
+def check_access():
+    """Reject clients outside the allowed source groups"""
+    if not ACCESS_GROUPS:
+        return None
+    # Compiled once per config generation
+    acl = access_list(config_store.current(), ACCESS_GROUPS, ACCESS_EXTRA_NETWORKS)
+    if acl.match(request.remote_addr) is None:
+        return jsonify({'error': 'Access denied: IP not authorized'}), 403
+    return None
+
+def get_node_by_region(region, snapshot=None):
     """Get node configuration by region"""
-    config = load_config()
-    for node_id, node_config in config["wireguard_config"]["node_assignments"].items():
-        if node_config["region"] == region:
-            return node_id, node_config
-    return None, None
+    snapshot = snapshot or config_store.current()
+    return snapshot.index.by_region.get(region, (None, None))
 
-def get_node_by_vultr_ip(vultr_ip):
+def get_node_by_vultr_ip(vultr_ip, snapshot=None):
     """Get node configuration by Vultr endpoint IP"""
-    config = load_config()
-    for node_id, node_config in config["wireguard_config"]["node_assignments"].items():
-        endpoint_ip = node_config["vultr_endpoint"].split(":")[0]
-        if endpoint_ip == vultr_ip:
-            return node_id, node_config
-    return None, None
+    snapshot = snapshot or config_store.current()
+    return snapshot.index.by_endpoint_ip.get(vultr_ip, (None, None))
+
+def get_nodes_by_provider(provider, snapshot=None):
+    """Get node IDs hosted on a provider"""
+    snapshot = snapshot or config_store.current()
+    return snapshot.index.by_provider.get(provider, [])
+
+def get_nodes_by_role(role, snapshot=None):
+    """Get node IDs with a BGP role"""
+    snapshot = snapshot or config_store.current()
+    return snapshot.index.by_role.get(role, [])
+
+def cached_entry(endpoint, key, snapshot, render):
+    """Get the cached rendering of render(snapshot, key), or None if there is nothing to serve"""
+    return response_cache.get(endpoint, key, snapshot.generation,
+                              lambda: render(snapshot, key))
+
+def entry_response(entry, snapshot):
+    """Build a conditional response (200 or 304) for a cached body"""
+    coding = request.accept_encodings.best_match(entry.encodings)
+    body, etag = entry.variant(coding)
+    response = app.response_class(body, mimetype=entry.mimetype)
+    if coding:
+        response.headers["Content-Encoding"] = coding
+    response.vary.add("Accept-Encoding")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Config-Generation"] = str(snapshot.generation)
+    return response.make_conditional(request)
+
+def cached_response(endpoint, key, snapshot, render):
+    """Serve a cached rendering of render(snapshot, key), honoring If-None-Match.
+
+    Returns None when render() has nothing for this key.
+    """
+    entry = cached_entry(endpoint, key, snapshot, render)
+    if entry is None:
+        return None
+    return entry_response(entry, snapshot)
+
+def liveness_headers(response, snapshot, node_id):
+    """Count live and stale peers in headers, leaving the cached body untouched.
+
+    Only counts: a list of names would outgrow proxy header limits on a
+    large mesh. GET /api/v1/nodes/<node_id>/liveness has the names.
+    """
+    live, stale = liveness.report(tunnel_peers(snapshot, node_id))
+    response.headers["X-Live-Peers"] = str(len(live))
+    response.headers["X-Stale-Peers"] = str(len(stale))
+    return response
+
+def instance_regions(snapshot, external_ips):
+    """Look up the Vultr region of each IP not already registered.
+
+    Done before taking the write lock, so a slow Vultr API never holds up
+    other writers.
+    """
+    if vultr_index is None:
+        return {}
+    regions = {}
+    for external_ip in external_ips:
+        if get_node_by_vultr_ip(external_ip, snapshot)[0] is None:
+            regions[external_ip] = vultr_index.region_of(external_ip)
+    return regions
+
+def plan_registrations(snapshot, external_ips, new_nodes=None, regions=None):
+    """Decide which node slot each external IP registers into.
+
+    Returns (node updates, [(status, node_id), ...]) with one result per IP;
+    status is None when no slot is left for that IP. Slots claimed earlier
+    in the list are not handed out again. An IP whose region is known (sent
+    in new_nodes, else looked up in regions) takes an open slot in that
+    region first, whatever its place in the list. Once the pre-seeded slots
+    are used up, IPs whose new_nodes entry has a public_key get a new node
+    with addresses from the mesh and regional allocators. An instance_id
+    in new_nodes is recorded on the node.
+    """
+    updates = {}
+    claimed = {}
+    assignments = snapshot.config["wireguard_config"]["node_assignments"]
+    regions = regions or {}
+    allocator = None
+    results = []
+    
+    for external_ip in external_ips:
+        endpoint = f"{external_ip}:51820"
+        request_node = (new_nodes or {}).get(external_ip) or {}
+        instance = {"instance_id": request_node["instance_id"]} if "instance_id" in request_node else {}
+        
+        # Check if this IP already exists (or was registered earlier in the batch)
+        node_id = claimed.get(external_ip)
+        if node_id is None:
+            node_id, _ = get_node_by_vultr_ip(external_ip, snapshot)
+        if node_id is not None:
+            updates[node_id] = dict(updates.get(node_id, {}), vultr_endpoint=endpoint, **instance)
+            claimed[external_ip] = node_id
+            results.append(('updated', node_id))
+            continue
+        
+        # Take the next node slot still holding a placeholder endpoint IP,
+        # preferring one in the instance's own region
+        region = request_node.get("region") or regions.get(external_ip)
+        free_slots = [slot for slot in snapshot.index.open_slots if slot not in updates]
+        node_id = next((slot for slot in free_slots if assignments[slot]["region"] == region),
+                       free_slots[0] if free_slots else None)
+        if node_id is not None:
+            updates[node_id] = dict(vultr_endpoint=endpoint, **instance)
+            claimed[external_ip] = node_id
+            results.append(('registered', node_id))
+            continue
+        
+        # Otherwise carve a new node out of the address pools
+        if "public_key" not in request_node or not region:
+            results.append((None, None))
+            continue
+        if allocator is None:
+            allocator = mesh_allocator(snapshot).copy()
+        addresses = allocator.allocate_node(region)
+        if addresses is None:
+            results.append(('exhausted', None))
+            continue
+        node_id = f"{region}-{allocator.ipv4.offset_of(addresses['ipv4'])}"
+        updates[node_id] = dict(
+            addresses,
+            # The node generates its key pair locally and keeps the private
+            # half, so the node has no private_key here
+            public_key=request_node["public_key"],
+            vultr_endpoint=endpoint,
+            role="secondary",
+            region=region,
+            provider="vultr",
+            **instance
+        )
+        claimed[external_ip] = node_id
+        results.append(('allocated', node_id))
+    
+    return updates, results
+
+def registration_result(external_ip, status, node_id):
+    """Build the response body and HTTP status for one registration"""
+    if status == 'updated':
+        return {
+            'status': 'updated',
+            'node_id': node_id,
+            'message': f'Updated endpoint for {node_id}'
+        }, 200
+    elif status in ('registered', 'allocated'):
+        return {
+            'status': 'registered',
+            'node_id': node_id,
+            'message': f'Registered as {node_id}',
+            'assigned_ip': external_ip
+        }, 200
+    elif status == 'exhausted':
+        return {'error': 'No free addresses left for a new node in that region'}, 409
+    return {'error': 'No available node slots for registration (send public_key, and region if it cannot be looked up, to allocate a new node)'}, 400
+
+def validation_error_response(error):
+    """422 for a write the config schema rejected (nothing was persisted)"""
+    return jsonify({
+        'error': 'Registration rejected: resulting config is invalid',
+        'details': [{'path': path, 'message': message} for path, message in error.errors]
+    }), 422
+
+def new_node_request(data):
+    """Validate the optional region, public_key and instance_id of a registration.
+
+    region picks the slot; with public_key, a new node can be allocated
+    once the slots run out (region may then be left out when the Vultr
+    instance index can supply it). instance_id is recorded on the node.
+    """
+    fields = {}
+    for name in ('region', 'public_key', 'instance_id'):
+        value = data.get(name)
+        if value is None:
+            continue
+        if not isinstance(value, str) or not value:
+            return None, f'{name} must be a non-empty string'
+        fields[name] = value
+    return fields or None, None
+
+def batch_external_ips(data):
+    """Validate a batch request body; returns (ips, error message)"""
+    external_ips = (data or {}).get('external_ips')
+    if not isinstance(external_ips, list) or not external_ips:
+        return None, 'external_ips must be a non-empty list'
+    if len(external_ips) > MAX_BATCH_SIZE:
+        return None, f'at most {MAX_BATCH_SIZE} external_ips per batch'
+    if not all(isinstance(ip, str) and ip for ip in external_ips):
+        return None, 'external_ips entries must be non-empty strings'
+    return external_ips, None
 
 @app.route('/api/v1/nodes/<region>/config', methods=['GET'])
-def get_node_config(region):
+def get_node_config(region, snapshot=None):
     """Get complete node configuration for a region"""
-    node_id, node_config = get_node_by_region(region)
+    snapshot = snapshot or config_store.current()
+    response = cached_response('node_config', region, snapshot, render_node_config)
     
-    if not node_config:
+    if response is None:
         return jsonify({"error": f"No node found for region {region}"}), 404
     
-    config = load_config()
+    return response
+
+def render_node_config(snapshot, region):
+    """Build the node configuration payload for a region"""
+    node_id, node_config = get_node_by_region(region, snapshot)
+    
+    if not node_config:
+        return None
+    
+    return build_node_config(snapshot, node_id, node_config)
+
+def render_discovered_config(snapshot, node_id):
+    """Build the node configuration payload for a specific node"""
+    node_config = snapshot.config["wireguard_config"]["node_assignments"].get(node_id)
+    
+    if not node_config:
+        return None
+    
+    return build_node_config(snapshot, node_id, node_config)
+
+def build_node_config(snapshot, node_id, node_config):
+    """Node configuration payload shared by /config and discovery"""
+    config = snapshot.config
+    region = node_config["region"]
     geographic_config = config["network_allocation"]["geographic_allocation"].get(region, {})
     
     response = {
@@ -56,7 +393,7 @@ def get_node_config(region):
         "wireguard": {
             "ipv4": node_config["ipv4"],
             "ipv6": node_config["ipv6"],
-            "private_key": node_config["private_key"],
+            **private_key_fields(node_config),
             "port": config["wireguard_config"]["mesh_networks"]["port"]
         },
         "geographic_allocation": geographic_config,
@@ -68,54 +405,207 @@ def get_node_config(region):
         }
     }
     
-    return jsonify(response)
+    return response
 
 @app.route('/api/v1/nodes/<node_id>/wireguard', methods=['GET'])
 def get_wireguard_config(node_id):
-    """Get WireGuard configuration for a specific node"""
-    config = load_config()
-    wg_config = config["wireguard_config"]
+    """
+    Get WireGuard configuration for a specific node.
+    With ?since=<generation>, only peers changed after that generation are
+    returned, falling back to the full listing if it is too old.
+    """
+    snapshot = config_store.current()
     
-    if node_id not in wg_config["node_assignments"]:
+    if 'since' in request.args:
+        since = request.args.get('since', type=int)
+        if since is None:
+            return jsonify({"error": "since must be an integer generation"}), 400
+        response = cached_response('wireguard_delta', (node_id, since), snapshot,
+                                   render_wireguard_delta)
+        if response is not None:
+            return liveness_headers(response, snapshot, node_id)
+    
+    response = cached_response('wireguard', node_id, snapshot, render_wireguard_config)
+    
+    if response is None:
         return jsonify({"error": f"Node {node_id} not found"}), 404
     
+    return liveness_headers(response, snapshot, node_id)
+
+def render_wireguard_config(snapshot, node_id):
+    """Build the WireGuard configuration payload for a node"""
+    wg_config = snapshot.config["wireguard_config"]
+    
+    if node_id not in wg_config["node_assignments"]:
+        return None
+    
     node = wg_config["node_assignments"][node_id]
     mesh_config = wg_config["mesh_networks"]
     
-    # Build peer list (all nodes except self)
-    peers = []
-    for peer_id, peer_config in wg_config["node_assignments"].items():
-        if peer_id != node_id:
-            peers.append({
-                "public_key": peer_config["public_key"],
-                "endpoint": peer_config["vultr_endpoint"],
-                "allowed_ips": [
-                    f"{peer_config['ipv4']}/32",
-                    f"{peer_config['ipv6']}/128"
-                ],
-                "persistent_keepalive": mesh_config["keepalive"],
-                "description": f"{peer_id.upper()} {peer_config['role']}"
-            })
+    # Only this node's tunnels in the configured topology; unregistered
+    # slots are never peers
+    peers = [render_wireguard_peer(peer_id, wg_config["node_assignments"][peer_id], mesh_config)
+             for peer_id in tunnel_peers(snapshot, node_id)]
     
     response = {
-        "interface": {
-            "private_key": node["private_key"],
-            "address": [
-                f"{node['ipv4']}/24",
-                f"{node['ipv6']}/64"
-            ],
-            "listen_port": mesh_config["port"]
-        },
+        "interface": render_wireguard_interface(node, mesh_config),
         "peers": peers
     }
     
-    return jsonify(response)
+    return response
+
+def render_wireguard_interface(node, mesh_config):
+    """Build the [Interface] section of a node's WireGuard payload"""
+    return {
+        **private_key_fields(node),
+        "address": [
+            f"{node['ipv4']}/24",
+            f"{node['ipv6']}/64"
+        ],
+        "listen_port": mesh_config["port"]
+    }
+
+def render_wireguard_peer(peer_id, peer_config, mesh_config):
+    """Build one peer entry of a node's WireGuard payload"""
+    return {
+        "public_key": peer_config["public_key"],
+        "endpoint": peer_config["vultr_endpoint"],
+        "allowed_ips": [
+            f"{peer_config['ipv4']}/32",
+            f"{peer_config['ipv6']}/128"
+        ],
+        "persistent_keepalive": mesh_config["keepalive"],
+        "description": f"{peer_id.upper()} {peer_config['role']}"
+    }
+
+def render_wireguard_delta(snapshot, key):
+    """
+    Build the peer changes for a node since a generation.
+    Returns None when the node is unknown or the generation is outside the
+    retained change log, in which case the full listing is served instead.
+    """
+    node_id, since = key
+    wg_config = snapshot.config["wireguard_config"]
+    assignments = wg_config["node_assignments"]
+    
+    if node_id not in assignments or since > snapshot.generation:
+        return None
+    
+    if since == snapshot.generation:
+        changed = {}
+    else:
+        changed = config_store.changes.changes_since(since)
+        if changed is None:
+            return None
+    
+    mesh_config = wg_config["mesh_networks"]
+    upsert = []
+    remove = []
+    if changed:
+        # A registration can add or drop tunnels between nodes that did not
+        # change themselves, so compare peer lists, not just changed nodes
+        before = tunnel_topology_since(snapshot, since, changed).peers(node_id)
+        after = tunnel_peers(snapshot, node_id)
+        after_set = set(after)
+        for peer_id in before:
+            previous = changed.get(peer_id) or assignments[peer_id]
+            if peer_id not in after_set or previous["public_key"] != assignments[peer_id]["public_key"]:
+                remove.append(previous["public_key"])
+        before_set = set(before)
+        for peer_id in after:
+            peer = render_wireguard_peer(peer_id, assignments[peer_id], mesh_config)
+            if peer_id not in before_set or (
+                    peer_id in changed and peer != render_wireguard_peer(peer_id, changed[peer_id], mesh_config)):
+                upsert.append(peer)
+    
+    return {
+        "since": since,
+        "generation": snapshot.generation,
+        "interface": render_wireguard_interface(assignments[node_id], mesh_config),
+        "upsert": upsert,
+        "remove": remove
+    }
+
+def tunnel_topology_since(snapshot, since, changed):
+    """The tunnel topology as of generation since, rebuilt by reverting changed nodes"""
+    key = ("tunnel_topology_since", since)
+    topology = snapshot.memo.get(key)
+    if topology is None:
+        wg_config = snapshot.config["wireguard_config"]
+        assignments = dict(wg_config["node_assignments"])
+        for node_id, previous in changed.items():
+            if previous is None:
+                assignments.pop(node_id, None)
+            else:
+                assignments[node_id] = previous
+        config = dict(snapshot.config, wireguard_config=dict(wg_config, node_assignments=assignments))
+        topology = build_mesh_topology(config)[1]
+        snapshot.memo[key] = topology
+    return topology
+
+@app.route('/api/v1/nodes/<node_id>/watch', methods=['GET'])
+def watch_node_config(node_id):
+    """
+    Long-poll for a change to a node's rendered config.
+    Blocks while the node's current rendering still matches If-None-Match,
+    returning 200 with the new body as soon as it changes or 304 once
+    ?timeout= seconds (default 30) pass. ?resource= picks wireguard
+    (default) or cloud-init.
+    """
+    resource = request.args.get('resource', 'wireguard')
+    if resource not in WATCH_RESOURCES:
+        return jsonify({"error": f"resource must be one of {sorted(WATCH_RESOURCES)}"}), 400
+    render = WATCH_RESOURCES[resource]
+    timeout = request.args.get('timeout', DEFAULT_WATCH_TIMEOUT, type=float)
+    if not math.isfinite(timeout):
+        # NaN would slip through the clamp and never reach the deadline
+        return jsonify({"error": "timeout must be a finite number of seconds"}), 400
+    timeout = min(max(timeout, 0), MAX_WATCH_TIMEOUT)
+    deadline = time.monotonic() + timeout
+    
+    snapshot = config_store.current()
+    entry = cached_entry(resource, node_id, snapshot, render)
+    if entry is None:
+        return jsonify({"error": f"Node {node_id} not found"}), 404
+    if not entry.matches(request.if_none_match) or timeout <= 0:
+        return entry_response(entry, snapshot)
+    
+    # A waiting watcher holds its worker thread (under gthread), so only
+    # MAX_WATCHERS may wait at once and the rest are told to come back
+    if not watch_slots.acquire(blocking=False):
+        response = jsonify({"error": "too many watchers, retry later"})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(WATCH_RETRY_AFTER)
+        return response
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return entry_response(entry, snapshot)
+            # Other nodes' changes also bump the generation; loop and re-check
+            # whether this node's rendering actually changed
+            snapshot = config_store.wait_for_change(snapshot.generation, remaining)
+            entry = cached_entry(resource, node_id, snapshot, render)
+            if entry is None:
+                return jsonify({"error": f"Node {node_id} not found"}), 404
+            if not entry.matches(request.if_none_match):
+                return entry_response(entry, snapshot)
+    finally:
+        watch_slots.release()
 
 @app.route('/api/v1/firewall/rules', methods=['GET'])
 def get_firewall_rules():
-    """Get firewall rules configuration"""
-    config = load_config()
-    return jsonify(config["firewall_config"])
+    """
+    Get firewall rules configuration, with each source group and the
+    announced subnets aggregated to the fewest CIDRs covering exactly the
+    same addresses, and the before/after counts.
+    """
+    snapshot = config_store.current()
+    return cached_response('firewall', None, snapshot, render_firewall_rules)
+
+def render_firewall_rules(snapshot, key):
+    """Build the aggregated firewall rules payload"""
+    return aggregated_firewall_config(snapshot.config)
 
 @app.route('/api/v1/nodes/register', methods=['POST'])
 def register_node():
@@ -131,45 +621,114 @@ def register_node():
         if not external_ip:
             return jsonify({'error': 'external_ip required'}), 400
         
-        # Load current config
-        config = load_config()
+        new_node, error = new_node_request(data)
+        if error:
+            return jsonify({'error': error}), 400
+        new_nodes = {external_ip: new_node} if new_node else None
         
-        # Check if this IP already exists
-        existing_node_id, existing_node = get_node_by_vultr_ip(external_ip)
+        # Slot selection and the journal append happen under the store's
+        # write lock, so concurrent registrations cannot claim the same slot
+        regions = instance_regions(config_store.current(), [external_ip])
+        results, _ = config_store.transact(
+            lambda snapshot: plan_registrations(snapshot, [external_ip], new_nodes, regions))
         
-        if existing_node:
-            # Update existing node endpoint
-            config['wireguard_config']['node_assignments'][existing_node_id]['vultr_endpoint'] = f"{external_ip}:51820"
-            save_config(config)
-            return jsonify({
-                'status': 'updated',
-                'node_id': existing_node_id,
-                'message': f'Updated endpoint for {existing_node_id}'
-            })
-        else:
-            # Find an available node slot based on unmatched endpoint IPs
-            for node_id, node_config in config['wireguard_config']['node_assignments'].items():
-                current_endpoint_ip = node_config['vultr_endpoint'].split(':')[0]
-                # If this node has a placeholder or unreachable IP, assign the new IP
-                if current_endpoint_ip in ['45.76.21.14', '207.246.118.124', '45.77.206.132', '0.0.0.0']:
-                    config['wireguard_config']['node_assignments'][node_id]['vultr_endpoint'] = f"{external_ip}:51820"
-                    save_config(config)
-                    return jsonify({
-                        'status': 'registered',
-                        'node_id': node_id,
-                        'message': f'Registered as {node_id}',
-                        'assigned_ip': external_ip
-                    })
-            
-            return jsonify({'error': 'No available node slots for registration'}), 400
-            
+        body, status_code = registration_result(external_ip, *results[0])
+        return jsonify(body), status_code
+    
+    except ConfigValidationError as e:
+        return validation_error_response(e)
     except Exception as e:
         return jsonify({'error': f'Registration failed: {str(e)}'}), 500
 
-def save_config(config):
-    """Save updated configuration to file"""
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f, indent=2)
+@app.route('/api/v1/nodes/register:batch', methods=['POST'])
+def register_nodes_batch():
+    """
+    Register a wave of nodes in one request.
+    All registrations are applied in a single transaction with one persist.
+    An optional "nodes" map of external_ip -> {"region", "public_key",
+    "instance_id"} steers each IP to a slot in its region, and with a
+    public_key lets IPs beyond the pre-seeded slots be allocated new nodes.
+    """
+    try:
+        data = request.get_json(silent=True)
+        external_ips, error = batch_external_ips(data)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        new_nodes = {}
+        nodes = data.get('nodes') or {}
+        if not isinstance(nodes, dict):
+            return jsonify({'error': 'nodes must map external_ip to {region, public_key, instance_id}'}), 400
+        for external_ip, node in nodes.items():
+            new_node, error = new_node_request(node) if isinstance(node, dict) else (None, 'expected an object')
+            if error:
+                return jsonify({'error': f'{external_ip}: {error}'}), 400
+            if new_node:
+                new_nodes[external_ip] = new_node
+        
+        regions = instance_regions(config_store.current(), external_ips)
+        results, snapshot = config_store.transact(
+            lambda snapshot: plan_registrations(snapshot, external_ips, new_nodes, regions))
+        
+        items = []
+        for external_ip, (status, node_id) in zip(external_ips, results):
+            body, status_code = registration_result(external_ip, status, node_id)
+            items.append(dict(body, external_ip=external_ip, code=status_code))
+        
+        return jsonify({
+            'results': items,
+            'config_generation': snapshot.generation
+        })
+    
+    except ConfigValidationError as e:
+        return validation_error_response(e)
+    except Exception as e:
+        return jsonify({'error': f'Batch registration failed: {str(e)}'}), 500
+
+@app.route('/api/v1/nodes/<node_id>', methods=['DELETE'])
+def deregister_node(node_id):
+    """
+    Remove a node allocated by registration and return its addresses to the
+    allocator. Needs SD_ADMIN_TOKEN as a bearer token. Seeded nodes (the API
+    holds their keys) and route reflectors are never removed.
+    """
+    error = admin_auth_error()
+    if error is not None:
+        return error
+    
+    def plan(snapshot):
+        node = snapshot.config["wireguard_config"]["node_assignments"].get(node_id)
+        if node is None:
+            return None, ('missing', None)
+        if node["role"] == "route_reflector":
+            return None, ('refused', 'route reflectors cannot be deregistered')
+        if "private_key" in node:
+            return None, ('refused', 'seeded nodes cannot be deregistered')
+        return {node_id: None}, ('removed', None)
+    
+    (status, reason), snapshot = config_store.transact(plan)
+    if status == 'missing':
+        return jsonify({'error': f'Node {node_id} not found'}), 404
+    if status == 'refused':
+        return jsonify({'error': f'Node {node_id}: {reason}'}), 409
+    
+    # Otherwise its timer keeps coming due as stale forever
+    liveness.forget(node_id)
+    
+    return jsonify({
+        'status': 'deregistered',
+        'node_id': node_id,
+        'config_generation': snapshot.generation
+    })
+
+def admin_auth_error():
+    """Error response unless the request carries the admin bearer token, else None"""
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Admin calls are disabled (SD_ADMIN_TOKEN is not set)'}), 403
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return jsonify({'error': 'Admin token required'}), 401
+    return None
 
 @app.route('/api/v1/nodes/discover', methods=['POST'])
 def discover_node():
@@ -180,56 +739,208 @@ def discover_node():
     if not external_ip:
         return jsonify({"error": "external_ip required"}), 400
     
-    node_id, node_config = get_node_by_vultr_ip(external_ip)
+    snapshot = config_store.current()
+    node_id, node_config = get_node_by_vultr_ip(external_ip, snapshot)
     
     if not node_config:
         return jsonify({"error": f"No node found for IP {external_ip}"}), 404
     
-    return get_node_config(node_config["region"])
+    # Keyed by node rather than region: allocated nodes share their region
+    return cached_response('discover', node_id, snapshot, render_discovered_config)
+
+@app.route('/api/v1/nodes/discover:batch', methods=['POST'])
+def discover_nodes_batch():
+    """Auto-discover configuration for several external IPs against one snapshot"""
+    external_ips, error = batch_external_ips(request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error}), 400
+    
+    snapshot = config_store.current()
+    items = []
+    for external_ip in external_ips:
+        node_id, node_config = get_node_by_vultr_ip(external_ip, snapshot)
+        if not node_config:
+            items.append({"external_ip": external_ip, "code": 404,
+                          "error": f"No node found for IP {external_ip}"})
+            continue
+        items.append({"external_ip": external_ip, "code": 200,
+                      "config": build_node_config(snapshot, node_id, node_config)})
+    
+    return jsonify({
+        "results": items,
+        "config_generation": snapshot.generation
+    })
 
 @app.route('/api/v1/status', methods=['GET'])
 def get_status():
     """Get service discovery API status"""
-    config = load_config()
+    snapshot = config_store.current()
+    config = snapshot.config
+    node_ids = list(config["wireguard_config"]["node_assignments"])
+    # Drops nodes deregistered through other workers (or edited out of the file)
+    liveness.retain(node_ids)
+    live, stale = liveness.report(node_ids)
     return jsonify({
         "service": config["service_info"]["name"],
         "version": config["service_info"]["version"],
         "status": "healthy",
         "timestamp": datetime.utcnow().isoformat() + "Z",
         "total_nodes": len(config["wireguard_config"]["node_assignments"]),
-        "anycast_ip": config["network_allocation"]["anycast_config"]["global_service_ip"]
+        "nodes_by_provider": snapshot.index.by_provider,
+        "nodes_by_role": snapshot.index.by_role,
+        "anycast_ip": config["network_allocation"]["anycast_config"]["global_service_ip"],
+        "config_generation": snapshot.generation,
+        "config_loaded_at": datetime.utcfromtimestamp(snapshot.loaded_at).isoformat() + "Z",
+        "live_nodes": live,
+        "stale_nodes": stale,
+        "heartbeat_ttl": liveness.ttl
+    })
+
+@app.route('/api/v1/topology', methods=['GET'])
+def get_topology():
+    """Report iBGP sessions and WireGuard tunnels, per node and in total, for every tunnel layout"""
+    snapshot = config_store.current()
+    return cached_response('topology', None, snapshot, render_topology_report)
+
+def render_topology_report(snapshot, key):
+    """Build the topology report for a snapshot"""
+    ibgp, tunnels = mesh_topology(snapshot)
+    layouts = {}
+    for mode in TUNNEL_TOPOLOGIES:
+        layout = tunnels if mode == tunnels.mode else build_mesh_topology(snapshot.config, mode)[1]
+        layouts[mode] = layout.summary()
+    
+    return {
+        "config_generation": snapshot.generation,
+        "registered_nodes": len(tunnels.node_ids),
+        "unregistered_slots": snapshot.index.open_slots,
+        "ibgp": dict(ibgp.summary(), sessions_per_node={
+            node_id: len(peers) for node_id, peers in ibgp.peers.items()}),
+        "wireguard": {
+            "topology": tunnels.mode,
+            "layouts": layouts
+        }
+    }
+
+@app.route('/api/v1/nodes/<node_id>/heartbeat', methods=['POST'])
+def node_heartbeat(node_id):
+    """Record that a node is alive (memory only, nothing is persisted)"""
+    snapshot = config_store.current()
+    
+    if node_id not in snapshot.config["wireguard_config"]["node_assignments"]:
+        return jsonify({"error": f"Node {node_id} not found"}), 404
+    
+    seen = liveness.heartbeat(node_id)
+    return jsonify({
+        "status": "ok",
+        "node_id": node_id,
+        "last_seen": datetime.utcfromtimestamp(seen).isoformat() + "Z",
+        "ttl": liveness.ttl
+    })
+
+@app.route('/api/v1/nodes/<node_id>/liveness', methods=['GET'])
+def get_node_liveness(node_id):
+    """List which of a node's tunnel peers are live and which are stale"""
+    snapshot = config_store.current()
+    
+    if node_id not in snapshot.config["wireguard_config"]["node_assignments"]:
+        return jsonify({"error": f"Node {node_id} not found"}), 404
+    
+    live, stale = liveness.report(tunnel_peers(snapshot, node_id))
+    return jsonify({
+        "node_id": node_id,
+        "live_peers": live,
+        "stale_peers": stale,
+        "heartbeat_ttl": liveness.ttl
+    })
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics (summed over all workers under serve)"""
+    return app.response_class(metrics.render(),
+                              content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/v1/admin/reload', methods=['POST'])
+def reload_config():
+    """Force a re-read of the service discovery configuration file"""
+    try:
+        snapshot = config_store.reload(force=True)
+    except (OSError, ValueError) as e:
+        return jsonify({'error': f'Reload failed: {str(e)}'}), 500
+    return jsonify({
+        'status': 'reloaded',
+        'config_generation': snapshot.generation
+    })
+
+@app.route('/api/v1/admin/compact', methods=['POST'])
+def compact_config():
+    """Fold the registration journal back into the schema file"""
+    try:
+        snapshot = config_store.compact()
+    except (OSError, ValueError) as e:
+        return jsonify({'error': f'Compaction failed: {str(e)}'}), 500
+    return jsonify({
+        'status': 'compacted',
+        'config_generation': snapshot.generation
+    })
+
+@app.route('/api/v1/admin/geography', methods=['GET'])
+def check_geography():
+    """Report registered nodes whose Vultr instance lives in another region"""
+    if vultr_index is None:
+        return jsonify({'error': 'VULTR_API_KEY is not configured'}), 503
+    
+    snapshot = config_store.current()
+    open_slots = set(snapshot.index.open_slots)
+    corrections = []
+    unknown = []
+    # One (cached) instance listing serves every node
+    for node_id, node_config in snapshot.config['wireguard_config']['node_assignments'].items():
+        if node_id in open_slots:
+            continue
+        current_endpoint_ip = node_config['vultr_endpoint'].split(':')[0]
+        vultr_region = vultr_index.region_of(current_endpoint_ip)
+        if vultr_region is None:
+            unknown.append(node_id)
+        elif vultr_region != node_config['region']:
+            corrections.append({
+                'ip': current_endpoint_ip,
+                'node_id': node_id,
+                'configured_region': node_config['region'],
+                'vultr_region': vultr_region
+            })
+    
+    return jsonify({
+        'status': 'analysis_complete',
+        'corrections_needed': corrections,
+        'not_found_in_vultr': unknown,
+        'instances_indexed': len(vultr_index),
+        'index_error': vultr_index.last_error
     })
 
 @app.route('/api/v1/nodes/<node_id>/cloud-init', methods=['GET'])
 def get_cloud_init_config(node_id):
     """Generate cloud-init configuration for a node"""
-    config = load_config()
+    snapshot = config_store.current()
+    response = cached_response('cloud-init', node_id, snapshot, render_cloud_init_config)
+    
+    if response is None:
+        return jsonify({"error": f"Node {node_id} not found"}), 404
+    
+    return response
+
+def render_cloud_init_config(snapshot, node_id):
+    """Build the cloud-init payload for a node"""
+    config = snapshot.config
     wg_config = config["wireguard_config"]
     
     if node_id not in wg_config["node_assignments"]:
-        return jsonify({"error": f"Node {node_id} not found"}), 404
+        return None
     
     node = wg_config["node_assignments"][node_id]
     
-    # Generate WireGuard configuration
-    wg_interface = f"""[Interface]
-PrivateKey = {node['private_key']}
-Address = {node['ipv4']}/24, {node['ipv6']}/64
-ListenPort = {wg_config['mesh_networks']['port']}
-
-"""
-    
-    # Add peers
-    for peer_id, peer_config in wg_config["node_assignments"].items():
-        if peer_id != node_id:
-            wg_interface += f"""[Peer]
-# {peer_id.upper()}
-PublicKey = {peer_config['public_key']}
-Endpoint = {peer_config['vultr_endpoint']}
-AllowedIPs = {peer_config['ipv4']}/32, {peer_config['ipv6']}/128
-PersistentKeepalive = {wg_config['mesh_networks']['keepalive']}
-
-"""
+    # Generate WireGuard configuration from the shared per-peer fragments
+    wg_interface = render_wg_conf(snapshot, node_id)
     
     response = {
         "node_id": node_id,
@@ -246,7 +957,82 @@ PersistentKeepalive = {wg_config['mesh_networks']['keepalive']}
         ]
     }
     
-    return jsonify(response)
+    return response
+
+@app.route('/api/v1/nodes/<node_id>/wg0.conf', methods=['GET'])
+def get_wg_conf(node_id):
+    """
+    Stream a node's WireGuard config as plain text, ready to pipe into
+    /etc/wireguard/wg0.conf.
+    """
+    snapshot = config_store.current()
+    
+    if node_id not in snapshot.config["wireguard_config"]["node_assignments"]:
+        return jsonify({"error": f"Node {node_id} not found"}), 404
+    
+    # Generations are shared by all workers, so they can stand in for a
+    # content hash without buffering the body
+    etag = f"wg0-{node_id}-{snapshot.generation}"
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(iter_wg_conf(snapshot, node_id), mimetype='text/plain')
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Config-Generation"] = str(snapshot.generation)
+    return liveness_headers(response, snapshot, node_id)
+
+@app.route('/api/v1/nodes/<node_id>/bird', methods=['GET'])
+def get_bird_bundle(node_id):
+    """Get every BIRD config file for a node in one response"""
+    snapshot = config_store.current()
+    error = bird_node_error(snapshot, node_id)
+    if error is not None:
+        return error
+    
+    return cached_response('bird', node_id, snapshot, render_bird_bundle)
+
+@app.route('/api/v1/nodes/<node_id>/bird/<name>.conf', methods=['GET'])
+def get_bird_config(node_id, name):
+    """
+    Get one BIRD config file (bird, vultr, ibgp, static or filters) for a
+    node as plain text, ready to drop into /etc/bird/.
+    """
+    snapshot = config_store.current()
+    error = bird_node_error(snapshot, node_id)
+    if error is not None:
+        return error
+    
+    filename = f"{name}.conf"
+    if filename not in BIRD_OUTPUTS:
+        return jsonify({"error": f"Unknown BIRD config file {filename}"}), 404
+    
+    entry = bird_cache.get('bird', (node_id, filename), snapshot.generation,
+                           lambda: render_output(snapshot_fleet(snapshot), node_id, filename))
+    return entry_response(entry, snapshot)
+
+def bird_node_error(snapshot, node_id):
+    """Error response if a node cannot be given BIRD configs, else None"""
+    if node_id not in snapshot.config["wireguard_config"]["node_assignments"]:
+        return jsonify({"error": f"Node {node_id} not found"}), 404
+    if node_id in snapshot.index.open_slots:
+        # Its router id and the peers' view of it are not known until it registers
+        return jsonify({"error": f"Node {node_id} is not registered yet"}), 409
+    return None
+
+def render_bird_bundle(snapshot, node_id):
+    """Build the payload of every BIRD config file for a node"""
+    return {
+        "node_id": node_id,
+        "config_generation": snapshot.generation,
+        "files": render_bundle(snapshot_fleet(snapshot), node_id)
+    }
+
+# Renderings a node can watch, keyed by ?resource= (also the cache endpoint name)
+WATCH_RESOURCES = {
+    'wireguard': render_wireguard_config,
+    'cloud-init': render_cloud_init_config
+}
 
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == 'test':
@@ -274,6 +1060,13 @@ if __name__ == '__main__':
             response = client.post('/api/v1/nodes/discover', 
                                  json={"external_ip": "149.248.2.74"})
             print(json.dumps(response.get_json(), indent=2))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        # Production mode: gunicorn workers, configured via SD_* env vars
+        from service_discovery.server import serve
+        metrics.enable_sharing(f"{CONFIG_FILE}.metrics")
+        liveness.enable_sharing(f"{CONFIG_FILE}.liveness",
+                                len(config_store.current().config["wireguard_config"]["node_assignments"]))
+        serve(app, warm=config_store.current)
     else:
-        # Run the API server
+        # Run the development server
         app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
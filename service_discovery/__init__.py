@@ -0,0 +1,3 @@
+"""
+Support modules for the BGP Mesh Service Discovery API (service-discovery-api.py)
+"""
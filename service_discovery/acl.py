@@ -0,0 +1,102 @@
+"""
+Source-address access control for the service discovery API.
+
+The allowed networks come from firewall_config.source_groups (the same
+groups the node firewalls use), plus the pseudo-group "registered_nodes"
+holding every registered node's endpoint IP. They are compiled into one
+binary prefix trie per address family, so checking a client address is a
+single longest-prefix walk of at most 32 (IPv4) or 128 (IPv6) steps no
+matter how many networks are allowed. The compiled list is cached on the
+config snapshot and rebuilt when a new generation is published.
+"""
+
+import ipaddress
+
+from .aggregate import aggregate_networks
+from .snapshot import PLACEHOLDER_ENDPOINT_IPS, endpoint_ip
+
+# Pseudo-group of registered node endpoint IPs, derived from node_assignments
+REGISTERED_NODES = "registered_nodes"
+
+
+class PrefixTrie:
+    """Binary trie mapping IP prefixes of one family to values"""
+
+    def __init__(self, bits):
+        self.bits = bits
+        # Each node is [child for bit 0, child for bit 1, value]
+        self._root = [None, None, None]
+
+    def insert(self, network, value):
+        """Map network (an ip_network) to value; later inserts win on equal prefixes"""
+        address = int(network.network_address)
+        node = self._root
+        for i in range(network.prefixlen):
+            bit = address >> (self.bits - 1 - i) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        node[2] = value
+
+    def lookup(self, address):
+        """Value of the longest prefix containing address (an int), or None"""
+        node = self._root
+        match = node[2]
+        shift = self.bits - 1
+        while node is not None:
+            if node[2] is not None:
+                match = node[2]
+            if shift < 0:
+                break
+            node = node[address >> shift & 1]
+            shift -= 1
+        return match
+
+
+class AccessList:
+    """Allowed source networks compiled from a config's source groups.
+
+    groups selects which source groups are allowed (None or "*" for all);
+    unknown group names allow nothing.
+    """
+
+    def __init__(self, config, groups=None, extra_networks=()):
+        self._tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        self.networks = 0
+        source_groups = dict(config["firewall_config"]["source_groups"])
+        source_groups[REGISTERED_NODES] = [
+            endpoint_ip(node["vultr_endpoint"])
+            for node in config["wireguard_config"]["node_assignments"].values()
+            if endpoint_ip(node["vultr_endpoint"]) not in PLACEHOLDER_ENDPOINT_IPS
+        ]
+        if groups is None or "*" in groups:
+            groups = list(source_groups)
+        for group in groups:
+            # Aggregated per group, so the trie holds the fewest prefixes
+            for network in aggregate_networks(source_groups.get(group, ())):
+                self.add(network, group)
+        for cidr in extra_networks:
+            self.add(cidr, "extra")
+
+    def add(self, cidr, group):
+        network = ipaddress.ip_network(cidr, strict=False)
+        self._tries[network.version].insert(network, group)
+        self.networks += 1
+
+    def match(self, address):
+        """Name of the group allowing address, or None if it is not allowed"""
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return None
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        return self._tries[address.version].lookup(int(address))
+
+
+def access_list(snapshot, groups=None, extra_networks=()):
+    """The snapshot's compiled AccessList, built on first use"""
+    acl = snapshot.memo.get("acl")
+    if acl is None:
+        acl = snapshot.memo["acl"] = AccessList(snapshot.config, groups, extra_networks)
+    return acl
@@ -0,0 +1,62 @@
+"""
+CIDR aggregation for firewall source groups, announced subnets and BIRD
+prefix sets.
+
+Config lists are written one address or allocation at a time (a /32 per
+node in firewall_config.source_groups, a /29 per region in
+network_allocation.geographic_allocation), and every generated firewall
+rule or filter entry used to follow them one to one. aggregate_networks()
+collapses a list into the minimal set of CIDRs covering exactly the same
+addresses: duplicates and networks inside another are dropped and sibling
+networks are merged into their parent, repeatedly, per address family.
+Nothing is widened, so a rule built from the aggregated list matches the
+same packets or routes as one built from the original.
+"""
+
+import ipaddress
+
+
+def aggregate_networks(cidrs):
+    """Minimal list of networks covering exactly the addresses of cidrs, IPv4 first"""
+    families = {4: [], 6: []}
+    for cidr in cidrs:
+        network = ipaddress.ip_network(cidr, strict=False)
+        families[network.version].append(network)
+    return [network for version in (4, 6) for network in ipaddress.collapse_addresses(families[version])]
+
+
+def aggregation_counts(before, after):
+    return {"before": before, "after": after}
+
+
+def aggregate_groups(groups):
+    """Aggregate every {name: [cidr, ...]} group on its own.
+
+    Returns ({name: [cidr, ...]}, {name: {"before": n, "after": m}}), plus
+    a "total" count.
+    """
+    aggregated = {}
+    counts = {}
+    for name, cidrs in groups.items():
+        aggregated[name] = [str(network) for network in aggregate_networks(cidrs)]
+        counts[name] = aggregation_counts(len(cidrs), len(aggregated[name]))
+    counts["total"] = aggregation_counts(sum(count["before"] for count in counts.values()),
+                                         sum(count["after"] for count in counts.values()))
+    return aggregated, counts
+
+
+def aggregated_firewall_config(config):
+    """firewall_config with its source groups aggregated, the announced subnets and before/after counts.
+
+    The announced subnets are the geographic_allocation subnets the
+    announced IPs (the destinations of announced_ip_rules) are taken from.
+    """
+    firewall_config = config["firewall_config"]
+    source_groups, source_counts = aggregate_groups(firewall_config["source_groups"])
+    subnets = [allocation["subnet"]
+               for allocation in config["network_allocation"]["geographic_allocation"].values()]
+    announced = [str(network) for network in aggregate_networks(subnets)]
+    return dict(firewall_config, source_groups=source_groups, announced_subnets=announced, aggregation={
+        "source_groups": source_counts,
+        "announced_subnets": aggregation_counts(len(subnets), len(announced)),
+    })
@@ -0,0 +1,185 @@
+"""
+Address allocation for new mesh nodes.
+
+Each pool is a bitmap (a Python int, one bit per host offset) over a
+subnet: the WireGuard mesh IPv4 and IPv6 subnets and each region's /29
+from network_allocation.geographic_allocation. Allocating takes the lowest
+clear bit and releasing clears it again, both a few machine-word
+operations rather than a walk over the node list.
+
+The bitmaps are derived from node_assignments, so whatever the journal and
+schema file persist is what survives a restart. They are built once when
+first needed and then carried from snapshot to snapshot by applying only
+the nodes that changed in each generation.
+"""
+
+import ipaddress
+
+# IPv6 subnets are far larger than the node count; only the first hosts
+# (matching the IPv4 host numbers, e.g. fd00:10:10::5 for 10.10.10.5) are used
+MAX_POOL_SIZE = 1 << 16
+
+NODE_ADDRESS_FIELDS = ("ipv4", "ipv6", "announced_ip")
+
+
+class AddressPool:
+    """Bitmap of used host offsets within one subnet"""
+
+    def __init__(self, network):
+        self.network = ipaddress.ip_network(network)
+        self.size = min(self.network.num_addresses, MAX_POOL_SIZE)
+        # Network address, plus the IPv4 broadcast address, are never handed out
+        self._fixed = 1
+        if self.network.version == 4 and self.network.num_addresses > 2:
+            self._fixed |= 1 << (self.network.num_addresses - 1)
+        self._bits = self._fixed
+
+    def copy(self):
+        pool = AddressPool.__new__(AddressPool)
+        pool.network = self.network
+        pool.size = self.size
+        pool._fixed = self._fixed
+        pool._bits = self._bits
+        return pool
+
+    def _offset(self, address):
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return None
+        if address.version != self.network.version or address not in self.network:
+            return None
+        offset = int(address) - int(self.network.network_address)
+        return offset if offset < self.size else None
+
+    def __contains__(self, address):
+        offset = self._offset(address)
+        return offset is not None and bool(self._bits >> offset & 1)
+
+    def reserve(self, address, fixed=False):
+        """Mark address used; fixed reservations are never released"""
+        offset = self._offset(address)
+        if offset is not None:
+            self._bits |= 1 << offset
+            if fixed:
+                self._fixed |= 1 << offset
+
+    def release(self, address):
+        offset = self._offset(address)
+        if offset is not None:
+            self._bits &= ~(1 << offset) | self._fixed
+
+    def allocate(self, offset=None):
+        """Claim a free address, preferring host offset if it is free"""
+        if offset is None or not 0 <= offset < self.size or self._bits >> offset & 1:
+            # Lowest clear bit
+            offset = (~self._bits & (self._bits + 1)).bit_length() - 1
+            if offset >= self.size:
+                return None
+        self._bits |= 1 << offset
+        return str(self.network.network_address + offset)
+
+    def offset_of(self, address):
+        return self._offset(address)
+
+    @property
+    def free(self):
+        return self.size - bin(self._bits & ((1 << self.size) - 1)).count("1")
+
+
+class MeshAllocator:
+    """Address pools for the mesh subnets and every region's /29"""
+
+    def __init__(self, config):
+        mesh = config["wireguard_config"]["mesh_networks"]
+        self.ipv4 = AddressPool(mesh["ipv4_subnet"])
+        self.ipv6 = AddressPool(mesh["ipv6_subnet"])
+        self.regions = {}
+        for region, allocation in config["network_allocation"]["geographic_allocation"].items():
+            pool = AddressPool(allocation["subnet"])
+            # Addresses named in the allocation table are pre-assigned
+            for key, address in allocation.items():
+                if key != "subnet":
+                    pool.reserve(address, fixed=True)
+            self.regions[region] = pool
+        for node in config["wireguard_config"]["node_assignments"].values():
+            self.reserve_node(node)
+
+    def copy(self):
+        allocator = MeshAllocator.__new__(MeshAllocator)
+        allocator.ipv4 = self.ipv4.copy()
+        allocator.ipv6 = self.ipv6.copy()
+        allocator.regions = {region: pool.copy() for region, pool in self.regions.items()}
+        return allocator
+
+    def _pools(self, node):
+        # Nodes come from validated configs, so every address field is present
+        yield self.ipv4, node["ipv4"]
+        yield self.ipv6, node["ipv6"]
+        pool = self.regions.get(node["region"])
+        if pool is not None:
+            yield pool, node["announced_ip"]
+
+    def reserve_node(self, node):
+        for pool, address in self._pools(node):
+            if address:
+                pool.reserve(address)
+
+    def release_node(self, node):
+        for pool, address in self._pools(node):
+            if address:
+                pool.release(address)
+
+    def allocate_node(self, region):
+        """Claim mesh and announced addresses for a new node in region.
+
+        Returns a dict of the address fields, or None (claiming nothing) if
+        the region is unknown or any of its pools is exhausted.
+        """
+        region_pool = self.regions.get(region)
+        if region_pool is None:
+            return None
+        ipv4 = self.ipv4.allocate()
+        if ipv4 is None:
+            return None
+        # Keep the IPv6 host number in step with the IPv4 one where possible
+        ipv6 = self.ipv6.allocate(self.ipv4.offset_of(ipv4))
+        announced_ip = region_pool.allocate() if ipv6 is not None else None
+        if announced_ip is None:
+            self.ipv4.release(ipv4)
+            if ipv6 is not None:
+                self.ipv6.release(ipv6)
+            return None
+        return {"ipv4": ipv4, "ipv6": ipv6, "announced_ip": announced_ip}
+
+    def apply_changes(self, changes, node_assignments):
+        """Update the pools for one generation's diff_assignments() result"""
+        for node_id, previous in changes.items():
+            if previous is not None:
+                self.release_node(previous)
+        for node_id in changes:
+            node = node_assignments.get(node_id)
+            if node is not None:
+                self.reserve_node(node)
+
+
+def _same_networks(old, new):
+    return (old["wireguard_config"]["mesh_networks"] == new["wireguard_config"]["mesh_networks"]
+            and old["network_allocation"] == new["network_allocation"])
+
+
+def mesh_allocator(snapshot):
+    """The snapshot's allocator; copy() it before allocating from it"""
+    allocator = snapshot.memo.get("allocator")
+    if allocator is None:
+        allocator = snapshot.memo["allocator"] = MeshAllocator(snapshot.config)
+    return allocator
+
+
+def inherit_allocator(previous, snapshot, changes):
+    """Carry previous's allocator over to snapshot by applying only changes"""
+    allocator = previous.memo.get("allocator")
+    if allocator is not None and _same_networks(previous.config, snapshot.config):
+        allocator = allocator.copy()
+        allocator.apply_changes(changes, snapshot.config["wireguard_config"]["node_assignments"])
+        snapshot.memo["allocator"] = allocator
@@ -0,0 +1,276 @@
+"""
+BIRD configuration rendering for the anycast mesh.
+
+Renders each node's bird.conf, vultr.conf, ibgp.conf, static.conf and
+filters.conf into memory from the "templates" section of bgp_config.json,
+the file operators edit (a config passed in may override them one by
+one). Templates are parsed once into literal and placeholder segments, and
+their placeholders are checked against the variables they are rendered
+with before any node is rendered.
+
+The input is a bgp_config.json-style config ("global", "nodes"). The
+offline generator (development_tools/bird_configs/generate_configs.py)
+writes the output to disk; the discovery API serves it from
+service-discovery-schema.json through discovery_fleet_config(), cached per
+config generation, so both are rendered by the same code.
+"""
+
+import hashlib
+import json
+import re
+from pathlib import Path
+
+from .filters import compile_route_filters, render_route_filters
+from .snapshot import endpoint_ip
+from .topology import FULL_MESH, REFLECTORS_PER_REGION, ROUTE_REFLECTOR, build_ibgp_topology, mesh_topology
+
+BGP_CONFIG_FILE = Path(__file__).resolve().parents[1] / "bgp_config.json"
+
+# {NAME} placeholders; BIRD's own braces never hold an upper-case identifier
+PLACEHOLDER = re.compile(r"\{([A-Z][A-Z0-9_]*)\}")
+
+# Variables each template is rendered with: (required, optional). A required
+# variable the template never uses is as much an error as a placeholder
+# nothing provides; optional ones may be left out of the template.
+TEMPLATE_VARIABLES = {
+    "static_routes": (set(), {"IPV4_PREFIX", "IPV6_PREFIX"}),
+    "vultr_bgp": ({"VULTR_ASN", "OUR_ASN", "VULTR_IP", "VULTR_IPV4_NEIGHBOR", "VULTR_IPV6_NEIGHBOR",
+                   "VULTR_MULTIHOP", "VULTR_PASSWORD", "IPV4_PREFIX", "IPV6_PREFIX"}, set()),
+    "ibgp": ({"OUR_ASN", "NODE_NAME_UPPER", "NODE_WG_IP", "SESSIONS"},
+             {"NODE_NAME", "IBGP_ROLE", "IBGP_TOPOLOGY", "SESSION_COUNT"}),
+    # One protocol block per iBGP session, joined into the ibgp template's {SESSIONS}
+    "ibgp_session": ({"NODE_NAME_UPPER", "PEER_NAME", "PEER_NAME_UPPER", "PEER_WG_IP", "RR_OPTIONS"},
+                     {"PEER_DESCRIPTION", "IBGP_IMPORT", "IBGP_EXPORT"}),
+    "bird_base": ({"NODE_NAME", "NODE_ROLE", "VULTR_IP"}, set()),
+    "bird_filters": ({"FILTERS"}, set()),
+}
+
+with open(BGP_CONFIG_FILE) as f:
+    DEFAULT_TEMPLATES = json.load(f)["templates"]
+
+
+class TemplateError(ValueError):
+    """A template's placeholders do not match the variables it is rendered with"""
+
+
+class Template:
+    """A template parsed once into literal and placeholder segments"""
+
+    def __init__(self, name, text, required=(), optional=()):
+        self.name = name
+        # split() alternates literal text and placeholder names
+        self.segments = PLACEHOLDER.split(text)
+        self.fields = self.segments[1::2]
+        # Identifies the template text in output input-hashes
+        self.digest = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+        used = set(self.fields)
+        unknown = used - set(required) - set(optional)
+        unused = set(required) - used
+        problems = []
+        if unknown:
+            problems.append(f"unknown placeholders {', '.join(sorted(unknown))}")
+        if unused:
+            problems.append(f"unused variables {', '.join(sorted(unused))}")
+        if problems:
+            raise TemplateError(f"template {name}: {'; '.join(problems)}")
+
+    def render(self, values):
+        """Fill every placeholder from values in one pass"""
+        segments = list(self.segments)
+        for i in range(1, len(segments), 2):
+            segments[i] = str(values[segments[i]])
+        return "".join(segments)
+
+
+def compile_templates(config):
+    """Compile every template, reporting all mismatches at once.
+
+    config["templates"], when present, overrides the defaults by name.
+    """
+    sources = dict(DEFAULT_TEMPLATES, **config.get("templates", {}))
+    templates = {}
+    errors = []
+    for name, (required, optional) in TEMPLATE_VARIABLES.items():
+        try:
+            templates[name] = Template(name, sources[name], required, optional)
+        except KeyError:
+            errors.append(f"template {name}: missing from config")
+        except TemplateError as e:
+            errors.append(str(e))
+    if errors:
+        raise TemplateError("\n".join(errors))
+    return templates
+
+
+def bird_symbol(node_name):
+    """Upper-case BIRD identifier for a node name, as in ORD_WG_IP"""
+    return re.sub(r"\W", "_", node_name).upper()
+
+
+def ibgp_topology(config):
+    """iBGP topology for every node in config, laid out as global.ibgp selects"""
+    ibgp = config["global"].get("ibgp", {})
+    nodes = ((node_name, node.get("region", node_name), node.get("is_route_reflector", False))
+             for node_name, node in config["nodes"].items())
+    return build_ibgp_topology(nodes, ibgp.get("topology", ROUTE_REFLECTOR),
+                               ibgp.get("reflectors_per_region", REFLECTORS_PER_REGION))
+
+
+class Fleet:
+    """A config with its compiled templates, route filters and iBGP topology, shared by every output rendered from it.
+
+    topology defaults to ibgp_topology(config); a node it leaves out gets
+    no iBGP sessions.
+    """
+
+    def __init__(self, config, topology=None):
+        self.config = config
+        self.templates = compile_templates(config)
+        self.topology = ibgp_topology(config) if topology is None else topology
+        # Same for every node, so compiled once
+        self.route_filters = compile_route_filters(config.get("route_filters", {}))
+        self.filters = render_route_filters(self.route_filters)
+
+
+def discovery_fleet_config(config):
+    """Fleet config for the nodes of a service discovery config (service-discovery-schema.json)"""
+    bgp_config = config["bgp_config"]
+    nodes = {}
+    for node_id, node in config["wireguard_config"]["node_assignments"].items():
+        nodes[node_id] = {
+            "role": node["role"],
+            "region": node["region"],
+            "vultr_ip": endpoint_ip(node["vultr_endpoint"]),
+            "wireguard_ipv4": node["ipv4"],
+            "wireguard_ipv6": node["ipv6"],
+            "is_route_reflector": node["role"] == "route_reflector",
+        }
+    return {
+        "global": dict(bgp_config["global"], ibgp=bgp_config.get("ibgp", {})),
+        "nodes": nodes,
+        "route_filters": bgp_config.get("route_filters", {}),
+    }
+
+
+def snapshot_fleet(snapshot):
+    """Fleet for a discovery snapshot, built once per generation.
+
+    Its iBGP sessions are the ones the snapshot's WireGuard tunnels are laid
+    out for, so only registered nodes have any.
+    """
+    fleet = snapshot.memo.get("bird_fleet")
+    if fleet is None:
+        fleet = Fleet(discovery_fleet_config(snapshot.config), mesh_topology(snapshot)[0])
+        snapshot.memo["bird_fleet"] = fleet
+    return fleet
+
+
+def static_inputs(fleet, node_name):
+    """Template name and variables for static.conf"""
+    config = fleet.config
+    return "static_routes", {
+        "IPV4_PREFIX": config["global"]["announcements"]["ipv4"][0],
+        "IPV6_PREFIX": config["global"]["announcements"]["ipv6"][0],
+    }
+
+
+def vultr_inputs(fleet, node_name):
+    """Template name and variables for vultr.conf"""
+    config = fleet.config
+    node = config["nodes"][node_name]
+    vultr_bgp = config["global"]["vultr_bgp"]
+
+    return "vultr_bgp", {
+        "VULTR_ASN": config["global"]["vultr_asn"],
+        "OUR_ASN": config["global"]["our_asn"],
+        "VULTR_IP": node["vultr_ip"],
+        "VULTR_IPV4_NEIGHBOR": vultr_bgp["ipv4_neighbor"],
+        "VULTR_IPV6_NEIGHBOR": vultr_bgp["ipv6_neighbor"],
+        "VULTR_MULTIHOP": vultr_bgp["multihop"],
+        "VULTR_PASSWORD": vultr_bgp["password"],
+        "IPV4_PREFIX": config["global"]["announcements"]["ipv4"][0],
+        "IPV6_PREFIX": config["global"]["announcements"]["ipv6"][0],
+    }
+
+
+def ibgp_inputs(fleet, node_name):
+    """Template name and variables for ibgp.conf, with one session block per iBGP peer"""
+    nodes = fleet.config["nodes"]
+    route_filters = fleet.config.get("route_filters", {})
+    topology = fleet.topology
+    session = fleet.templates["ibgp_session"]
+    node_symbol = bird_symbol(node_name)
+    # Sessions use the compiled filters.conf filters when there are any
+    import_filter = "filter ibgp_import" if "ibgp_import" in route_filters else "all"
+    export_filter = "filter ibgp_export" if "ibgp_export" in route_filters else "all"
+
+    sessions = []
+    for peer in topology.peers.get(node_name, ()):
+        peer_symbol = bird_symbol(peer.node_id)
+        sessions.append(session.render({
+            "NODE_NAME_UPPER": node_symbol,
+            "PEER_NAME": peer_symbol.lower(),
+            "PEER_NAME_UPPER": peer_symbol,
+            "PEER_WG_IP": nodes[peer.node_id]["wireguard_ipv4"],
+            "PEER_DESCRIPTION": f"{peer_symbol} (route reflector)" if peer.relation == "reflector" else peer_symbol,
+            "RR_OPTIONS": f"  rr client;\n  rr cluster id {peer.cluster_id};\n" if peer.relation == "client" else "",
+            "IBGP_IMPORT": import_filter,
+            "IBGP_EXPORT": export_filter,
+        }))
+
+    if topology.is_reflector(node_name):
+        role = f"a route reflector (cluster {topology.cluster_ids[node_name]})"
+    elif topology.mode == FULL_MESH or node_name not in topology.peers:
+        role = "a full-mesh peer" if node_name in topology.peers else "not yet in the iBGP mesh"
+    else:
+        role = "a route reflector client"
+
+    return "ibgp", {
+        "OUR_ASN": fleet.config["global"]["our_asn"],
+        "NODE_NAME": node_name,
+        "NODE_NAME_UPPER": node_symbol,
+        "NODE_WG_IP": nodes[node_name]["wireguard_ipv4"],
+        "IBGP_ROLE": role,
+        "IBGP_TOPOLOGY": topology.mode,
+        "SESSION_COUNT": len(sessions),
+        "SESSIONS": "".join(sessions),
+    }
+
+
+def bird_inputs(fleet, node_name):
+    """Template name and variables for bird.conf"""
+    node = fleet.config["nodes"][node_name]
+
+    return "bird_base", {
+        "NODE_NAME": node_name.upper(),
+        "NODE_ROLE": node["role"],
+        "VULTR_IP": node["vultr_ip"],
+    }
+
+
+def filters_inputs(fleet, node_name):
+    """Template name and variables for filters.conf"""
+    return "bird_filters", {
+        "FILTERS": fleet.filters,
+    }
+
+
+# Output file -> function giving its template and variables
+OUTPUTS = {
+    "static.conf": static_inputs,
+    "vultr.conf": vultr_inputs,
+    "ibgp.conf": ibgp_inputs,
+    "bird.conf": bird_inputs,
+    "filters.conf": filters_inputs,
+}
+
+
+def render_output(fleet, node_name, filename):
+    """Render one output file for a node"""
+    template_name, values = OUTPUTS[filename](fleet, node_name)
+    return fleet.templates[template_name].render(values)
+
+
+def render_bundle(fleet, node_name):
+    """Render every output file for a node, keyed by file name"""
+    return {filename: render_output(fleet, node_name, filename) for filename in OUTPUTS}
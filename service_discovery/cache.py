@@ -0,0 +1,92 @@
+"""
+Pre-rendered response cache for the service discovery API.
+
+Per-node responses only change when the config changes, so each body is
+serialized once per (endpoint, node, config generation) and reused until
+the next generation is published. Every body carries a strong ETag derived
+from its content so polling clients can revalidate with If-None-Match.
+
+Compressed variants of a body are built on first request for each content
+coding and kept with it, so compression also happens once per generation.
+Each variant has its own ETag (the body's ETag plus the coding).
+"""
+
+import hashlib
+import threading
+
+from .encoding import ENCODINGS, MIN_COMPRESS_SIZE, compress
+
+
+class CachedBody:
+    """A fully serialized response body, its ETag and compressed variants"""
+
+    __slots__ = ("body", "etag", "mimetype", "encodings", "_variants")
+
+    def __init__(self, body, mimetype):
+        self.body = body
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.mimetype = mimetype
+        self.encodings = ENCODINGS if len(body) >= MIN_COMPRESS_SIZE else ()
+        self._variants = {}
+
+    def variant(self, coding):
+        """(body, etag) for a content coding, or the identity body for None"""
+        if coding is None:
+            return self.body, self.etag
+        variant = self._variants.get(coding)
+        if variant is None:
+            # Racing threads may both compress; either result is identical
+            variant = self._variants[coding] = (compress(self.body, coding), f"{self.etag}-{coding}")
+        return variant
+
+    def matches(self, if_none_match):
+        """True if If-None-Match names this body in any encoding"""
+        return if_none_match.contains(self.etag) or any(
+            if_none_match.contains(f"{self.etag}-{coding}") for coding in self.encodings)
+
+
+class ResponseCache:
+    """Serialized response bodies keyed by (endpoint, node, config generation)"""
+
+    def __init__(self, serializer, mimetype="application/json"):
+        self.serializer = serializer
+        self.mimetype = mimetype
+        self._entries = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, endpoint, node, generation, render):
+        """Return the cached body, calling render() to build it on a miss.
+
+        render() returns the payload to serialize, or None when there is
+        nothing to serve (e.g. unknown node); None results are not cached.
+        """
+        key = (endpoint, node, generation)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        payload = render()
+        if payload is None:
+            return None
+        entry = CachedBody(self.serializer(payload), self.mimetype)
+
+        with self._lock:
+            if generation > self._generation:
+                # Bodies from older generations can never be served again
+                self._entries = {}
+                self._generation = generation
+            if generation == self._generation:
+                self._entries[key] = entry
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,85 @@
+"""
+Bounded per-generation log of node assignment changes.
+
+Every published snapshot records which nodes were added, removed or
+modified relative to the previous generation, together with their old
+values. That is enough to work out what a client holding generation G
+needs to change to reach the current generation without resending the
+whole peer list.
+
+Changes outside node_assignments that still change what peer lists render
+to (mesh_networks keepalive or port, the tunnel topology, the iBGP layout it
+is built from) are logged as resets: no delta can span them, so a client
+whose generation predates one gets the full listing.
+"""
+
+import threading
+from collections import deque
+
+# Generations kept before clients fall back to a full listing
+DEFAULT_MAX_GENERATIONS = 1024
+
+
+def diff_assignments(old, new):
+    """Map node_id -> old node dict (None if added) for nodes that differ"""
+    changes = {}
+    for node_id, node in new.items():
+        previous = old.get(node_id)
+        # Copy-on-write updates keep untouched node dicts identical
+        if previous is not node and previous != node:
+            changes[node_id] = previous
+    for node_id, previous in old.items():
+        if node_id not in new:
+            changes[node_id] = previous
+    return changes
+
+
+def diff_settings(old, new):
+    """Whether anything besides node_assignments that peer lists are rendered from differs"""
+    def settings(config):
+        wg_config = config["wireguard_config"]
+        return ({key: value for key, value in wg_config.items() if key != "node_assignments"},
+                config["bgp_config"].get("ibgp"))
+    return settings(old) != settings(new)
+
+
+class ChangeLog:
+    """Changed nodes per generation step, for the last max_generations steps.
+
+    A step normally advances the generation by one, but a process that
+    shares generations with other workers may observe a jump (5 -> 8); the
+    generations skipped inside a jump cannot be used as a delta base.
+    """
+
+    def __init__(self, max_generations=DEFAULT_MAX_GENERATIONS):
+        self._entries = deque(maxlen=max_generations)
+        self._lock = threading.Lock()
+
+    def record(self, from_generation, to_generation, changes, reset=False):
+        """Log one step; reset marks a change deltas cannot express"""
+        with self._lock:
+            self._entries.append((from_generation, to_generation, changes, reset))
+
+    def changes_since(self, generation):
+        """Map node_id -> node dict as of generation, for nodes changed after it.
+
+        Returns None when generation is outside the retained history or a
+        reset was logged after it.
+        """
+        with self._lock:
+            entries = list(self._entries)
+        state_at = None
+        for from_generation, to_generation, changes, reset in entries:
+            if state_at is None:
+                if from_generation == generation:
+                    state_at = {}
+                elif to_generation <= generation:
+                    continue
+                else:
+                    return None
+            if reset:
+                return None
+            for node_id, previous in changes.items():
+                # The earliest recorded old value is the value at `generation`
+                state_at.setdefault(node_id, previous)
+        return state_at
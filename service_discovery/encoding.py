@@ -0,0 +1,74 @@
+"""
+Response serialization and content encoding for the service discovery API.
+
+JSON is encoded with orjson when it is installed (several times faster than
+the stdlib encoder, same compact sorted-key output for ASCII data) and with
+the stdlib json module otherwise. Cached bodies are compressed at most once
+per config generation and content coding (gzip, and brotli when the brotli
+module is installed); each request then only picks a variant from its
+Accept-Encoding header.
+"""
+
+import gzip
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are always sent uncompressed
+MIN_COMPRESS_SIZE = 512
+
+# Content codings offered, in order of preference
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+if orjson is not None:
+    # Datetimes are passed through (and so rejected) to keep Flask's HTTP-date format
+    _ORJSON_COMPACT = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def dumps_json(payload):
+    """Serialize payload as compact, sorted-key JSON bytes with a trailing newline"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload, option=_ORJSON_COMPACT | orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            # Types orjson does not handle fall back to the stdlib encoder
+            pass
+    return (json.dumps(payload, separators=(",", ":"), sort_keys=True) + "\n").encode()
+
+
+# The first request for a coding after each config change compresses on the
+# request path. gzip 6 and brotli 5 come close to the ratio of gzip 9 and
+# brotli 11 in much less time; brotli 11 is slower by an order of magnitude.
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def compress(body, coding):
+    if coding == "gzip":
+        # mtime=0 keeps the output (and so its ETag) stable across workers
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    if coding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    raise ValueError(f"unsupported content coding {coding}")
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that uses orjson for compact jsonify() output"""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and kwargs.get("indent") is None:
+            try:
+                return orjson.dumps(obj, option=_ORJSON_COMPACT).decode()
+            except TypeError:
+                pass
+        return super().dumps(obj, **kwargs)
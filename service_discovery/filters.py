@@ -0,0 +1,213 @@
+"""
+Route filter compiler for bgp_config.route_filters.
+
+A route filter is an ordered list of rules, each matching one or more
+prefixes (optionally with a "ge"/"le" prefix-length range) and deciding
+accept or reject; the first matching rule wins, a "default" rule decides
+everything no earlier rule matched, and without one the rest is rejected.
+
+Instead of one `if net = ... then ...;` line per prefix, which BIRD tests
+one after another for every route, consecutive rules with the same action
+are compiled into one `prefix set` per address family, named by a `define`
+and matched with `net ~ SET`. BIRD matches a prefix set with a trie, so a
+filter costs one test per change of action, however many prefixes the
+lists grow to:
+
+    define IBGP_IMPORT_V4_1 = [ 0.0.0.0/0 ];
+    define IBGP_IMPORT_V4_2 = [
+      192.30.120.0/23,
+      198.51.100.0/22{24,28}
+    ];
+
+    filter ibgp_import {
+      if net.type = NET_IP4 then {
+        if net ~ IBGP_IMPORT_V4_1 then reject;
+        if net ~ IBGP_IMPORT_V4_2 then accept;
+      }
+      ...
+      reject;
+    }
+
+Rules of different families can never match the same route, so splitting
+them by family keeps first-match order. Within a set, entries with the same
+length range are aggregated (see aggregate.py): a range never matches a
+route shorter than the prefix it is attached to, so merging two sibling
+prefixes into their parent with the same range matches exactly the same
+routes, e.g. 192.0.2.0/25 and 192.0.2.128/25 become 192.0.2.0/24{25,25}. rule_action() evaluates the rules
+one by one as written and CompiledFilter.action() evaluates the compiled
+sets, so the two can be checked against each other.
+"""
+
+import ipaddress
+import re
+from collections import namedtuple
+
+from .aggregate import aggregate_networks, aggregation_counts
+
+ACTIONS = ("accept", "reject")
+
+# Rule prefix that stands for every route no earlier rule matched
+DEFAULT_PREFIX = "default"
+
+# Action for routes no rule matched, when there is no "default" rule
+DEFAULT_ACTION = "reject"
+
+# BIRD net.type and define-name suffix per IP version
+FAMILIES = {4: ("NET_IP4", "V4"), 6: ("NET_IP6", "V6")}
+
+# Filter names become BIRD symbols, and their define names are derived from them
+FILTER_NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+class PrefixPattern(namedtuple("PrefixPattern", ["network", "min_length", "max_length"])):
+    """A prefix and the lengths of the routes inside it that it matches"""
+
+    __slots__ = ()
+
+    def matches(self, net):
+        return (net.version == self.network.version
+                and self.min_length <= net.prefixlen <= self.max_length
+                and net.subnet_of(self.network))
+
+    def bird(self):
+        """BIRD prefix-set entry, as in 192.0.2.0/24, 192.0.2.0/24+ or 192.0.2.0/24{25,28}"""
+        length = self.network.prefixlen
+        if self.min_length == self.max_length == length:
+            return str(self.network)
+        if self.min_length == length and self.max_length == self.network.max_prefixlen:
+            return f"{self.network}+"
+        return f"{self.network}{{{self.min_length},{self.max_length}}}"
+
+
+def rule_patterns(rule):
+    """The prefix patterns a rule matches; raises ValueError if it is malformed"""
+    if rule.get("action") not in ACTIONS:
+        raise ValueError(f"action must be one of {', '.join(ACTIONS)}")
+    if ("prefix" in rule) == ("prefixes" in rule):
+        raise ValueError("a rule needs exactly one of prefix and prefixes")
+    prefixes = [rule["prefix"]] if "prefix" in rule else rule["prefixes"]
+    patterns = []
+    for prefix in prefixes:
+        network = ipaddress.ip_network(prefix, strict=False)
+        length = network.prefixlen
+        min_length = rule.get("ge", length)
+        max_length = rule.get("le", network.max_prefixlen if "ge" in rule else length)
+        if not length <= min_length <= max_length <= network.max_prefixlen:
+            raise ValueError(f"{prefix}: lengths must satisfy {length} <= ge <= le <= {network.max_prefixlen}")
+        patterns.append(PrefixPattern(network, min_length, max_length))
+    return patterns
+
+
+def rule_action(route_filter, net):
+    """Decide a route by trying the rules one at a time, in order"""
+    net = ipaddress.ip_network(net)
+    for rule in route_filter["rules"]:
+        if rule.get("prefix") == DEFAULT_PREFIX:
+            return rule["action"]
+        if any(pattern.matches(net) for pattern in rule_patterns(rule)):
+            return rule["action"]
+    return DEFAULT_ACTION
+
+
+def aggregate_patterns(patterns):
+    """Fewest patterns matching exactly the routes patterns match"""
+    by_range = {}
+    for pattern in patterns:
+        by_range.setdefault((pattern.min_length, pattern.max_length), []).append(pattern.network)
+    return [PrefixPattern(network, min_length, max_length)
+            for (min_length, max_length), networks in by_range.items()
+            for network in aggregate_networks(networks)]
+
+
+class CompiledFilter:
+    """A route filter compiled to prefix sets.
+
+    sets maps IP version to [(define name, [PrefixPattern], action)] in
+    evaluation order. prefix_counts gives the prefixes listed in the rules
+    and the prefix-set entries they were aggregated into.
+    """
+
+    def __init__(self, name, description, sets, default, prefixes=0):
+        self.name = name
+        self.description = description
+        self.sets = sets
+        self.default = default
+        entries = sum(len(patterns) for prefix_sets in sets.values() for _, patterns, _ in prefix_sets)
+        self.prefix_counts = aggregation_counts(prefixes, entries)
+
+    def action(self, net):
+        """Decide a route the way the compiled BIRD filter does"""
+        net = ipaddress.ip_network(net)
+        for _, patterns, action in self.sets.get(net.version, ()):
+            if any(pattern.matches(net) for pattern in patterns):
+                return action
+        return self.default
+
+    def render(self):
+        """The defines and filter block, as BIRD config text"""
+        lines = []
+        for prefix_sets in self.sets.values():
+            for symbol, patterns, _ in prefix_sets:
+                entries = [pattern.bird() for pattern in patterns]
+                if len(entries) == 1:
+                    lines.append(f"define {symbol} = [ {', '.join(entries)} ];")
+                else:
+                    lines.append(f"define {symbol} = [")
+                    lines.append(",\n".join(f"  {entry}" for entry in entries))
+                    lines.append("];")
+        lines.append("")
+        lines.append(f"filter {self.name} {{")
+        if self.description:
+            lines.append(f"  # {self.description}")
+        for version, prefix_sets in self.sets.items():
+            lines.append(f"  if net.type = {FAMILIES[version][0]} then {{")
+            for symbol, _, action in prefix_sets:
+                lines.append(f"    if net ~ {symbol} then {action};")
+            lines.append("  }")
+        lines.append(f"  {self.default};")
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+
+def compile_route_filter(name, route_filter):
+    """Compile one route_filters entry; raises ValueError naming the bad rule"""
+    if not FILTER_NAME.fullmatch(name):
+        raise ValueError(f"filter {name}: name is not a valid BIRD symbol")
+    runs = {4: [], 6: []}
+    default = DEFAULT_ACTION
+    prefixes = 0
+    for position, rule in enumerate(route_filter["rules"]):
+        if rule.get("prefix") == DEFAULT_PREFIX:
+            if rule.get("action") not in ACTIONS:
+                raise ValueError(f"filter {name} rule {position}: action must be one of {', '.join(ACTIONS)}")
+            # Later rules can never match
+            default = rule["action"]
+            break
+        try:
+            patterns = rule_patterns(rule)
+        except ValueError as e:
+            raise ValueError(f"filter {name} rule {position}: {e}") from None
+        prefixes += len(patterns)
+        for pattern in patterns:
+            family_runs = runs[pattern.network.version]
+            if not family_runs or family_runs[-1][1] != rule["action"]:
+                family_runs.append(([], rule["action"]))
+            family_runs[-1][0].append(pattern)
+
+    sets = {}
+    for version, family_runs in runs.items():
+        if family_runs:
+            suffix = FAMILIES[version][1]
+            sets[version] = [(f"{name.upper()}_{suffix}_{i}", aggregate_patterns(patterns), action)
+                             for i, (patterns, action) in enumerate(family_runs, 1)]
+    return CompiledFilter(name, route_filter.get("description"), sets, default, prefixes)
+
+
+def compile_route_filters(route_filters):
+    """Compile every route_filters entry, in order"""
+    return [compile_route_filter(name, route_filter) for name, route_filter in route_filters.items()]
+
+
+def render_route_filters(compiled_filters):
+    """BIRD config text for compiled route filters"""
+    return "".join("\n" + compiled.render() for compiled in compiled_filters)
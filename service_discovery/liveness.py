@@ -0,0 +1,251 @@
+"""
+Node liveness tracking for POST /api/v1/nodes/<node_id>/heartbeat.
+
+Heartbeats only touch memory: a dict of last-seen times and a hashed timer
+wheel holding each node's expiry. Recording a heartbeat is O(1) (update the
+dict, move the node to its new wheel slot). Expiry is driven by advancing
+the wheel, which only visits the slots for elapsed ticks and the nodes
+actually due in them, so no request ever scans every node.
+
+Worker processes each keep their own table, but every heartbeat is also
+stamped into a small mmap'd hash table shared by all workers. When a node
+comes due in one worker's wheel, that worker checks the shared stamp before
+declaring the node stale, so heartbeats answered by any worker count.
+"""
+
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Seconds without a heartbeat before a node is reported stale
+HEARTBEAT_TTL = 90
+
+# Timer wheel resolution in seconds
+WHEEL_TICK = 1.0
+
+# How often stale nodes are re-checked against heartbeats seen by other workers
+STALE_RECHECK = 10
+
+# Smallest shared table; it is sized to twice the mesh when that is larger
+SHARED_CAPACITY = 4096
+
+log = logging.getLogger(__name__)
+
+
+class TimerWheel:
+    """Hashed timer wheel with O(1) schedule and cancel.
+
+    Deadlines are rounded up to whole ticks. A key whose deadline is more
+    than one revolution away stays in its slot and is skipped until the
+    wheel comes round to its tick.
+    """
+
+    def __init__(self, tick, slots, now):
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._due = {}
+        self._current = self._tick_of(now)
+
+    def _tick_of(self, when):
+        return int(when // self.tick)
+
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        due = max(self._tick_of(deadline) + 1, self._current + 1)
+        self._due[key] = due
+        self._slots[due % len(self._slots)].add(key)
+
+    def cancel(self, key):
+        due = self._due.pop(key, None)
+        if due is not None:
+            self._slots[due % len(self._slots)].discard(key)
+
+    def advance(self, now):
+        """Move the wheel to now and return the keys that came due"""
+        target = self._tick_of(now)
+        steps = min(target - self._current, len(self._slots))
+        expired = []
+        for step in range(1, steps + 1):
+            slot = self._slots[(self._current + step) % len(self._slots)]
+            for key in [key for key in slot if self._due[key] <= target]:
+                slot.discard(key)
+                del self._due[key]
+                expired.append(key)
+        self._current = max(self._current, target)
+        return expired
+
+    def __len__(self):
+        return len(self._due)
+
+
+class SharedHeartbeats:
+    """Last-heartbeat times shared between processes through an mmap'd file.
+
+    Fixed-size open-addressing table of 64-byte records (56-byte node id,
+    8-byte timestamp). Claiming a record for a new node takes an flock;
+    stamping a heartbeat afterwards is a single 8-byte write. Once every
+    record is claimed, heartbeats from further nodes are only seen by the
+    worker that took them; each one is counted in overflows and the first
+    is logged.
+    """
+
+    RECORD = struct.Struct("56sd")
+
+    def __init__(self, path, capacity=SHARED_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.overflows = 0
+        size = self.RECORD.size * capacity
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size != size:
+                # Left by a run with another capacity: its records hash to
+                # other slots, so start empty
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._offsets = {}
+
+    def _probe(self, key):
+        """Offset of key's record, or of the first free one on its probe path, and what it holds"""
+        start = zlib.crc32(key) % self.capacity
+        for probe in range(self.capacity):
+            offset = ((start + probe) % self.capacity) * self.RECORD.size
+            stored = self._mm[offset:offset + 56].rstrip(b"\0")
+            if not stored or stored == key:
+                return offset, stored
+        return None, None
+
+    def _find(self, node_id, claim):
+        offset = self._offsets.get(node_id)
+        if offset is not None:
+            return offset
+        key = node_id.encode()[:56]
+        offset, stored = self._probe(key)
+        if offset is None or not stored and not claim:
+            return None
+        if not stored:
+            with open(self.path, "rb") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # Another process may have claimed the free record since we
+                # looked, so probe again under the lock and claim what it finds
+                offset, stored = self._probe(key)
+                if offset is None:
+                    return None
+                if not stored:
+                    self.RECORD.pack_into(self._mm, offset, key, 0.0)
+        self._offsets[node_id] = offset
+        return offset
+
+    def stamp(self, node_id, when):
+        offset = self._find(node_id, claim=True)
+        if offset is None:
+            if not self.overflows:
+                log.warning("%s: all %d records are taken; heartbeats from %s and any further "
+                            "nodes are not shared between workers", self.path, self.capacity, node_id)
+            self.overflows += 1
+            return
+        struct.pack_into("d", self._mm, offset + 56, when)
+
+    def last_seen(self, node_id):
+        offset = self._find(node_id, claim=False)
+        if offset is None:
+            return None
+        when = struct.unpack_from("d", self._mm, offset + 56)[0]
+        return when or None
+
+
+class LivenessTable:
+    """Live/stale state per node, maintained incrementally by heartbeats and a timer wheel"""
+
+    def __init__(self, ttl=HEARTBEAT_TTL, tick=WHEEL_TICK, shared=None, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.shared = shared
+        self._wheel = TimerWheel(tick, int(ttl / tick) + 2, clock())
+        self._lock = threading.Lock()
+        self.last_seen = {}
+        self.live = set()
+        self.stale = set()
+
+    def enable_sharing(self, path, node_count=0):
+        """Share last-heartbeat times with other worker processes via path.
+
+        Called once in the gunicorn master before forking. The table holds
+        twice as many records as the mesh has nodes (at least
+        SHARED_CAPACITY), which keeps probes short and leaves room to grow.
+        """
+        self.shared = SharedHeartbeats(path, max(SHARED_CAPACITY, 2 * node_count))
+
+    def heartbeat(self, node_id):
+        """Record a heartbeat from node_id (O(1))"""
+        now = self.clock()
+        with self._lock:
+            self._mark_live(node_id, now)
+        if self.shared is not None:
+            self.shared.stamp(node_id, now)
+        return now
+
+    def _mark_live(self, node_id, seen):
+        self.last_seen[node_id] = seen
+        self.live.add(node_id)
+        self.stale.discard(node_id)
+        self._wheel.schedule(node_id, seen + self.ttl)
+
+    def _mark_stale(self, node_id, now):
+        self.live.discard(node_id)
+        self.stale.add(node_id)
+        self._wheel.schedule(node_id, now + STALE_RECHECK)
+
+    def _check(self, node_id, now):
+        seen = self.last_seen.get(node_id)
+        if self.shared is not None:
+            shared_seen = self.shared.last_seen(node_id)
+            if shared_seen and (seen is None or shared_seen > seen):
+                seen = shared_seen
+        if seen is not None and seen + self.ttl > now:
+            self._mark_live(node_id, seen)
+        else:
+            if seen is not None:
+                self.last_seen[node_id] = seen
+            self._mark_stale(node_id, now)
+
+    def refresh(self, node_ids=()):
+        """Expire due nodes and start tracking any of node_ids not seen yet"""
+        now = self.clock()
+        with self._lock:
+            for node_id in self._wheel.advance(now):
+                self._check(node_id, now)
+            for node_id in node_ids:
+                if node_id not in self.live and node_id not in self.stale:
+                    self._check(node_id, now)
+
+    def forget(self, node_id):
+        """Stop tracking a node that was removed from the mesh"""
+        with self._lock:
+            self._wheel.cancel(node_id)
+            self.last_seen.pop(node_id, None)
+            self.live.discard(node_id)
+            self.stale.discard(node_id)
+
+    def retain(self, node_ids):
+        """Forget every tracked node not in node_ids, e.g. ones another worker deregistered"""
+        keep = set(node_ids)
+        with self._lock:
+            gone = [node_id for node_id in self.live | self.stale if node_id not in keep]
+        for node_id in gone:
+            self.forget(node_id)
+
+    def report(self, node_ids):
+        """Split node_ids into (live, stale) lists, preserving order"""
+        self.refresh(node_ids)
+        live = [node_id for node_id in node_ids if node_id in self.live]
+        stale = [node_id for node_id in node_ids if node_id not in self.live]
+        return live, stale
@@ -0,0 +1,217 @@
+"""
+Prometheus metrics for the service discovery API.
+
+Counters and histograms are kept in per-thread shards (keyed by the OS
+thread id, so gevent greenlets on one thread share a shard and never race),
+which means recording a request takes no lock. Each series is a plain list
+created the first time a route or label is seen; after that an observation
+is a couple of dict lookups and in-place increments, with no label dicts or
+tuples built per request. Shards are summed only when /metrics is scraped.
+
+Under `serve` every gunicorn worker keeps its own shards and periodically
+writes their totals to <dir>/<pid>.metrics; a scrape answered by any worker
+adds up every worker's file, so counters stay monotonic across workers.
+"""
+
+import bisect
+import marshal
+import os
+import tempfile
+import threading
+import time
+
+# Latency histogram bucket bounds, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Seconds between a worker's writes of its totals to the shared directory
+FLUSH_INTERVAL = 1.0
+
+# name -> (help, label name or None)
+HISTOGRAMS = {
+    "sd_http_request_duration_seconds": ("Request latency by route", "route"),
+    "sd_config_reload_duration_seconds": ("Time to load and publish a config generation", "source"),
+    "sd_registration_persist_duration_seconds": ("Time to append and fsync a registration journal entry", None),
+}
+
+REQUESTS_TOTAL = "sd_http_requests_total"
+REQUESTS_HELP = "Requests handled, by route and status code"
+
+
+class _Shard:
+    __slots__ = ("requests", "histograms")
+
+    def __init__(self):
+        # route -> {status code: count}
+        self.requests = {}
+        # histogram name -> label value -> [bucket counts..., +Inf count, sum]
+        self.histograms = {name: {} for name in HISTOGRAMS}
+
+
+class Metrics:
+    """Per-thread request counters and latency histograms"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._shards = {}
+        self._lock = threading.Lock()
+        # name -> callable returning a number, read at scrape time
+        self._counters = {}
+        self.shared_dir = None
+        self._last_flush = 0.0
+
+    def _shard(self):
+        thread_id = threading.get_native_id()
+        shard = self._shards.get(thread_id)
+        if shard is None:
+            with self._lock:
+                shard = self._shards.setdefault(thread_id, _Shard())
+        return shard
+
+    def observe_request(self, route, status, seconds):
+        shard = self._shard()
+        codes = shard.requests.get(route)
+        if codes is None:
+            codes = shard.requests[route] = {}
+        codes[status] = codes.get(status, 0) + 1
+        self._observe(shard, "sd_http_request_duration_seconds", route, seconds)
+
+    def observe(self, name, seconds, label=""):
+        self._observe(self._shard(), name, label, seconds)
+
+    def _observe(self, shard, name, label, seconds):
+        series = shard.histograms[name].get(label)
+        if series is None:
+            series = shard.histograms[name][label] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, seconds)] += 1
+        series[-1] += seconds
+
+    def counter(self, name, help_text, read):
+        """Export a counter maintained elsewhere; read() is called on scrape"""
+        self._counters[name] = (help_text, read)
+
+    def totals(self):
+        """Sum all shards into plain dicts (also the on-disk format)"""
+        requests = {}
+        histograms = {name: {} for name in HISTOGRAMS}
+        for shard in list(self._shards.values()):
+            _merge_requests(requests, shard.requests)
+            _merge_histograms(histograms, shard.histograms)
+        counters = {name: read() for name, (_, read) in self._counters.items()}
+        return {"requests": requests, "histograms": histograms, "counters": counters}
+
+    def enable_sharing(self, directory):
+        """Aggregate across worker processes via files in directory.
+
+        Called once in the gunicorn master before forking; leftover files
+        from a previous run are removed.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".metrics"):
+                os.unlink(os.path.join(directory, name))
+        self.shared_dir = directory
+
+    def maybe_flush(self):
+        """Write this worker's totals if FLUSH_INTERVAL has passed (cheap no-op otherwise)"""
+        if self.shared_dir is None:
+            return
+        now = time.monotonic()
+        if now - self._last_flush < FLUSH_INTERVAL:
+            return
+        self._last_flush = now
+        self._write(self.totals())
+
+    def _write(self, totals):
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=self.shared_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                marshal.dump(totals, f)
+            os.replace(tmp_path, os.path.join(self.shared_dir, f"{os.getpid()}.metrics"))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def collect(self):
+        """Totals for this process plus every other worker's last flush"""
+        totals = self.totals()
+        if self.shared_dir is None:
+            return totals
+        self._write(totals)
+        own = f"{os.getpid()}.metrics"
+        for name in os.listdir(self.shared_dir):
+            if not name.endswith(".metrics") or name == own:
+                continue
+            try:
+                with open(os.path.join(self.shared_dir, name), "rb") as f:
+                    other = marshal.load(f)
+            except (OSError, EOFError, ValueError):
+                continue
+            _merge_requests(totals["requests"], other["requests"])
+            _merge_histograms(totals["histograms"], other["histograms"])
+            for counter, value in other["counters"].items():
+                totals["counters"][counter] = totals["counters"].get(counter, 0) + value
+        return totals
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+        totals = self.collect()
+        lines = [f"# HELP {REQUESTS_TOTAL} {REQUESTS_HELP}", f"# TYPE {REQUESTS_TOTAL} counter"]
+        for route, codes in sorted(totals["requests"].items()):
+            for code, count in sorted(codes.items()):
+                lines.append(f'{REQUESTS_TOTAL}{{route="{_escape(route)}",code="{code}"}} {count}')
+
+        for name, (help_text, label_name) in HISTOGRAMS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for label, series in sorted(totals["histograms"][name].items()):
+                label_prefix = f'{label_name}="{_escape(label)}",' if label_name else ""
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{label_prefix}le="{bound}"}} {cumulative}')
+                cumulative += series[len(self.buckets)]
+                lines.append(f'{name}_bucket{{{label_prefix}le="+Inf"}} {cumulative}')
+                suffix = f"{{{label_prefix[:-1]}}}" if label_prefix else ""
+                lines.append(f"{name}_sum{suffix} {series[-1]}")
+                lines.append(f"{name}_count{suffix} {cumulative}")
+
+        for name, (help_text, _) in self._counters.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {totals['counters'].get(name, 0)}")
+        return "\n".join(lines) + "\n"
+
+
+def _items(mapping):
+    """Copy of a shard dict's items while its thread may be adding to it"""
+    while True:
+        try:
+            return list(mapping.items())
+        except RuntimeError:
+            # Even the copy can be interrupted (a GC pass runs other threads)
+            # and see the dict resized; recording never removes keys, so retry
+            continue
+
+
+def _merge_requests(into, requests):
+    for route, codes in _items(requests):
+        merged = into.setdefault(route, {})
+        for code, count in _items(codes):
+            merged[code] = merged.get(code, 0) + count
+
+
+def _merge_histograms(into, histograms):
+    for name, series_by_label in _items(histograms):
+        merged = into.setdefault(name, {})
+        for label, series in _items(series_by_label):
+            total = merged.get(label)
+            if total is None:
+                merged[label] = list(series)
+            else:
+                for i, value in enumerate(series):
+                    total[i] += value
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,220 @@
+"""
+Opt-in per-request profiling for the service discovery API.
+
+Disabled unless SD_PROFILE_DIR is set; the API then wraps its WSGI app in
+ProfilingMiddleware, so when profiling is off no hook is installed at all.
+When it is on, a request is profiled if it carries an X-SD-Profile header
+(equal to SD_PROFILE_TOKEN when one is set) or is picked at random with
+probability SD_PROFILE_SAMPLE_RATE:
+
+    SD_PROFILE_DIR          directory holding the profile ring
+    SD_PROFILE_FORMAT       pstats (cProfile, open with `python -m pstats`) or
+                            collapsed (sampled stacks, one "a;b;c count" line
+                            each, for flamegraph.pl / speedscope)       (pstats)
+    SD_PROFILE_SAMPLE_RATE  fraction of requests profiled without a header (0)
+    SD_PROFILE_TOKEN        required X-SD-Profile value                 (unset)
+    SD_PROFILE_KEEP         profiles kept; older ones are deleted       (100)
+    SD_PROFILE_INTERVAL     collapsed-stack sampling interval, seconds  (0.001)
+
+Profiles are written as <unix ns>-<pid>-<method>-<path>.prof / .folded, and
+the name is returned in the X-SD-Profile-File response header. The ring is
+shared by every worker writing to the directory.
+"""
+
+import cProfile
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+PROFILE_HEADER = "HTTP_X_SD_PROFILE"
+PROFILE_FILE_HEADER = "X-SD-Profile-File"
+
+FORMATS = {"pstats": ".prof", "collapsed": ".folded"}
+
+# Profiles kept in the ring by default
+DEFAULT_KEEP = 100
+
+# Seconds between stack samples in collapsed format
+DEFAULT_INTERVAL = 0.001
+
+
+class ProfileRing:
+    """Bounded directory of profile files, oldest deleted first"""
+
+    def __init__(self, directory, keep=DEFAULT_KEEP):
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+    def name_for(self, method, path, suffix):
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", path).strip("_")[:80] or "root"
+        return f"{time.time_ns()}-{os.getpid()}-{method}-{slug}{suffix}"
+
+    def write(self, name, dump):
+        """Write a profile atomically via dump(path), then trim the ring"""
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=self.directory)
+        os.close(fd)
+        try:
+            dump(tmp_path)
+            os.replace(tmp_path, os.path.join(self.directory, name))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.trim()
+
+    def profiles(self):
+        """Profile file names, oldest first (names start with a timestamp)"""
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith(tuple(FORMATS.values())))
+
+    def trim(self):
+        names = self.profiles()
+        for name in names[:max(0, len(names) - self.keep)]:
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                # Another worker trimmed it first
+                pass
+
+
+class StackSampler:
+    """Samples one thread's Python stack on a timer and counts collapsed stacks"""
+
+    def __init__(self, thread_id, interval=DEFAULT_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sd-profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class ProfilingMiddleware:
+    """WSGI middleware that profiles selected requests into a ProfileRing"""
+
+    def __init__(self, app, ring, fmt="pstats", sample_rate=0.0, token=None,
+                 interval=DEFAULT_INTERVAL):
+        if fmt not in FORMATS:
+            raise ValueError(f"unknown profile format {fmt}")
+        self.app = app
+        self.ring = ring
+        self.format = fmt
+        self.sample_rate = sample_rate
+        self.token = token
+        self.interval = interval
+
+    @classmethod
+    def from_environment(cls, app):
+        """Middleware configured from SD_PROFILE_*, or None if SD_PROFILE_DIR is unset"""
+        directory = os.environ.get("SD_PROFILE_DIR")
+        if not directory:
+            return None
+        ring = ProfileRing(directory, int(os.environ.get("SD_PROFILE_KEEP", DEFAULT_KEEP)))
+        return cls(app, ring,
+                   fmt=os.environ.get("SD_PROFILE_FORMAT", "pstats"),
+                   sample_rate=float(os.environ.get("SD_PROFILE_SAMPLE_RATE", 0)),
+                   token=os.environ.get("SD_PROFILE_TOKEN") or None,
+                   interval=float(os.environ.get("SD_PROFILE_INTERVAL", DEFAULT_INTERVAL)))
+
+    def selected(self, environ):
+        requested = environ.get(PROFILE_HEADER)
+        if requested:
+            return self.token is None or requested == self.token
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, environ, start_response):
+        if not self.selected(environ):
+            return self.app(environ, start_response)
+
+        name = self.ring.name_for(environ.get("REQUEST_METHOD", "GET"),
+                                  environ.get("PATH_INFO", ""), FORMATS[self.format])
+
+        def start_profiled_response(status, headers, exc_info=None):
+            return start_response(status, headers + [(PROFILE_FILE_HEADER, name)], exc_info)
+
+        if self.format == "pstats":
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is active on this interpreter (Python 3.12+)
+                return self.app(environ, start_response)
+            pause, resume, stop = profiler.disable, profiler.enable, profiler.disable
+            dump = profiler.dump_stats
+        else:
+            sampler = StackSampler(threading.get_ident(), self.interval)
+            sampler.start()
+            pause = resume = lambda: None
+            stop, dump = sampler.stop, sampler.dump
+
+        def finish():
+            stop()
+            self.ring.write(name, dump)
+
+        try:
+            result = self.app(environ, start_profiled_response)
+        except BaseException:
+            finish()
+            raise
+        pause()
+        return _ProfiledBody(result, resume, pause, finish)
+
+
+class _ProfiledBody:
+    """Response iterable that keeps profiling while a streamed body is rendered.
+
+    The profile is written on close(), which the WSGI server calls even if
+    the body was never iterated.
+    """
+
+    def __init__(self, result, resume, pause, finish):
+        self._result = result
+        self._resume = resume
+        self._pause = pause
+        self._finish = finish
+
+    def __iter__(self):
+        iterator = iter(self._result)
+        while True:
+            self._resume()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._pause()
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self._result, "close"):
+                self._result.close()
+        finally:
+            self._finish()
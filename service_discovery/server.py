@@ -0,0 +1,104 @@
+"""
+Production serving mode for the service discovery API.
+
+`python3 service-discovery-api.py serve` runs the app under gunicorn instead
+of the single-process Werkzeug development server. Settings come from the
+environment:
+
+    SD_BIND              address to listen on            (0.0.0.0:5000)
+    SD_WORKERS           worker processes                (2 x CPUs + 1)
+    SD_THREADS           threads per worker (gthread)    (8)
+    SD_WORKER_CLASS      gthread, or gevent for many idle /watch long-polls
+                         (patched in by service-discovery-api.py before any
+                         locks are created)
+    SD_TIMEOUT           seconds before a silent worker is killed and restarted (30)
+    SD_GRACEFUL_TIMEOUT  seconds in-flight requests get on reload/stop   (30)
+    SD_KEEPALIVE         keep-alive seconds between requests             (5)
+    SD_MAX_REQUESTS      recycle a worker after this many requests       (0, never)
+    SD_MAX_WATCHERS      /watch long-polls waiting at once per worker    (see max_watchers)
+
+Send SIGHUP to the master for a graceful reload: workers are replaced and
+the old ones finish in-flight requests first. Config changes never need a
+reload (they are picked up from disk); code changes need a full restart
+because the app is preloaded in the master.
+
+The app is loaded once in the master (preload) and the loaded objects are
+moved out of the garbage collector's reach with gc.freeze(), so forked
+workers start out sharing the initial parsed snapshot copy-on-write. The
+first change each worker adopts is unmarshalled from the snapshot file
+written by SharedSnapshotStore into a private copy, so from then on every
+worker holds its own parsed config.
+"""
+
+import gc
+import multiprocessing
+import os
+import sys
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def gunicorn_options():
+    """Build gunicorn settings from SD_* environment variables"""
+    worker_class = os.environ.get("SD_WORKER_CLASS", "gthread")
+    options = {
+        "bind": os.environ.get("SD_BIND", "0.0.0.0:5000"),
+        "workers": _env_int("SD_WORKERS", multiprocessing.cpu_count() * 2 + 1),
+        "worker_class": worker_class,
+        "timeout": _env_int("SD_TIMEOUT", 30),
+        "graceful_timeout": _env_int("SD_GRACEFUL_TIMEOUT", 30),
+        "keepalive": _env_int("SD_KEEPALIVE", 5),
+        "max_requests": _env_int("SD_MAX_REQUESTS", 0),
+        "max_requests_jitter": _env_int("SD_MAX_REQUESTS", 0) // 10,
+        "preload_app": True,
+        "pre_fork": _pre_fork,
+        "accesslog": "-",
+    }
+    if worker_class == "gthread":
+        options["threads"] = _env_int("SD_THREADS", 8)
+    elif worker_class == "gevent":
+        options["worker_connections"] = _env_int("SD_WORKER_CONNECTIONS", 1000)
+    return options
+
+
+def max_watchers():
+    """How many /watch long-polls one worker lets wait at once.
+
+    Under gthread (and the threaded development server) every waiting
+    watcher holds a thread for its whole timeout, so only half of
+    SD_THREADS may wait and the rest stay free for other requests. gevent
+    watchers are greenlets, so most of SD_WORKER_CONNECTIONS may wait.
+    """
+    if "SD_MAX_WATCHERS" in os.environ:
+        return max(1, _env_int("SD_MAX_WATCHERS", 1))
+    if os.environ.get("SD_WORKER_CLASS", "gthread") == "gevent":
+        return max(1, _env_int("SD_WORKER_CONNECTIONS", 1000) * 9 // 10)
+    return max(1, _env_int("SD_THREADS", 8) // 2)
+
+
+def _pre_fork(server, worker):
+    # Keep the GC from touching (and so copying) the master's pages in workers
+    gc.freeze()
+
+
+def serve(app, warm=None):
+    """Run app under gunicorn; warm() is called once in the master before forking"""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        print("gunicorn is not installed: pip3 install gunicorn (and gevent for SD_WORKER_CLASS=gevent)")
+        sys.exit(1)
+
+    class DiscoveryApplication(BaseApplication):
+        def load_config(self):
+            for key, value in gunicorn_options().items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            if warm is not None:
+                warm()
+            return app
+
+    DiscoveryApplication().run()
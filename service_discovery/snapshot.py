@@ -0,0 +1,193 @@
+"""
+Process-wide config snapshot for the service discovery API.
+
+The schema file is parsed once and shared by every request. It is only
+re-read when the file on disk changes (mtime/size/inode) or when a reload
+is requested explicitly. Each load bumps the generation number.
+"""
+
+import json
+import os
+import threading
+import time
+
+from .allocator import inherit_allocator
+from .changelog import ChangeLog, diff_assignments, diff_settings
+
+# How often a blocked watcher re-checks the file for changes made by
+# other processes (changes published in this process wake it immediately)
+WATCH_RECHECK_INTERVAL = 1.0
+
+# Endpoint IPs that mark a node slot as unclaimed and open for registration
+PLACEHOLDER_ENDPOINT_IPS = frozenset([
+    '45.76.21.14', '207.246.118.124', '45.77.206.132', '0.0.0.0'
+])
+
+
+def endpoint_ip(endpoint):
+    """Strip the port from a WireGuard "ip:port" endpoint"""
+    return endpoint.rsplit(":", 1)[0]
+
+
+class NodeIndex:
+    """Secondary indexes over wireguard_config.node_assignments.
+
+    Built once per snapshot so node lookups are dict hits instead of scans.
+    Where several nodes share a key, region and endpoint lookups return the
+    first node in assignment order, matching the old linear search.
+    """
+
+    __slots__ = ("by_region", "by_endpoint_ip", "by_mesh_ip", "by_provider", "by_role", "open_slots")
+
+    def __init__(self, node_assignments):
+        self.by_region = {}
+        self.by_endpoint_ip = {}
+        # Mesh ipv4/ipv6 address -> node_id
+        self.by_mesh_ip = {}
+        # provider/role -> [node_id], in assignment order
+        self.by_provider = {}
+        self.by_role = {}
+        self.open_slots = []
+        for node_id, node_config in node_assignments.items():
+            entry = (node_id, node_config)
+            ip = endpoint_ip(node_config["vultr_endpoint"])
+            self.by_region.setdefault(node_config["region"], entry)
+            self.by_endpoint_ip.setdefault(ip, entry)
+            self.by_mesh_ip.setdefault(node_config["ipv4"], node_id)
+            self.by_mesh_ip.setdefault(node_config["ipv6"], node_id)
+            self.by_provider.setdefault(node_config["provider"], []).append(node_id)
+            self.by_role.setdefault(node_config["role"], []).append(node_id)
+            if ip in PLACEHOLDER_ENDPOINT_IPS:
+                self.open_slots.append(node_id)
+
+
+class ConfigSnapshot:
+    """Parsed service discovery config at a single generation.
+
+    The config dict is shared between threads and must be treated as
+    read-only. Writers build a new dict and publish it as a new snapshot.
+    `memo` holds values derived from this generation (e.g. pre-rendered
+    config fragments) so they are computed once and dropped with it.
+    """
+
+    __slots__ = ("config", "generation", "loaded_at", "index", "memo")
+
+    def __init__(self, config, generation):
+        self.config = config
+        self.generation = generation
+        self.loaded_at = time.time()
+        self.index = NodeIndex(config["wireguard_config"]["node_assignments"])
+        self.memo = {}
+
+
+class SnapshotStore:
+    """Holds the current ConfigSnapshot and reloads it when the file changes"""
+
+    def __init__(self, config_file):
+        self.config_file = config_file
+        self._lock = threading.Lock()
+        self._published = threading.Condition(self._lock)
+        self._snapshot = None
+        self._signature = None
+        # Signature of the last file version that failed to load
+        self._rejected = None
+        self._generation = 0
+        self.changes = ChangeLog()
+        # Optional service_discovery.metrics.Metrics for load/persist timings
+        self.metrics = None
+        # Optional service_discovery.validation.ConfigValidator; configs that
+        # fail it are never published or written
+        self.validator = None
+
+    def _file_signature(self):
+        st = os.stat(self.config_file)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def current(self):
+        """Return the current snapshot, reloading if the file has changed"""
+        snapshot = self._snapshot
+        if snapshot is not None and self._file_signature() in (self._signature, self._rejected):
+            # Unchanged, or a version already found invalid: not re-read
+            # and re-validated on every request until it is edited again
+            return snapshot
+        try:
+            return self.reload()
+        except ValueError:
+            # File is mid-edit or malformed; keep serving the last good copy
+            if snapshot is None:
+                raise
+            return snapshot
+
+    def reload(self, force=False):
+        """Re-read the config file and publish it as a new generation"""
+        with self._lock:
+            signature = self._file_signature()
+            if not force and self._snapshot is not None and signature == self._signature:
+                # Another thread already picked up this version
+                return self._snapshot
+            started = time.perf_counter()
+            snapshot = self._publish(self._read_valid(signature), signature)
+            self._observe("sd_config_reload_duration_seconds", started, "file")
+            return snapshot
+
+    def _observe(self, name, started, label=""):
+        if self.metrics is not None:
+            self.metrics.observe(name, time.perf_counter() - started, label)
+
+    def _read(self):
+        with open(self.config_file, 'r') as f:
+            return json.load(f)
+
+    def _read_valid(self, signature):
+        """Read and validate the file version with signature, remembering a failure"""
+        try:
+            config = self._read()
+            self._validate(config)
+        except ValueError:
+            self._rejected = signature
+            raise
+        return config
+
+    def _validate(self, config):
+        """Raise ConfigValidationError (a ValueError) if config is invalid"""
+        if self.validator is not None:
+            self.validator.validate(config)
+
+    def wait_for_change(self, generation, timeout):
+        """Block until a generation newer than `generation` is published.
+
+        Returns the current snapshot, which is unchanged if timeout expired.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            snapshot = self.current()
+            remaining = deadline - time.monotonic()
+            if snapshot.generation != generation or remaining <= 0:
+                return snapshot
+            with self._published:
+                if self._snapshot.generation == generation:
+                    self._published.wait(min(remaining, WATCH_RECHECK_INTERVAL))
+
+    def save(self, config):
+        """Write config to disk and publish it without waiting for a reload"""
+        self._validate(config)
+        with self._lock:
+            with open(self.config_file, 'w') as f:
+                json.dump(config, f, indent=2)
+            return self._publish(config, self._file_signature())
+
+    def _publish(self, config, signature, generation=None):
+        previous_generation = self._generation
+        previous = self._snapshot
+        self._generation = generation or previous_generation + 1
+        self._snapshot = ConfigSnapshot(config, self._generation)
+        if previous is not None:
+            changes = diff_assignments(
+                previous.config["wireguard_config"]["node_assignments"],
+                config["wireguard_config"]["node_assignments"])
+            self.changes.record(previous_generation, self._generation, changes,
+                                diff_settings(previous.config, config))
+            inherit_allocator(previous, self._snapshot, changes)
+        self._signature = signature
+        self._published.notify_all()
+        return self._snapshot
@@ -0,0 +1,225 @@
+"""
+Crash-safe registration store for the service discovery config.
+
+Registrations no longer rewrite service-discovery-schema.json. Each
+transaction is appended as one JSON line to a journal next to it and
+fsync'd; loading replays the journal over the base file. Once the journal
+grows past a threshold it is compacted: the merged config is written to a
+temp file, fsync'd and renamed over the base file, then the journal is
+truncated. Writers serialize on an flock'd lock file, so several threads
+or worker processes can register concurrently without losing updates.
+
+Journal lines look like:
+    {"seq": 12, "ts": 1716508800.0, "nodes": {"ord": {"vultr_endpoint": "1.2.3.4:51820"}}}
+save() replaces the whole config, and first journals it as a checkpoint
+line that replay adopts as is, dropping everything before it:
+    {"seq": 13, "ts": 1716508900.0, "config": {...}}
+"""
+
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from .snapshot import SnapshotStore
+
+# Journal entries replayed on load before a compaction is triggered
+COMPACT_THRESHOLD = 256
+
+
+def apply_node_updates(config, nodes):
+    """Copy config with per-node field updates applied.
+
+    Only the dicts on the path to updated nodes are copied, so published
+    snapshots are never mutated. A node whose update is None is removed.
+    """
+    wg_config = dict(config["wireguard_config"])
+    assignments = dict(wg_config["node_assignments"])
+    for node_id, fields in nodes.items():
+        if fields is None:
+            assignments.pop(node_id, None)
+            continue
+        node = dict(assignments.get(node_id, {}))
+        node.update(fields)
+        assignments[node_id] = node
+    wg_config["node_assignments"] = assignments
+    updated = dict(config)
+    updated["wireguard_config"] = wg_config
+    return updated
+
+
+def write_json_atomic(path, data):
+    """Write JSON to path via fsync'd temp file and rename"""
+    path = os.fspath(path)
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class RegistrationStore(SnapshotStore):
+    """SnapshotStore whose writes go to an append-only journal"""
+
+    def __init__(self, config_file, compact_threshold=COMPACT_THRESHOLD):
+        super().__init__(config_file)
+        self.journal_file = f"{config_file}.journal"
+        self.lock_file = f"{config_file}.lock"
+        self.compact_threshold = compact_threshold
+        self._write_lock = threading.RLock()
+        self._write_depth = 0
+        self._journal_entries = 0
+        self._journal_valid_size = 0
+        self._seq = 0
+
+    def _file_signature(self):
+        st = os.stat(self.config_file)
+        try:
+            jst = os.stat(self.journal_file)
+            journal = (jst.st_mtime_ns, jst.st_size, jst.st_ino)
+        except FileNotFoundError:
+            journal = None
+        return (st.st_mtime_ns, st.st_size, st.st_ino, journal)
+
+    def _read(self):
+        config = super()._read()
+        entries = 0
+        valid_size = 0
+        try:
+            with open(self.journal_file, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Torn final append from a crash; ignored and truncated
+                        # by the next writer
+                        break
+                    record = json.loads(line)
+                    if "config" in record:
+                        config = record["config"]
+                    else:
+                        config = apply_node_updates(config, record["nodes"])
+                    self._seq = max(self._seq, record.get("seq", 0))
+                    entries += 1
+                    valid_size += len(line)
+        except FileNotFoundError:
+            pass
+        self._journal_entries = entries
+        self._journal_valid_size = valid_size
+        return config
+
+    @contextmanager
+    def _exclusive(self):
+        """Hold the in-process and cross-process write locks (re-entrant)"""
+        with self._write_lock:
+            if self._write_depth:
+                # flock is per open file; taking it again here would deadlock
+                self._write_depth += 1
+                try:
+                    yield
+                finally:
+                    self._write_depth -= 1
+                return
+            with open(self.lock_file, "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self._write_depth = 1
+                try:
+                    yield
+                finally:
+                    self._write_depth = 0
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def transact(self, plan):
+        """Run plan(snapshot) against the latest state and persist its updates.
+
+        plan returns (nodes, result) where nodes maps node_id to the fields
+        to change. It runs under the write lock, so decisions it makes (such
+        as which free slot to claim) cannot race another writer. All updates
+        are persisted as one journal append. Updates that leave the config
+        invalid raise ConfigValidationError and persist nothing. Returns
+        (result, snapshot).
+        """
+        with self._exclusive():
+            # Pick up appends made by other processes before planning
+            snapshot = self.reload()
+            nodes, result = plan(snapshot)
+            if not nodes:
+                return result, snapshot
+            config = apply_node_updates(snapshot.config, nodes)
+            if self.validator is not None:
+                # Rejected before anything reaches the journal
+                self.validator.validate_nodes(snapshot, config, nodes)
+            # Readers reload under _lock; holding it while the journal and its
+            # bookkeeping change keeps them from recording a half-written state
+            with self._lock:
+                return result, self._append(nodes, config)
+
+    def _append(self, nodes, config):
+        started = time.perf_counter()
+        self._journal({"nodes": nodes})
+        if self._journal_entries >= self.compact_threshold:
+            self._compact(config)
+        self._observe("sd_registration_persist_duration_seconds", started)
+        return self._publish(config, self._file_signature())
+
+    def _journal(self, fields):
+        """Append one fsync'd record after the last complete one"""
+        self._seq += 1
+        record = dict({"seq": self._seq, "ts": time.time()}, **fields)
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode()
+
+        fd = os.open(self.journal_file, os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            os.ftruncate(fd, self._journal_valid_size)
+            os.lseek(fd, self._journal_valid_size, os.SEEK_SET)
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._journal_entries += 1
+        self._journal_valid_size += len(line)
+
+    def compact(self):
+        """Fold the journal into the base config file"""
+        with self._exclusive():
+            snapshot = self.reload()
+            with self._lock:
+                self._compact(snapshot.config)
+                return self._publish(snapshot.config, self._file_signature())
+
+    def _compact(self, config):
+        write_json_atomic(self.config_file, config)
+        # A crash before this truncate replays the journal over the new
+        # base. When the base is the journal folded in (compaction), that
+        # only re-applies updates it already holds. save() writes an
+        # unrelated config, so it journals that config first: replay then
+        # ends on it rather than on the old entries.
+        with open(self.journal_file, "w") as f:
+            os.fsync(f.fileno())
+        self._journal_entries = 0
+        self._journal_valid_size = 0
+
+    def save(self, config):
+        """Replace the whole config atomically and discard the journal"""
+        self._validate(config)
+        with self._exclusive():
+            with self._lock:
+                self._journal({"config": config})
+                self._compact(config)
+                return self._publish(config, self._file_signature())
+
+    @property
+    def journal_entries(self):
+        return self._journal_entries
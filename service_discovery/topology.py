@@ -0,0 +1,303 @@
+"""
+iBGP session and WireGuard tunnel topology for the anycast mesh.
+
+Every BIRD node needs to know which other nodes it holds iBGP sessions
+with and in which role. A full mesh needs N(N-1)/2 sessions and puts N-1
+of them on every node, which stops scaling as PoPs are added; route
+reflection bounds both. Three layouts are supported:
+
+    full-mesh        every pair of nodes peers directly
+    route-reflector  one reflector; every other node is its client
+    regional-rr      up to two reflectors per region sharing the region's
+                     cluster ID; clients peer with their region's
+                     reflectors, and all reflectors peer in a full mesh
+
+Each node's session list is filled in while the sessions are generated,
+so building the whole topology costs O(sessions).
+
+iBGP runs over the WireGuard mesh addresses, so the tunnels are laid out
+on top of the sessions. Every session always gets a tunnel, and the
+tunnel layout adds to that:
+
+    full-mesh   every pair of nodes
+    hub-spoke   nothing more: spokes reach only their route reflectors
+    k-nearest   each node also tunnels to its k nearest nodes, its own
+                region first, then regions by distance
+
+Only registered nodes take part. A slot whose endpoint is still a
+placeholder has nobody to handshake with, and gets its tunnels once it
+registers.
+"""
+
+import math
+from collections import namedtuple
+
+from .snapshot import PLACEHOLDER_ENDPOINT_IPS, endpoint_ip
+
+FULL_MESH = "full-mesh"
+ROUTE_REFLECTOR = "route-reflector"
+REGIONAL_RR = "regional-rr"
+IBGP_TOPOLOGIES = (FULL_MESH, ROUTE_REFLECTOR, REGIONAL_RR)
+
+# A region keeps its routes while one of its two reflectors is down
+REFLECTORS_PER_REGION = 2
+
+HUB_SPOKE = "hub-spoke"
+K_NEAREST = "k-nearest"
+TUNNEL_TOPOLOGIES = (FULL_MESH, HUB_SPOKE, K_NEAREST)
+
+# Tunnels each node opens in k-nearest, on top of its iBGP sessions
+NEAREST_PEERS = 3
+
+# Approximate (latitude, longitude) of Vultr locations, for k-nearest.
+# Regions missing here are treated as farther away than any listed one.
+REGION_COORDINATES = {
+    "ams": (52.31, 4.76), "atl": (33.64, -84.43), "blr": (13.20, 77.71),
+    "bom": (19.09, 72.87), "cdg": (49.01, 2.55), "del": (28.56, 77.10),
+    "dfw": (32.90, -97.04), "ewr": (40.69, -74.17), "fra": (50.03, 8.57),
+    "hnl": (21.32, -157.92), "icn": (37.46, 126.44), "itm": (34.79, 135.44),
+    "jnb": (-26.14, 28.25), "lax": (33.94, -118.41), "lhr": (51.47, -0.45),
+    "mad": (40.47, -3.56), "man": (53.35, -2.27), "mel": (-37.67, 144.84),
+    "mex": (19.44, -99.07), "mia": (25.80, -80.29), "nrt": (35.77, 140.39),
+    "ord": (41.98, -87.90), "sao": (-23.43, -46.47), "scl": (-33.39, -70.79),
+    "sea": (47.45, -122.31), "sgp": (1.36, 103.99), "sjc": (37.36, -121.93),
+    "sto": (59.65, 17.93), "syd": (-33.94, 151.18), "tlv": (32.01, 34.89),
+    "waw": (52.17, 20.97), "yto": (43.68, -79.63),
+}
+
+# One iBGP session as seen from a node. relation is "client" when node_id
+# is this node's route reflector client, "reflector" when node_id reflects
+# routes to this node, and "peer" for a plain iBGP session. cluster_id is
+# set on "client" entries only.
+IBGPPeer = namedtuple("IBGPPeer", ["node_id", "relation", "cluster_id"])
+
+
+class IBGPTopology:
+    """iBGP sessions between a set of nodes, listed per node"""
+
+    def __init__(self, mode, node_ids):
+        self.mode = mode
+        self.peers = {node_id: [] for node_id in node_ids}
+        # Reflector node_id -> cluster ID
+        self.cluster_ids = {}
+        self.session_count = 0
+
+    def _peer(self, a, b):
+        self.peers[a].append(IBGPPeer(b, "peer", None))
+        self.peers[b].append(IBGPPeer(a, "peer", None))
+        self.session_count += 1
+
+    def _reflect(self, reflector, client, cluster_id):
+        self.peers[reflector].append(IBGPPeer(client, "client", cluster_id))
+        self.peers[client].append(IBGPPeer(reflector, "reflector", None))
+        self.session_count += 1
+
+    def is_reflector(self, node_id):
+        return node_id in self.cluster_ids
+
+    def sessions(self):
+        """Yield every session once as (node_id, IBGPPeer), reflector side first"""
+        for node_id, peers in self.peers.items():
+            for peer in peers:
+                if peer.relation == "client" or (peer.relation == "peer" and node_id < peer.node_id):
+                    yield node_id, peer
+
+    def summary(self):
+        """Session counts for reporting, next to what a full mesh would need"""
+        count = len(self.peers)
+        return {
+            "topology": self.mode,
+            "nodes": count,
+            "reflectors": len(self.cluster_ids),
+            "sessions": self.session_count,
+            "full_mesh_sessions": count * (count - 1) // 2,
+            "max_sessions_per_node": max((len(peers) for peers in self.peers.values()), default=0),
+        }
+
+
+def build_ibgp_topology(nodes, mode=ROUTE_REFLECTOR, reflectors_per_region=REFLECTORS_PER_REGION):
+    """Build the iBGP topology for nodes, an iterable of (node_id, region, preferred_reflector).
+
+    Reflectors are picked from the nodes marked preferred_reflector first,
+    then in node order. Clusters are numbered from 1 in sorted region order;
+    route-reflector mode is a single cluster 1.
+    """
+    if mode not in IBGP_TOPOLOGIES:
+        raise ValueError(f"unknown iBGP topology {mode!r}, expected one of {', '.join(IBGP_TOPOLOGIES)}")
+    if reflectors_per_region < 1:
+        raise ValueError("reflectors_per_region must be at least 1")
+    nodes = list(nodes)
+    topology = IBGPTopology(mode, [node_id for node_id, _, _ in nodes])
+
+    if mode == FULL_MESH:
+        _full_mesh(topology, [node_id for node_id, _, _ in nodes])
+        return topology
+
+    if mode == ROUTE_REFLECTOR:
+        clusters = [nodes] if nodes else []
+        per_cluster = 1
+    else:
+        regions = {}
+        for node in nodes:
+            regions.setdefault(node[1], []).append(node)
+        clusters = [regions[region] for region in sorted(regions)]
+        per_cluster = reflectors_per_region
+
+    reflectors = []
+    for cluster_id, members in enumerate(clusters, 1):
+        # sorted() is stable, so ties keep node order
+        chosen = [node_id for node_id, _, _ in sorted(members, key=lambda node: not node[2])[:per_cluster]]
+        for reflector in chosen:
+            topology.cluster_ids[reflector] = cluster_id
+        for node_id, _, _ in members:
+            if node_id not in topology.cluster_ids:
+                for reflector in chosen:
+                    topology._reflect(reflector, node_id, cluster_id)
+        reflectors.extend(chosen)
+
+    # Reflectors are ordinary iBGP peers of each other, including the two
+    # in one cluster
+    _full_mesh(topology, reflectors)
+    return topology
+
+
+def _full_mesh(topology, node_ids):
+    for i, a in enumerate(node_ids):
+        for b in node_ids[i + 1:]:
+            topology._peer(a, b)
+
+
+def region_distance(a, b):
+    """Great-circle distance in km between two regions (0 within one, inf if unknown)"""
+    if a == b:
+        return 0.0
+    if a not in REGION_COORDINATES or b not in REGION_COORDINATES:
+        return math.inf
+    lat1, lon1 = map(math.radians, REGION_COORDINATES[a])
+    lat2, lon2 = map(math.radians, REGION_COORDINATES[b])
+    h = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * 6371.0 * math.asin(math.sqrt(h))
+
+
+class TunnelTopology:
+    """WireGuard tunnels between a set of nodes, listed per node in node order"""
+
+    def __init__(self, mode, node_ids, peers=None):
+        self.mode = mode
+        self.node_ids = node_ids
+        self._members = set(node_ids)
+        # node_id -> sorted peer list; None for a full mesh, which is not
+        # worth materializing
+        self._peers = peers
+
+    def peers(self, node_id):
+        """node_id's tunnel peers; empty for a node outside the topology"""
+        if node_id not in self._members:
+            return []
+        if self._peers is None:
+            return [peer_id for peer_id in self.node_ids if peer_id != node_id]
+        return self._peers[node_id]
+
+    def peer_counts(self):
+        if self._peers is None:
+            return {node_id: len(self.node_ids) - 1 for node_id in self.node_ids}
+        return {node_id: len(peers) for node_id, peers in self._peers.items()}
+
+    def summary(self):
+        """Tunnel counts for reporting, next to what a full mesh would need"""
+        counts = self.peer_counts()
+        count = len(self.node_ids)
+        return {
+            "topology": self.mode,
+            "nodes": count,
+            "tunnels": sum(counts.values()) // 2,
+            "full_mesh_tunnels": count * (count - 1) // 2,
+            "max_peers_per_node": max(counts.values(), default=0),
+            "peers_per_node": counts,
+        }
+
+
+def build_tunnel_topology(nodes, mode=FULL_MESH, ibgp=None, k=NEAREST_PEERS):
+    """Build the tunnel topology for nodes, an iterable of (node_id, region).
+
+    Every session of ibgp (an IBGPTopology over the same nodes) gets a
+    tunnel whatever the mode.
+    """
+    if mode not in TUNNEL_TOPOLOGIES:
+        raise ValueError(f"unknown tunnel topology {mode!r}, expected one of {', '.join(TUNNEL_TOPOLOGIES)}")
+    if k < 1:
+        raise ValueError("k must be at least 1")
+    nodes = list(nodes)
+    node_ids = [node_id for node_id, _ in nodes]
+    if mode == FULL_MESH:
+        return TunnelTopology(mode, node_ids)
+
+    peers = {node_id: set() for node_id in node_ids}
+
+    def link(a, b):
+        peers[a].add(b)
+        peers[b].add(a)
+
+    if ibgp is not None:
+        for node_id, peer in ibgp.sessions():
+            link(node_id, peer.node_id)
+
+    if mode == K_NEAREST:
+        regions = {}
+        for node_id, region in nodes:
+            regions.setdefault(region, []).append(node_id)
+        for region, members in regions.items():
+            # Own region first; sorted() keeps equally distant regions in node order
+            ranked = sorted(regions, key=lambda other: (region_distance(region, other), other != region))
+            for i, node_id in enumerate(members):
+                wanted = k
+                for other in ranked:
+                    candidates = regions[other]
+                    # Walk each region from this node's position, so the
+                    # tunnels of one region spread over the other instead of
+                    # all landing on its first few nodes
+                    available = len(candidates) - 1 if other == region else len(candidates)
+                    start = 1 if other == region else 0
+                    for j in range(start, start + min(wanted, available)):
+                        link(node_id, candidates[(i + j) % len(candidates)])
+                    wanted -= min(wanted, available)
+                    if not wanted:
+                        break
+
+    order = {node_id: i for i, node_id in enumerate(node_ids)}
+    return TunnelTopology(mode, node_ids,
+                          {node_id: sorted(linked, key=order.__getitem__) for node_id, linked in peers.items()})
+
+
+def build_mesh_topology(config, tunnel_mode=None):
+    """(IBGPTopology, TunnelTopology) over the registered nodes of a service discovery config.
+
+    bgp_config.ibgp and wireguard_config.topology pick the layouts;
+    tunnel_mode overrides the latter.
+    """
+    ibgp_settings = config["bgp_config"].get("ibgp", {})
+    tunnel_settings = config["wireguard_config"].get("topology", {})
+    nodes = [(node_id, node["region"], node["role"] == "route_reflector")
+             for node_id, node in config["wireguard_config"]["node_assignments"].items()
+             if endpoint_ip(node["vultr_endpoint"]) not in PLACEHOLDER_ENDPOINT_IPS]
+    ibgp = build_ibgp_topology(nodes, ibgp_settings.get("topology", ROUTE_REFLECTOR),
+                               ibgp_settings.get("reflectors_per_region", REFLECTORS_PER_REGION))
+    tunnels = build_tunnel_topology([(node_id, region) for node_id, region, _ in nodes],
+                                    tunnel_mode or tunnel_settings.get("mode", FULL_MESH), ibgp,
+                                    tunnel_settings.get("k", NEAREST_PEERS))
+    return ibgp, tunnels
+
+
+def mesh_topology(snapshot):
+    """build_mesh_topology() for a snapshot, built once per generation"""
+    topology = snapshot.memo.get("mesh_topology")
+    if topology is None:
+        topology = build_mesh_topology(snapshot.config)
+        snapshot.memo["mesh_topology"] = topology
+    return topology
+
+
+def tunnel_peers(snapshot, node_id):
+    """node_id's WireGuard peers in a snapshot"""
+    return mesh_topology(snapshot)[1].peers(node_id)
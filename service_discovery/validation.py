@@ -0,0 +1,349 @@
+"""
+Schema validation for the service discovery config.
+
+service_discovery/config.schema.json (JSON Schema draft-07) is compiled once,
+when the validator is created, into a tree of small check functions; a
+validation run is then plain dict/type checks with no schema interpretation
+or $ref lookups per value. Only the keywords the schema uses are supported,
+and an unknown keyword fails at compile time rather than being silently
+ignored.
+
+Every config loaded from disk is validated in full before it is published,
+so request handlers can index node fields directly. Registration writes
+only re-check the nodes they touch, with address uniqueness answered from
+the snapshot's NodeIndex, before anything is appended to the journal.
+"""
+
+import ipaddress
+import json
+import re
+from datetime import datetime
+from pathlib import Path
+
+from .filters import compile_route_filter
+from .snapshot import PLACEHOLDER_ENDPOINT_IPS, endpoint_ip
+
+SCHEMA_FILE = Path(__file__).parent / "config.schema.json"
+
+# Errors reported per validation before the rest are summarized
+MAX_ERRORS = 20
+
+# Keywords that only describe the schema
+_ANNOTATIONS = frozenset(["$schema", "$id", "$comment", "title", "description",
+                          "default", "examples", "definitions"])
+
+_TYPES = {
+    "object": lambda value: isinstance(value, dict),
+    "array": lambda value: isinstance(value, list),
+    "string": lambda value: isinstance(value, str),
+    "integer": lambda value: isinstance(value, int) and not isinstance(value, bool),
+    "number": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    "boolean": lambda value: isinstance(value, bool),
+    "null": lambda value: value is None,
+}
+
+
+def _parses(parse):
+    def check(value):
+        try:
+            parse(value)
+        except ValueError:
+            return False
+        return True
+    return check
+
+
+def _endpoint(value):
+    host, sep, port = value.rpartition(":")
+    if not sep or not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(value)
+    ipaddress.ip_address(host.strip("[]"))
+
+
+_FORMATS = {
+    "ipv4": _parses(ipaddress.IPv4Address),
+    "ipv6": _parses(ipaddress.IPv6Address),
+    "ipv4-network": _parses(lambda value: ipaddress.IPv4Network(value, strict=False)),
+    "ipv6-network": _parses(lambda value: ipaddress.IPv6Network(value, strict=False)),
+    "ip-network": _parses(lambda value: ipaddress.ip_network(value, strict=False)),
+    "endpoint": _parses(_endpoint),
+    "date": _parses(lambda value: datetime.strptime(value, "%Y-%m-%d")),
+    "date-time": _parses(lambda value: datetime.fromisoformat(value.replace("Z", "+00:00"))),
+}
+
+
+class ConfigValidationError(ValueError):
+    """The config does not match the schema; errors lists (path, message)"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        shown = "; ".join(f"{path or '<root>'}: {message}" for path, message in errors[:MAX_ERRORS])
+        if len(errors) > MAX_ERRORS:
+            shown += f" (and {len(errors) - MAX_ERRORS} more)"
+        super().__init__(f"invalid config: {shown}")
+
+
+def compile_schema(schema, root=None, refs=None):
+    """Compile a schema into check(value, path, errors) that appends (path, message)"""
+    root = schema if root is None else root
+    refs = {} if refs is None else refs
+    checks = []
+
+    unknown = set(schema) - _ANNOTATIONS - set(_KEYWORDS)
+    if unknown:
+        raise ValueError(f"unsupported schema keywords: {', '.join(sorted(unknown))}")
+
+    if "$ref" in schema:
+        checks.append(_compile_ref(schema["$ref"], root, refs))
+    for keyword, compile_keyword in _KEYWORDS.items():
+        if keyword in schema and keyword != "$ref":
+            check = compile_keyword(schema, root, refs)
+            if check is not None:
+                checks.append(check)
+
+    if len(checks) == 1:
+        return checks[0]
+
+    def check_all(value, path, errors):
+        for check in checks:
+            check(value, path, errors)
+    return check_all
+
+
+def _compile_ref(ref, root, refs):
+    if not ref.startswith("#/"):
+        raise ValueError(f"only local $refs are supported: {ref}")
+    if ref not in refs:
+        # Placeholder first, so recursive definitions terminate
+        refs[ref] = None
+        target = root
+        for part in ref[2:].split("/"):
+            target = target[part]
+        refs[ref] = compile_schema(target, root, refs)
+
+    def check_ref(value, path, errors):
+        refs[ref](value, path, errors)
+    return check_ref
+
+
+def _compile_type(schema, root, refs):
+    names = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+    tests = [_TYPES[name] for name in names]
+    expected = " or ".join(names)
+
+    def check_type(value, path, errors):
+        if not any(test(value) for test in tests):
+            errors.append((path, f"expected {expected}, got {type(value).__name__}"))
+    return check_type
+
+
+def _compile_enum(schema, root, refs):
+    allowed = schema["enum"]
+
+    def check_enum(value, path, errors):
+        if value not in allowed:
+            errors.append((path, f"{value!r} is not one of {allowed}"))
+    return check_enum
+
+
+def _compile_required(schema, root, refs):
+    required = schema["required"]
+
+    def check_required(value, path, errors):
+        if isinstance(value, dict):
+            for key in required:
+                if key not in value:
+                    errors.append((path, f"missing required field {key!r}"))
+    return check_required
+
+
+def _compile_properties(schema, root, refs):
+    properties = {key: compile_schema(sub, root, refs) for key, sub in schema["properties"].items()}
+    extra = schema.get("additionalProperties", True)
+    if extra is True:
+        extra_check = None
+    elif extra is False:
+        extra_check = False
+    else:
+        extra_check = compile_schema(extra, root, refs)
+
+    def check_properties(value, path, errors):
+        if not isinstance(value, dict):
+            return
+        for key, item in value.items():
+            check = properties.get(key, extra_check)
+            if check is None:
+                continue
+            item_path = f"{path}.{key}" if path else key
+            if check is False:
+                errors.append((item_path, "unexpected field"))
+            else:
+                check(item, item_path, errors)
+    return check_properties
+
+
+def _compile_additional(schema, root, refs):
+    if "properties" in schema:
+        # Handled together with properties
+        return None
+    return _compile_properties(dict(schema, properties={}), root, refs)
+
+
+def _compile_items(schema, root, refs):
+    item_check = compile_schema(schema["items"], root, refs)
+
+    def check_items(value, path, errors):
+        if isinstance(value, list):
+            for i, item in enumerate(value):
+                item_check(item, f"{path}[{i}]", errors)
+    return check_items
+
+
+def _compile_min_items(schema, root, refs):
+    minimum = schema["minItems"]
+
+    def check_min_items(value, path, errors):
+        if isinstance(value, list) and len(value) < minimum:
+            errors.append((path, f"expected at least {minimum} items"))
+    return check_min_items
+
+
+def _compile_min_length(schema, root, refs):
+    minimum = schema["minLength"]
+
+    def check_min_length(value, path, errors):
+        if isinstance(value, str) and len(value) < minimum:
+            errors.append((path, f"expected at least {minimum} characters"))
+    return check_min_length
+
+
+def _compile_pattern(schema, root, refs):
+    pattern = re.compile(schema["pattern"])
+
+    def check_pattern(value, path, errors):
+        if isinstance(value, str) and not pattern.search(value):
+            errors.append((path, f"{value!r} does not match {pattern.pattern!r}"))
+    return check_pattern
+
+
+def _compile_format(schema, root, refs):
+    name = schema["format"]
+    if name not in _FORMATS:
+        raise ValueError(f"unsupported format {name!r}")
+    test = _FORMATS[name]
+
+    def check_format(value, path, errors):
+        if isinstance(value, str) and not test(value):
+            errors.append((path, f"{value!r} is not a valid {name}"))
+    return check_format
+
+
+def _compile_bound(keyword, compare, message):
+    def compile_bound(schema, root, refs):
+        bound = schema[keyword]
+
+        def check_bound(value, path, errors):
+            if _TYPES["number"](value) and not compare(value, bound):
+                errors.append((path, f"{value} {message} {bound}"))
+        return check_bound
+    return compile_bound
+
+
+_KEYWORDS = {
+    "$ref": None,
+    "type": _compile_type,
+    "enum": _compile_enum,
+    "required": _compile_required,
+    "properties": _compile_properties,
+    "additionalProperties": _compile_additional,
+    "items": _compile_items,
+    "minItems": _compile_min_items,
+    "minLength": _compile_min_length,
+    "pattern": _compile_pattern,
+    "format": _compile_format,
+    "minimum": _compile_bound("minimum", lambda value, bound: value >= bound, "is less than"),
+    "maximum": _compile_bound("maximum", lambda value, bound: value <= bound, "is greater than"),
+}
+
+
+class ConfigValidator:
+    """Compiled validator for the service discovery config"""
+
+    def __init__(self, schema):
+        self._check_config = compile_schema(schema)
+        self._check_node = compile_schema({"$ref": "#/definitions/node"}, schema)
+
+    @classmethod
+    def from_file(cls, path=SCHEMA_FILE):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def validate(self, config):
+        """Raise ConfigValidationError unless the whole config is valid"""
+        errors = []
+        self._check_config(config, "", errors)
+        if not errors:
+            _check_unique_nodes(config["wireguard_config"]["node_assignments"], errors)
+            _check_route_filters(config["bgp_config"].get("route_filters", {}), errors)
+        if errors:
+            raise ConfigValidationError(errors)
+
+    def validate_nodes(self, snapshot, config, node_ids):
+        """Validate the given nodes of config, which is snapshot's config with them updated.
+
+        snapshot is already known to be valid, so only the touched nodes are
+        checked, and its index answers which node owns an address without a
+        scan over every node.
+        """
+        errors = []
+        assignments = config["wireguard_config"]["node_assignments"]
+        changed = [node_id for node_id in node_ids if node_id in assignments]
+        for node_id in changed:
+            self._check_node(assignments[node_id], f"wireguard_config.node_assignments.{node_id}", errors)
+        if errors:
+            raise ConfigValidationError(errors)
+
+        index = snapshot.index
+        claimed = {}
+        for node_id in changed:
+            for field, value in _unique_keys(assignments[node_id]):
+                if field == "vultr_endpoint":
+                    owner = index.by_endpoint_ip.get(value, (None, None))[0]
+                else:
+                    owner = index.by_mesh_ip.get(value)
+                if owner is None or owner == node_id or owner in node_ids:
+                    # Nodes changed in this write are compared with each other below
+                    owner = claimed.setdefault((field, value), node_id)
+                if owner != node_id:
+                    errors.append((f"wireguard_config.node_assignments.{node_id}.{field}",
+                                   f"{value} is already used by {owner}"))
+        if errors:
+            raise ConfigValidationError(errors)
+
+
+def _unique_keys(node):
+    yield "ipv4", node["ipv4"]
+    yield "ipv6", node["ipv6"]
+    ip = endpoint_ip(node["vultr_endpoint"])
+    if ip not in PLACEHOLDER_ENDPOINT_IPS:
+        yield "vultr_endpoint", ip
+
+
+def _check_unique_nodes(assignments, errors):
+    """Mesh addresses and registered endpoint IPs may not be shared by two nodes"""
+    owners = {}
+    for node_id, node in assignments.items():
+        for key in _unique_keys(node):
+            other = owners.setdefault(key, node_id)
+            if other != node_id:
+                errors.append((f"wireguard_config.node_assignments.{node_id}.{key[0]}",
+                               f"{key[1]} is already used by {other}"))
+
+
+def _check_route_filters(route_filters, errors):
+    """Every route filter must compile to BIRD prefix sets"""
+    for name, route_filter in route_filters.items():
+        try:
+            compile_route_filter(name, route_filter)
+        except ValueError as e:
+            errors.append((f"bgp_config.route_filters.{name}", str(e)))
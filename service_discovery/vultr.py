@@ -0,0 +1,165 @@
+"""
+Cached index of Vultr instances keyed by main_ip.
+
+Region-aware registration needs to know which Vultr region an external IP
+belongs to. Instead of downloading /v2/instances for every lookup, the
+whole account is fetched once (following cursor pagination), indexed by
+main_ip, and reused until it is older than the TTL. Concurrent refreshes
+are coalesced: one thread fetches while the others either keep using the
+previous index or, if there is none yet, wait for that one fetch.
+
+An IP missing from a fresh index may belong to an instance created after
+the last fetch (a node registering straight after boot), so a miss also
+triggers a refresh, at most once per MISS_REFRESH_INTERVAL.
+
+A failed fetch is remembered too: for MISS_REFRESH_INTERVAL afterwards no
+lookup tries the API again, and lookups that find no index answer "unknown"
+at once instead of queueing up behind one timeout after another while the
+API is unreachable.
+"""
+
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+VULTR_API_URL = "https://api.vultr.com"
+
+# Seconds an instance listing is trusted before it is fetched again
+INDEX_TTL = 300
+
+# Minimum seconds between refreshes triggered by lookups that missed
+MISS_REFRESH_INTERVAL = 15
+
+# Instances requested per page (Vultr allows up to 500)
+PAGE_SIZE = 500
+
+
+class VultrAPIError(Exception):
+    """The Vultr API could not be reached or returned an error"""
+
+
+class InstanceIndex:
+    """main_ip -> instance dict for every instance in the account"""
+
+    def __init__(self, api_key, base_url=VULTR_API_URL, ttl=INDEX_TTL,
+                 page_size=PAGE_SIZE, timeout=10, clock=time.monotonic):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.ttl = ttl
+        self.page_size = page_size
+        self.timeout = timeout
+        self.clock = clock
+        self._by_ip = None
+        self._fetched_at = None
+        self._failed_at = None
+        self._refresh_lock = threading.Lock()
+        self.fetches = 0
+        self.last_error = None
+
+    @classmethod
+    def from_environment(cls):
+        """Index configured from VULTR_API_KEY / VULTR_API_URL, or None if no key is set"""
+        api_key = os.environ.get("VULTR_API_KEY")
+        if not api_key:
+            return None
+        return cls(api_key, os.environ.get("VULTR_API_URL", VULTR_API_URL))
+
+    def _get_page(self, cursor):
+        query = {"per_page": self.page_size}
+        if cursor:
+            query["cursor"] = cursor
+        request = urllib.request.Request(
+            f"{self.base_url}/v2/instances?{urllib.parse.urlencode(query)}",
+            headers={"Authorization": f"Bearer {self.api_key}"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.load(response)
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            raise VultrAPIError(f"Error querying Vultr API: {e}") from e
+
+    def fetch_all(self):
+        """Fetch every instance, following meta.links.next cursors"""
+        instances = []
+        cursor = None
+        seen = set()
+        while True:
+            page = self._get_page(cursor)
+            self.fetches += 1
+            instances.extend(page.get("instances", []))
+            cursor = (page.get("meta") or {}).get("links", {}).get("next")
+            if not cursor or cursor in seen:
+                return instances
+            seen.add(cursor)
+
+    def refresh(self, seen=False):
+        """Re-fetch the index.
+
+        Callers that saw the index as of fetch time `seen` pass it in; if
+        another thread refreshed it while they waited, its result is reused.
+        """
+        with self._refresh_lock:
+            if seen is not False and self._fetched_at != seen:
+                # Someone else fetched while we waited for the lock
+                return self._by_ip
+            requested_at = self.clock()
+            if self._backing_off(requested_at):
+                raise VultrAPIError(self.last_error)
+            try:
+                instances = self.fetch_all()
+            except VultrAPIError as e:
+                self.last_error = str(e)
+                self._failed_at = self.clock()
+                raise
+            self._by_ip = {instance["main_ip"]: instance
+                           for instance in instances if instance.get("main_ip")}
+            self._fetched_at = requested_at
+            self._failed_at = None
+            self.last_error = None
+            return self._by_ip
+
+    def _backing_off(self, now):
+        """Whether a fetch failed less than MISS_REFRESH_INTERVAL ago"""
+        failed_at = self._failed_at
+        return failed_at is not None and now - failed_at < MISS_REFRESH_INTERVAL
+
+    def _current(self):
+        by_ip, fetched_at = self._by_ip, self._fetched_at
+        now = self.clock()
+        if by_ip is None:
+            if self._backing_off(now):
+                raise VultrAPIError(self.last_error)
+            return self.refresh(seen=fetched_at)
+        if now - fetched_at >= self.ttl and not self._refresh_lock.locked() and not self._backing_off(now):
+            # Stale: this thread refreshes, concurrent callers keep using the old index
+            try:
+                return self.refresh(seen=fetched_at)
+            except VultrAPIError:
+                return by_ip
+        return by_ip
+
+    def lookup(self, main_ip):
+        """Instance dict for main_ip, or None if unknown or the API is unreachable"""
+        try:
+            instance = self._current().get(main_ip)
+            fetched_at = self._fetched_at
+            now = self.clock()
+            if instance is None and now - fetched_at >= MISS_REFRESH_INTERVAL and not self._backing_off(now):
+                instance = self.refresh(seen=fetched_at).get(main_ip)
+        except VultrAPIError:
+            return None
+        return instance
+
+    def region_of(self, main_ip):
+        instance = self.lookup(main_ip)
+        return instance.get("region") if instance else None
+
+    @property
+    def age(self):
+        return None if self._fetched_at is None else self.clock() - self._fetched_at
+
+    def __len__(self):
+        return len(self._by_ip or ())
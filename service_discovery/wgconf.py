@@ -0,0 +1,81 @@
+"""
+WireGuard wg0.conf rendering from pre-rendered fragments.
+
+Each node's [Peer] section is identical in the configs of all nodes that
+list it, so it is rendered once per config generation and cached on the
+snapshot. A node's config is then its own [Interface] section followed by
+the fragments of its tunnel peers (see topology.py), and can be streamed
+piece by piece or joined once, with no repeated string concatenation.
+"""
+
+from .topology import tunnel_peers
+
+
+# Where a node allocated by registration keeps the private key it generated;
+# the API only ever sees the public half
+PRIVATE_KEY_FILE = "/etc/wireguard/private.key"
+
+
+def private_key_fields(node):
+    """The private key fields of a node's WireGuard payload"""
+    if "private_key" in node:
+        return {"private_key": node["private_key"]}
+    return {"private_key": None, "private_key_file": PRIVATE_KEY_FILE}
+
+
+def interface_section(node, mesh_config):
+    """Render a node's [Interface] section.
+
+    Nodes that generated their own key get no PrivateKey line; wg-quick
+    loads the key from PRIVATE_KEY_FILE once the interface is up, so the
+    file can still be piped straight into /etc/wireguard/wg0.conf.
+    """
+    if "private_key" in node:
+        key = f"PrivateKey = {node['private_key']}\n"
+    else:
+        key = f"PostUp = wg set %i private-key {PRIVATE_KEY_FILE}\n"
+    return f"""[Interface]
+{key}Address = {node['ipv4']}/24, {node['ipv6']}/64
+ListenPort = {mesh_config['port']}
+
+"""
+
+
+def peer_section(peer_id, peer_config, mesh_config):
+    """Render the [Peer] section other nodes use to reach peer_id"""
+    return f"""[Peer]
+# {peer_id.upper()}
+PublicKey = {peer_config['public_key']}
+Endpoint = {peer_config['vultr_endpoint']}
+AllowedIPs = {peer_config['ipv4']}/32, {peer_config['ipv6']}/128
+PersistentKeepalive = {mesh_config['keepalive']}
+
+"""
+
+
+def peer_fragments(snapshot):
+    """Map node_id -> [Peer] section, rendered once per snapshot"""
+    fragments = snapshot.memo.get("wg_peer_fragments")
+    if fragments is None:
+        wg_config = snapshot.config["wireguard_config"]
+        mesh_config = wg_config["mesh_networks"]
+        fragments = {
+            peer_id: peer_section(peer_id, peer_config, mesh_config)
+            for peer_id, peer_config in wg_config["node_assignments"].items()
+        }
+        snapshot.memo["wg_peer_fragments"] = fragments
+    return fragments
+
+
+def iter_wg_conf(snapshot, node_id):
+    """Yield the sections of node_id's wg0.conf in order"""
+    wg_config = snapshot.config["wireguard_config"]
+    yield interface_section(wg_config["node_assignments"][node_id], wg_config["mesh_networks"])
+    fragments = peer_fragments(snapshot)
+    for peer_id in tunnel_peers(snapshot, node_id):
+        yield fragments[peer_id]
+
+
+def render_wg_conf(snapshot, node_id):
+    """Render node_id's complete wg0.conf as one string"""
+    return "".join(iter_wg_conf(snapshot, node_id))
@@ -0,0 +1,78 @@
+"""
+Shared fixtures for the service discovery API tests.
+
+The API lives in a hyphenated script (service-discovery-api.py), so it is
+loaded by path. Each test gets its own copy of the schema file so nothing
+touches the checked-in service-discovery-schema.json.
+"""
+
+import base64
+import hashlib
+import importlib.util
+import json
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(REPO_ROOT))
+
+from service_discovery.cache import ResponseCache  # noqa: E402
+from service_discovery.liveness import LivenessTable  # noqa: E402
+from service_discovery.shared import SharedSnapshotStore  # noqa: E402
+
+SCHEMA_FILE = REPO_ROOT / "service-discovery-schema.json"
+
+
+def load_api():
+    spec = importlib.util.spec_from_file_location(
+        "service_discovery_api", REPO_ROOT / "service-discovery-api.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def add_open_slots(config, count):
+    """Append placeholder node slots to a schema dict"""
+    assignments = config["wireguard_config"]["node_assignments"]
+    for i in range(count):
+        node_id = f"slot{i:03d}"
+        assignments[node_id] = {
+            "ipv4": f"10.10.11.{i + 1}",
+            "ipv6": f"fd00:10:11::{i + 1:x}",
+            "public_key": f"pub-{node_id}",
+            "private_key": base64.b64encode(hashlib.sha256(node_id.encode()).digest()).decode(),
+            "vultr_endpoint": "0.0.0.0:51820",
+            "role": "secondary",
+            "announced_ip": "192.30.120.9",
+            "region": node_id,
+            "provider": "vultr"
+        }
+    return config
+
+
+@pytest.fixture
+def schema_file(tmp_path):
+    path = tmp_path / "service-discovery-schema.json"
+    shutil.copy(SCHEMA_FILE, path)
+    return path
+
+
+@pytest.fixture
+def api(schema_file):
+    module = load_api()
+    module.config_store = SharedSnapshotStore(schema_file)
+    module.config_store.metrics = module.metrics
+    module.config_store.validator = module.config_validator
+    module.response_cache = ResponseCache(module.serialize_json)
+    module.bird_cache = ResponseCache(str.encode, mimetype="text/plain")
+    module.liveness = LivenessTable()
+    module.liveness.enable_sharing(f"{schema_file}.liveness")
+    return module
+
+
+def write_schema(path, config):
+    with open(path, "w") as f:
+        json.dump(config, f, indent=2)
@@ -0,0 +1,738 @@
+"""
+Endpoint tests for the service discovery API
+"""
+
+import gzip
+import hashlib
+import ipaddress
+import json
+import os
+import pstats
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+from werkzeug.test import Client
+
+from conftest import REPO_ROOT, add_open_slots, load_api, write_schema
+from service_discovery.acl import PrefixTrie
+from service_discovery import liveness as liveness_module
+from service_discovery.liveness import LivenessTable, SharedHeartbeats
+from service_discovery.metrics import Metrics
+from service_discovery.profiling import ProfileRing, ProfilingMiddleware
+from service_discovery.server import max_watchers
+from service_discovery.snapshot import PLACEHOLDER_ENDPOINT_IPS, SnapshotStore, endpoint_ip
+
+
+def test_snapshot_is_reread_only_when_the_file_changes(api, schema_file, monkeypatch):
+    store = SnapshotStore(schema_file)
+    api.config_store = store
+    reads = []
+    read = store._read
+    monkeypatch.setattr(store, "_read", lambda: reads.append(1) or read())
+    client = api.app.test_client()
+
+    first = store.current()
+    assert client.get('/api/v1/status').get_json()["config_generation"] == first.generation
+    assert store.current() is first
+    assert len(reads) == 1
+
+    with open(schema_file) as f:
+        config = json.load(f)
+    config["service_info"]["version"] = "9.9.9"
+    write_schema(schema_file, config)
+    # Some filesystems keep whole-second mtimes; make sure this one moves
+    stat = os.stat(schema_file)
+    os.utime(schema_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2_000_000_000))
+
+    status = client.get('/api/v1/status').get_json()
+    assert status["version"] == "9.9.9"
+    assert status["config_generation"] == first.generation + 1
+    assert len(reads) == 2
+
+
+def test_node_index_lookups_match_a_linear_scan(api, schema_file):
+    with open(schema_file) as f:
+        config = json.load(f)
+    add_open_slots(config, 40)
+    assignments = config["wireguard_config"]["node_assignments"]
+    # Shared regions and placeholder endpoints: the first node in
+    # assignment order wins
+    for i, node_id in enumerate(list(assignments)[4:]):
+        assignments[node_id]["region"] = ("ord", "mia", node_id)[i % 3]
+        assignments[node_id]["provider"] = ("vultr", "hetzner")[i % 2]
+        assignments[node_id]["role"] = ("secondary", "route_reflector", "backup")[i % 3]
+        if i % 4 == 0:
+            assignments[node_id]["vultr_endpoint"] = f"198.51.100.{i}:51820"
+    write_schema(schema_file, config)
+    snapshot = api.config_store.current()
+
+    def scan(key, value):
+        return next(((node_id, node) for node_id, node in assignments.items() if key(node) == value),
+                    (None, None))
+
+    for region in {node["region"] for node in assignments.values()} | {"nowhere"}:
+        assert api.get_node_by_region(region, snapshot) == scan(lambda node: node["region"], region)
+    endpoints = {endpoint_ip(node["vultr_endpoint"]) for node in assignments.values()}
+    for ip in endpoints | {"192.0.2.1"}:
+        assert api.get_node_by_vultr_ip(ip, snapshot) == scan(lambda node: endpoint_ip(node["vultr_endpoint"]), ip)
+    assert snapshot.index.open_slots == [node_id for node_id, node in assignments.items()
+                                         if endpoint_ip(node["vultr_endpoint"]) in PLACEHOLDER_ENDPOINT_IPS]
+
+    # Provider and role list every matching node, in assignment order
+    def scan_all(field, value):
+        return [node_id for node_id, node in assignments.items() if node[field] == value]
+
+    for provider in {node["provider"] for node in assignments.values()} | {"nowhere"}:
+        assert api.get_nodes_by_provider(provider, snapshot) == scan_all("provider", provider)
+    for role in {node["role"] for node in assignments.values()} | {"nowhere"}:
+        assert api.get_nodes_by_role(role, snapshot) == scan_all("role", role)
+    status = api.app.test_client().get('/api/v1/status').get_json()
+    assert status["nodes_by_role"] == {role: scan_all("role", role) for role in snapshot.index.by_role}
+    assert sum(map(len, status["nodes_by_provider"].values())) == len(assignments)
+
+
+def test_if_none_match_gets_304_until_the_body_hash_changes(api, schema_file):
+    client = api.app.test_client()
+    first = client.get('/api/v1/nodes/lax/wireguard')
+    etag = first.headers["ETag"]
+    assert etag == f'"{hashlib.blake2b(first.data, digest_size=16).hexdigest()}"'
+
+    revalidated = client.get('/api/v1/nodes/lax/wireguard', headers={"If-None-Match": etag})
+    assert revalidated.status_code == 304
+    assert revalidated.data == b""
+
+    # A new generation that leaves lax's body alone keeps its hash
+    with open(schema_file) as f:
+        config = json.load(f)
+    config["service_info"]["version"] = "9.9.9"
+    write_schema(schema_file, config)
+    stat = os.stat(schema_file)
+    os.utime(schema_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2_000_000_000))
+    revalidated = client.get('/api/v1/nodes/lax/wireguard', headers={"If-None-Match": etag})
+    assert revalidated.status_code == 304
+    assert int(revalidated.headers["X-Config-Generation"]) > int(first.headers["X-Config-Generation"])
+
+    # ord registering gives lax a new peer, so a new body and ETag
+    client.post('/api/v1/nodes/register', json={"external_ip": "198.51.100.1"})
+    changed = client.get('/api/v1/nodes/lax/wireguard', headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] == f'"{hashlib.blake2b(changed.data, digest_size=16).hexdigest()}"' != etag
+
+
+def test_register_batch_claims_distinct_slots(api):
+    client = api.app.test_client()
+    response = client.post('/api/v1/nodes/register:batch', json={
+        "external_ips": ["198.51.100.1", "149.248.2.74", "198.51.100.2",
+                         "198.51.100.1", "198.51.100.3", "198.51.100.4"]
+    })
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+
+    assert [(r["status"], r["node_id"]) for r in results[:5]] == [
+        ("registered", "ord"), ("updated", "lax"), ("registered", "mia"),
+        ("updated", "ord"), ("registered", "ewr")]
+    assert results[5]["code"] == 400
+    # The whole batch is one journal append
+    assert api.config_store.journal_entries == 1
+
+
+def test_register_batch_places_each_ip_by_its_region(api):
+    client = api.app.test_client()
+    response = client.post('/api/v1/nodes/register:batch', json={
+        "external_ips": ["198.51.100.1", "198.51.100.2", "198.51.100.3"],
+        "nodes": {"198.51.100.1": {"region": "ewr", "instance_id": "inst-ewr"},
+                  "198.51.100.2": {"region": "mia"},
+                  "198.51.100.3": {"region": "ord", "instance_id": "inst-ord"}}
+    })
+    assert [(r["status"], r["node_id"]) for r in response.get_json()["results"]] == [
+        ("registered", "ewr"), ("registered", "mia"), ("registered", "ord")]
+    assignments = api.config_store.current().config["wireguard_config"]["node_assignments"]
+    assert assignments["ewr"]["instance_id"] == "inst-ewr"
+    assert "instance_id" not in assignments["mia"]
+
+    # A region alone never allocates a node: that needs the node's public key
+    response = client.post('/api/v1/nodes/register', json={"external_ip": "198.51.100.4", "region": "lax"})
+    assert response.status_code == 400
+    assert client.post('/api/v1/nodes/register:batch', json={
+        "external_ips": ["198.51.100.5"], "nodes": {"198.51.100.5": {"instance_id": 7}}}).status_code == 400
+
+
+def test_register_batch_rejects_bad_bodies(api):
+    client = api.app.test_client()
+    assert client.post('/api/v1/nodes/register:batch', json={}).status_code == 400
+    assert client.post('/api/v1/nodes/register:batch',
+                       json={"external_ips": "198.51.100.1"}).status_code == 400
+    assert client.post('/api/v1/nodes/register:batch',
+                       json={"external_ips": ["x"] * (api.MAX_BATCH_SIZE + 1)}).status_code == 400
+
+
+def test_discover_batch_matches_single_discover(api):
+    client = api.app.test_client()
+    client.post('/api/v1/nodes/register:batch', json={"external_ips": ["198.51.100.1"]})
+    response = client.post('/api/v1/nodes/discover:batch',
+                           json={"external_ips": ["198.51.100.1", "192.0.2.1"]})
+    found, missing = response.get_json()["results"]
+
+    single = client.post('/api/v1/nodes/discover', json={"external_ip": "198.51.100.1"})
+    assert found["config"] == single.get_json()
+    assert missing["code"] == 404
+
+
+def test_wireguard_delta_since_generation(api):
+    client = api.app.test_client()
+    full = client.get('/api/v1/nodes/lax/wireguard')
+    generation = int(full.headers["X-Config-Generation"])
+
+    unchanged = client.get(f'/api/v1/nodes/lax/wireguard?since={generation}').get_json()
+    assert unchanged["upsert"] == [] and unchanged["remove"] == []
+
+    client.post('/api/v1/nodes/register', json={"external_ip": "198.51.100.1"})
+    delta = client.get(f'/api/v1/nodes/lax/wireguard?since={generation}').get_json()
+    assert delta["since"] == generation
+    assert [peer["endpoint"] for peer in delta["upsert"]] == ["198.51.100.1:51820"]
+    assert delta["remove"] == []
+
+    # The registering node gains its first tunnel, to the one registered node
+    own = client.get(f'/api/v1/nodes/ord/wireguard?since={generation}').get_json()
+    assert [peer["endpoint"] for peer in own["upsert"]] == ["149.248.2.74:51820"]
+
+
+def test_wireguard_delta_falls_back_to_full_listing(api):
+    client = api.app.test_client()
+    client.post('/api/v1/nodes/register:batch', json={"external_ips": ["198.51.100.1", "198.51.100.2"]})
+    response = client.get('/api/v1/nodes/lax/wireguard?since=999')
+    assert len(response.get_json()["peers"]) == 2
+    assert client.get('/api/v1/nodes/lax/wireguard?since=abc').status_code == 400
+
+
+def test_wireguard_delta_spanning_a_settings_change_is_a_full_listing(api, schema_file):
+    client = api.app.test_client()
+    client.post('/api/v1/nodes/register:batch', json={"external_ips": ["198.51.100.1", "198.51.100.2"]})
+    generation = int(client.get('/api/v1/nodes/ord/wireguard').headers["X-Config-Generation"])
+
+    # No node changes, but every peer's keepalive and the tunnel layout do
+    config = json.loads(schema_file.read_text())
+    config["wireguard_config"]["mesh_networks"]["keepalive"] = 10
+    config["wireguard_config"]["topology"] = {"mode": "hub-spoke"}
+    write_schema(schema_file, config)
+
+    full = client.get('/api/v1/nodes/ord/wireguard').get_json()
+    assert [peer["description"] for peer in full["peers"]] == ["LAX route_reflector"]
+    assert full["peers"][0]["persistent_keepalive"] == 10
+    response = client.get(f'/api/v1/nodes/ord/wireguard?since={generation}')
+    assert response.get_json() == full
+    assert api.config_store.changes.changes_since(generation) is None
+
+    # Deltas from after the change work again
+    after = int(response.headers["X-Config-Generation"])
+    client.post('/api/v1/nodes/register', json={"external_ip": "198.51.100.3"})
+    delta = client.get(f'/api/v1/nodes/lax/wireguard?since={after}').get_json()
+    assert [peer["endpoint"] for peer in delta["upsert"]] == ["198.51.100.3:51820"]
+    assert delta["upsert"][0]["persistent_keepalive"] == 10
+
+
+def test_wireguard_peers_follow_the_tunnel_topology(api, schema_file):
+    config = json.loads(schema_file.read_text())
+    config["wireguard_config"]["topology"] = {"mode": "hub-spoke"}
+    write_schema(schema_file, config)
+    client = api.app.test_client()
+
+    # Unregistered placeholder slots are nobody's peer
+    assert client.get('/api/v1/nodes/lax/wireguard').get_json()["peers"] == []
+    client.post('/api/v1/nodes/register:batch', json={"external_ips": ["198.51.100.1", "198.51.100.2"]})
+    generation = int(client.get('/api/v1/nodes/lax/wireguard').headers["X-Config-Generation"])
+
+    # Spokes tunnel only to the route reflector they hold their iBGP session with
+    ord_peers = client.get('/api/v1/nodes/ord/wireguard').get_json()["peers"]
+    assert [peer["description"] for peer in ord_peers] == ["LAX route_reflector"]
+    assert "# MIA" not in client.get('/api/v1/nodes/ord/wg0.conf').get_data(as_text=True)
+
+    client.post('/api/v1/nodes/register', json={"external_ip": "198.51.100.3"})
+    assert client.get(f'/api/v1/nodes/ord/wireguard?since={generation}').get_json()["upsert"] == []
+    lax_delta = client.get(f'/api/v1/nodes/lax/wireguard?since={generation}').get_json()
+    assert [peer["endpoint"] for peer in lax_delta["upsert"]] == ["198.51.100.3:51820"]
+
+    report = client.get('/api/v1/topology').get_json()
+    assert report["registered_nodes"] == 4 and report["unregistered_slots"] == []
+    assert report["ibgp"]["sessions"] == 3
+    assert report["ibgp"]["sessions_per_node"] == {"lax": 3, "ord": 1, "mia": 1, "ewr": 1}
+    layouts = report["wireguard"]["layouts"]
+    assert report["wireguard"]["topology"] == "hub-spoke"
+    assert layouts["hub-spoke"]["tunnels"] == 3
+    assert layouts["hub-spoke"]["peers_per_node"] == {"lax": 3, "ord": 1, "mia": 1, "ewr": 1}
+    assert layouts["full-mesh"]["tunnels"] == layouts["full-mesh"]["full_mesh_tunnels"] == 6
+    assert layouts["k-nearest"]["max_peers_per_node"] <= 3
+
+
+def test_watch_returns_when_own_config_changes(api):
+    client = api.app.test_client()
+    etag = client.get('/api/v1/nodes/lax/wireguard').headers["ETag"]
+
+    for timeout in ("nan", "inf", "-inf"):
+        assert client.get(f'/api/v1/nodes/lax/watch?timeout={timeout}').status_code == 400
+
+    # Nothing changes: the watch times out with a 304
+    idle = client.get('/api/v1/nodes/lax/watch?timeout=0.2', headers={"If-None-Match": etag})
+    assert idle.status_code == 304
+
+    def register_later():
+        time.sleep(0.2)
+        api.app.test_client().post('/api/v1/nodes/register', json={"external_ip": "198.51.100.1"})
+
+    thread = threading.Thread(target=register_later)
+    thread.start()
+    started = time.monotonic()
+    changed = client.get('/api/v1/nodes/lax/watch?timeout=10', headers={"If-None-Match": etag})
+    thread.join()
+
+    assert changed.status_code == 200
+    assert time.monotonic() - started < 5
+    assert changed.headers["ETag"] != etag
+    assert "198.51.100.1:51820" in [peer["endpoint"] for peer in changed.get_json()["peers"]]
+
+
+def test_watchers_past_the_cap_get_503(api, monkeypatch):
+    api.watch_slots = threading.BoundedSemaphore(1)
+    client = api.app.test_client()
+    etag = client.get('/api/v1/nodes/lax/wireguard').headers["ETag"]
+
+    waiting = []
+    thread = threading.Thread(target=lambda: waiting.append(api.app.test_client().get(
+        '/api/v1/nodes/lax/watch?timeout=10', headers={"If-None-Match": etag})))
+    thread.start()
+    while api.watch_slots.acquire(blocking=False):
+        api.watch_slots.release()
+        time.sleep(0.01)
+
+    refused = client.get('/api/v1/nodes/lax/watch?timeout=10', headers={"If-None-Match": etag})
+    assert refused.status_code == 503
+    assert refused.headers["Retry-After"] == str(api.WATCH_RETRY_AFTER)
+    # Watches that answer at once never need a slot, and other endpoints are unaffected
+    assert client.get('/api/v1/nodes/ord/watch?timeout=10', headers={"If-None-Match": "old"}).status_code == 200
+    assert client.get('/api/v1/nodes/lax/watch?timeout=0', headers={"If-None-Match": etag}).status_code == 304
+    assert client.get('/api/v1/status').status_code == 200
+
+    client.post('/api/v1/nodes/register', json={"external_ip": "198.51.100.1"})
+    thread.join()
+    assert waiting[0].status_code == 200
+    # The slot is free again
+    etag = waiting[0].headers["ETag"]
+    assert client.get('/api/v1/nodes/lax/watch?timeout=0.1', headers={"If-None-Match": etag}).status_code == 304
+
+    # Half the gthread threads may wait; gevent watchers are greenlets
+    monkeypatch.delenv("SD_WORKER_CLASS", raising=False)
+    monkeypatch.setenv("SD_THREADS", "8")
+    assert max_watchers() == 4
+    monkeypatch.setenv("SD_WORKER_CLASS", "gevent")
+    assert max_watchers() == 900
+    monkeypatch.setenv("SD_MAX_WATCHERS", "50")
+    assert max_watchers() == 50
+
+
+def test_wg0_conf_matches_cloud_init_and_revalidates(api):
+    client = api.app.test_client()
+    client.post('/api/v1/nodes/register:batch',
+                json={"external_ips": ["198.51.100.1", "198.51.100.2", "198.51.100.3"]})
+    cloud_init = client.get('/api/v1/nodes/mia/cloud-init').get_json()["wireguard_config"]
+
+    response = client.get('/api/v1/nodes/mia/wg0.conf')
+    assert response.mimetype == "text/plain"
+    assert response.get_data(as_text=True) == cloud_init
+    assert cloud_init.count("[Peer]") == 3 and "# MIA" not in cloud_init
+
+    revalidated = client.get('/api/v1/nodes/mia/wg0.conf',
+                             headers={"If-None-Match": response.headers["ETag"]})
+    assert revalidated.status_code == 304
+    assert client.get('/api/v1/nodes/nope/wg0.conf').status_code == 404
+
+
+def test_bird_configs_are_served_from_the_discovery_config(api):
+    client = api.app.test_client()
+    # BIRD needs a router id, so placeholder slots get nothing until they register
+    assert client.get('/api/v1/nodes/mia/bird/bird.conf').status_code == 409
+    client.post('/api/v1/nodes/register:batch', json={"external_ips": ["198.51.100.1", "198.51.100.2"]})
+
+    response = client.get('/api/v1/nodes/ord/bird/bird.conf')
+    assert response.mimetype == "text/plain"
+    bird_conf = response.get_data(as_text=True)
+    assert "router id 198.51.100.1;" in bird_conf and "include \"/etc/bird/filters.conf\";" in bird_conf
+
+    ibgp = client.get('/api/v1/nodes/ord/bird/ibgp.conf').get_data(as_text=True)
+    assert ibgp.count("protocol bgp ") == 1 and "neighbor LAX_WG_IP as SELF_ASN;" in ibgp
+    assert "import filter ibgp_import;" in ibgp and "export filter ibgp_export;" in ibgp
+    assert "filter ibgp_import {" in client.get('/api/v1/nodes/ord/bird/filters.conf').get_data(as_text=True)
+
+    bundle = client.get('/api/v1/nodes/ord/bird')
+    files = bundle.get_json()["files"]
+    assert sorted(files) == ["bird.conf", "filters.conf", "ibgp.conf", "static.conf", "vultr.conf"]
+    assert files["ibgp.conf"] == ibgp
+    assert client.get('/api/v1/nodes/ord/bird', headers={"If-None-Match": bundle.headers["ETag"]}).status_code == 304
+
+    assert client.get('/api/v1/nodes/ord/bird/kernel.conf').status_code == 404
+    assert client.get('/api/v1/nodes/nope/bird/bird.conf').status_code == 404
+
+
+def test_heartbeats_drive_live_and_stale_nodes(api, schema_file):
+    now = [1000.0]
+    api.liveness = LivenessTable(ttl=30, clock=lambda: now[0],
+                                 shared=SharedHeartbeats(f"{schema_file}.liveness"))
+    client = api.app.test_client()
+    client.post('/api/v1/nodes/register:batch',
+                json={"external_ips": ["198.51.100.1", "198.51.100.2", "198.51.100.3"]})
+    mtime = schema_file.stat().st_mtime_ns
+
+    assert client.post('/api/v1/nodes/ord/heartbeat').status_code == 200
+    assert client.post('/api/v1/nodes/nope/heartbeat').status_code == 404
+    now[0] += 20
+    client.post('/api/v1/nodes/mia/heartbeat')
+
+    status = client.get('/api/v1/status').get_json()
+    assert status["live_nodes"] == ["ord", "mia"]
+    assert status["stale_nodes"] == ["lax", "ewr"]
+
+    # ord's expiry comes due in the timer wheel; mia's does not yet
+    now[0] += 15
+    status = client.get('/api/v1/status').get_json()
+    assert status["live_nodes"] == ["mia"]
+    # Headers only count; the names are in the liveness body
+    response = client.get('/api/v1/nodes/lax/wireguard')
+    assert response.headers["X-Live-Peers"] == "1"
+    assert response.headers["X-Stale-Peers"] == "2"
+    not_modified = client.get('/api/v1/nodes/lax/wireguard', headers={"If-None-Match": response.headers["ETag"]})
+    assert not_modified.status_code == 304
+    assert not_modified.headers["X-Live-Peers"] == "1"
+    peers = client.get('/api/v1/nodes/lax/liveness').get_json()
+    assert (peers["live_peers"], peers["stale_peers"]) == (["mia"], ["ord", "ewr"])
+    assert client.get('/api/v1/nodes/nope/liveness').status_code == 404
+
+    # Another worker hears from ord; this one picks it up on its next check
+    other = LivenessTable(ttl=30, clock=lambda: now[0],
+                          shared=SharedHeartbeats(f"{schema_file}.liveness"))
+    other.heartbeat("ord")
+    now[0] += 11
+    assert api.liveness.report(["ord", "mia"]) == (["ord", "mia"], [])
+
+    # Heartbeats never touch the schema file
+    assert schema_file.stat().st_mtime_ns == mtime
+
+
+def test_full_shared_liveness_table_keeps_heartbeats_local(tmp_path, caplog):
+    shared = SharedHeartbeats(str(tmp_path / "liveness"), capacity=2)
+    table = LivenessTable(shared=shared)
+    for node_id in ("ord", "mia", "ewr", "lax"):
+        table.heartbeat(node_id)
+    assert shared.last_seen("ewr") is None
+    assert shared.overflows == 2
+    assert len([r for r in caplog.records if "all 2 records are taken" in r.getMessage()]) == 1
+    # Still live in the worker that took the heartbeat
+    assert table.report(["ord", "ewr", "lax"]) == (["ord", "ewr", "lax"], [])
+
+    # Sharing is sized for the mesh, and a table from a smaller run starts over
+    table.enable_sharing(str(tmp_path / "liveness"), node_count=5000)
+    assert table.shared.capacity == 10000
+    assert table.shared.last_seen("ord") is None
+
+
+def test_deregistered_nodes_leave_the_timer_wheel(api):
+    now = [1000.0]
+    api.liveness = LivenessTable(ttl=30, clock=lambda: now[0])
+    api.ADMIN_TOKEN = "admin-secret"
+    client = api.app.test_client()
+    client.post('/api/v1/nodes/register:batch',
+                json={"external_ips": ["198.51.100.1", "198.51.100.2", "198.51.100.3"]})
+    node_id = client.post('/api/v1/nodes/register', json={
+        "external_ip": "198.51.100.7", "region": "lax", "public_key": "pub-7"}).get_json()["node_id"]
+    client.post(f'/api/v1/nodes/{node_id}/heartbeat')
+    client.post('/api/v1/nodes/ord/heartbeat')
+
+    # Another worker also tracks it, and only learns of the removal from the config
+    other = LivenessTable(ttl=30, clock=lambda: now[0])
+    other.heartbeat(node_id)
+
+    assert client.delete(f'/api/v1/nodes/{node_id}', headers={"Authorization": "Bearer admin-secret"}).status_code == 200
+    assert len(api.liveness._wheel) == 1
+    for _ in range(10):
+        now[0] += 30
+        status = client.get('/api/v1/status').get_json()
+        assert node_id not in status["live_nodes"] + status["stale_nodes"]
+        # The four seeded nodes, rechecked as stale; nothing left behind
+        assert len(api.liveness._wheel) == 4
+        assert node_id not in api.liveness.last_seen
+
+    other.retain(status["live_nodes"] + status["stale_nodes"])
+    assert len(other._wheel) == 0 and node_id not in other.last_seen
+
+
+def test_claim_raced_by_another_process_takes_the_next_record(tmp_path, monkeypatch):
+    path = str(tmp_path / "liveness")
+    shared = SharedHeartbeats(path, capacity=4)
+    # Another node whose probe starts at the same record as ord's
+    rival = next(f"node{i}" for i in range(100) if zlib.crc32(f"node{i}".encode()) % 4 == zlib.crc32(b"ord") % 4)
+    flock = liveness_module.fcntl.flock
+
+    def claim_first(fd, operation):
+        # Runs after the unlocked probe found the record free, before the lock is taken
+        monkeypatch.setattr(liveness_module.fcntl, "flock", flock)
+        subprocess.run([sys.executable, "-c", "import sys; from service_discovery.liveness import SharedHeartbeats; "
+                        "SharedHeartbeats(sys.argv[1], capacity=4).stamp(sys.argv[2], 1.0)", path, rival],
+                       cwd=REPO_ROOT, check=True)
+        flock(fd, operation)
+    monkeypatch.setattr(liveness_module.fcntl, "flock", claim_first)
+
+    stamp = threading.Thread(target=shared.stamp, args=("ord", 2.0), daemon=True)
+    stamp.start()
+    stamp.join(10)
+    assert not stamp.is_alive(), "claim deadlocked on its own lock"
+    assert (shared.last_seen("ord"), shared.last_seen(rival)) == (2.0, 1.0)
+    assert SharedHeartbeats(path, capacity=4).last_seen("ord") == 2.0
+    assert shared.overflows == 0
+
+
+def test_loading_the_api_creates_no_files():
+    before = set(REPO_ROOT.iterdir())
+    load_api()
+    assert set(REPO_ROOT.iterdir()) == before
+
+
+def test_registration_allocates_new_nodes_past_seeded_slots(api, schema_file):
+    client = api.app.test_client()
+    client.post('/api/v1/nodes/register:batch', json={
+        "external_ips": ["198.51.100.1", "198.51.100.2", "198.51.100.3"]})
+
+    # No placeholder slots left: without region/public_key this still fails
+    assert client.post('/api/v1/nodes/register',
+                       json={"external_ip": "198.51.100.4"}).status_code == 400
+    response = client.post('/api/v1/nodes/register:batch', json={
+        "external_ips": ["198.51.100.4", "198.51.100.5", "198.51.100.6"],
+        "nodes": {ip: {"region": "lax", "public_key": f"pub-{ip}"}
+                  for ip in ["198.51.100.4", "198.51.100.5", "198.51.100.6"]}})
+    results = response.get_json()["results"]
+    assert [r["node_id"] for r in results[:2]] == ["lax-5", "lax-6"]
+    # lax's /29 has two unreserved hosts
+    assert results[2]["code"] == 409
+
+    config = client.post('/api/v1/nodes/discover', json={"external_ip": "198.51.100.5"}).get_json()
+    assert config["node_id"] == "lax-6"
+    assert config["wireguard"]["ipv4"] == "10.10.10.6"
+    assert config["wireguard"]["ipv6"] == "fd00:10:10::6"
+    assert config["announced_ip"] == "192.30.120.6"
+    # Allocated nodes keep their own private key: no empty PrivateKey line
+    assert config["wireguard"]["private_key"] is None
+    wg0 = client.get('/api/v1/nodes/lax-6/wg0.conf').get_data(as_text=True)
+    assert "PrivateKey" not in wg0
+    assert "PostUp = wg set %i private-key /etc/wireguard/private.key\n" in wg0
+    assert "PrivateKey = " in client.get('/api/v1/nodes/lax/wg0.conf').get_data(as_text=True)
+    # The region's own config still describes its seeded node
+    assert client.get('/api/v1/nodes/lax/config').get_json()["node_id"] == "lax"
+
+    # Deregistration is an admin call, and never removes seeded nodes or reflectors
+    assert client.delete('/api/v1/nodes/lax-5').status_code == 403
+    api.ADMIN_TOKEN = "admin-secret"
+    assert client.delete('/api/v1/nodes/lax-5', headers={"Authorization": "Bearer wrong"}).status_code == 401
+    admin = {"Authorization": "Bearer admin-secret"}
+    assert client.delete('/api/v1/nodes/lax', headers=admin).status_code == 409
+    assert client.delete('/api/v1/nodes/ord', headers=admin).status_code == 409
+
+    # Releasing a node frees its addresses for the next allocation
+    assert client.delete('/api/v1/nodes/lax-5', headers=admin).status_code == 200
+    assert client.delete('/api/v1/nodes/lax-5', headers=admin).status_code == 404
+    response = client.post('/api/v1/nodes/register', json={
+        "external_ip": "198.51.100.7", "region": "lax", "public_key": "pub-7"})
+    assert response.get_json()["node_id"] == "lax-5"
+
+    # A restarted API rebuilds the same allocations from the persisted journal
+    api.config_store = api.SharedSnapshotStore(schema_file)
+    response = client.post('/api/v1/nodes/register', json={
+        "external_ip": "198.51.100.8", "region": "lax", "public_key": "pub-8"})
+    assert response.status_code == 409
+    response = client.post('/api/v1/nodes/register', json={
+        "external_ip": "198.51.100.8", "region": "ord", "public_key": "pub-8"})
+    assert response.get_json()["node_id"] == "ord-7"
+
+
+def test_access_control_follows_source_groups(api, schema_file):
+    api.ACCESS_GROUPS = ["bgp_mesh_tunnel", "registered_nodes"]
+    api.ACCESS_EXTRA_NETWORKS = ["2001:db8::/32"]
+    client = api.app.test_client()
+
+    def status(remote_addr):
+        return client.get('/api/v1/status',
+                          environ_base={"REMOTE_ADDR": remote_addr}).status_code
+
+    assert status("10.10.10.3") == 200
+    assert status("149.248.2.74") == 200        # lax's registered endpoint
+    assert status("2001:db8::1") == 200
+    assert status("10.10.10.9") == 403
+    assert status("192.30.120.1") == 403        # bgp_mesh_announced not allowed
+
+    # A new registration is allowed as soon as its generation is published
+    api.ACCESS_GROUPS = ["*"]
+    api.config_store.transact(
+        lambda snapshot: ({"ord": {"vultr_endpoint": "198.51.100.1:51820"}}, None))
+    assert status("198.51.100.1") == 200
+    assert status("::ffff:192.30.120.9") == 200
+
+
+def test_firewall_rules_are_aggregated(api):
+    rules = api.app.test_client().get('/api/v1/firewall/rules').get_json()
+    assert rules["source_groups"]["bgp_mesh_tunnel"] == ["10.10.10.1/32", "10.10.10.2/31", "10.10.10.4/32"]
+    # Not adjacent, so nothing to merge
+    assert len(rules["source_groups"]["bgp_mesh_announced"]) == 4
+    assert rules["announced_subnets"] == ["192.30.120.0/27"]
+    assert rules["aggregation"]["source_groups"]["total"] == {"before": 12, "after": 11}
+    assert rules["aggregation"]["announced_subnets"] == {"before": 4, "after": 1}
+    assert rules["vultr_ip_rules"]["admin_access"][0]["port"] == 22
+
+
+def test_prefix_trie_longest_match():
+    trie = PrefixTrie(32)
+    trie.insert(ipaddress.ip_network("10.0.0.0/8"), "wide")
+    trie.insert(ipaddress.ip_network("10.10.0.0/16"), "narrow")
+    trie.insert(ipaddress.ip_network("10.10.10.1/32"), "host")
+    lookup = lambda ip: trie.lookup(int(ipaddress.ip_address(ip)))
+    assert lookup("10.10.10.1") == "host"
+    assert lookup("10.10.10.2") == "narrow"
+    assert lookup("10.9.0.1") == "wide"
+    assert lookup("11.0.0.1") is None
+
+
+def test_cached_bodies_are_precompressed_per_encoding(api):
+    client = api.app.test_client()
+    client.post('/api/v1/nodes/register:batch',
+                json={"external_ips": ["198.51.100.1", "198.51.100.2", "198.51.100.3"]})
+    plain = client.get('/api/v1/nodes/ord/cloud-init')
+    assert "Content-Encoding" not in plain.headers
+    assert plain.headers["Vary"] == "Accept-Encoding"
+    # The fast encoder produces the same bytes as the stdlib one
+    assert plain.data == (json.dumps(plain.get_json(), separators=(",", ":"),
+                                     sort_keys=True) + "\n").encode()
+
+    packed = client.get('/api/v1/nodes/ord/cloud-init', headers={"Accept-Encoding": "gzip"})
+    assert packed.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(packed.data) == plain.data
+    assert packed.headers["ETag"] == plain.headers["ETag"][:-1] + '-gzip"'
+
+    # Each encoding revalidates against its own ETag, and the compressed
+    # body is built once per generation
+    revalidated = client.get('/api/v1/nodes/ord/cloud-init', headers={
+        "Accept-Encoding": "gzip", "If-None-Match": packed.headers["ETag"]})
+    assert revalidated.status_code == 304
+    entry = api.cached_entry('cloud-init', 'ord', api.config_store.current(),
+                             api.render_cloud_init_config)
+    assert entry.variant("gzip")[0] is entry.variant("gzip")[0]
+    assert client.get('/api/v1/nodes/ord/cloud-init', headers={
+        "Accept-Encoding": "gzip;q=0"}).data == plain.data
+
+    # A watcher holding the gzip ETag is still up to date, so it waits
+    started = time.monotonic()
+    watched = client.get('/api/v1/nodes/ord/watch?resource=cloud-init&timeout=0.2',
+                         headers={"If-None-Match": packed.headers["ETag"],
+                                  "Accept-Encoding": "gzip"})
+    assert watched.status_code == 304
+    assert time.monotonic() - started >= 0.2
+
+
+def test_metrics_endpoint_reports_routes_reloads_and_cache(api):
+    api.metrics = api.Metrics()
+    api.metrics.counter("sd_response_cache_hits_total", "hits", lambda: api.response_cache.hits)
+    api.config_store.metrics = api.metrics
+    client = api.app.test_client()
+
+    client.get('/api/v1/nodes/ord/wireguard')
+    client.get('/api/v1/nodes/ord/wireguard')
+    client.get('/api/v1/nodes/nope/wireguard')
+    client.post('/api/v1/nodes/register', json={"external_ip": "198.51.100.1"})
+    client.get('/api/v1/nodes/ord/wireguard')
+
+    response = client.get('/metrics')
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+    samples = {}
+    for line in response.get_data(as_text=True).splitlines():
+        if not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+
+    route = 'route="/api/v1/nodes/<node_id>/wireguard"'
+    assert samples[f'sd_http_requests_total{{{route},code="200"}}'] == 3
+    assert samples[f'sd_http_requests_total{{{route},code="404"}}'] == 1
+    assert samples[f'sd_http_request_duration_seconds_count{{{route}}}'] == 4
+    assert samples[f'sd_http_request_duration_seconds_bucket{{{route},le="+Inf"}}'] == 4
+    assert samples['sd_registration_persist_duration_seconds_count'] == 1
+    assert samples['sd_config_reload_duration_seconds_count{source="file"}'] == 1
+    # Only the repeated read before the registration was a cache hit
+    assert samples['sd_response_cache_hits_total'] == 1
+
+
+def test_metrics_are_summed_across_workers(tmp_path, monkeypatch):
+    worker = Metrics()
+    worker.enable_sharing(str(tmp_path))
+    worker.observe_request("/api/v1/status", 200, 0.002)
+    monkeypatch.setattr(os, "getpid", lambda: 1)
+    worker.maybe_flush()
+    monkeypatch.undo()
+
+    scraped = Metrics()
+    scraped.shared_dir = str(tmp_path)
+    scraped.observe_request("/api/v1/status", 200, 0.004)
+    text = scraped.render()
+    assert 'sd_http_requests_total{route="/api/v1/status",code="200"} 2' in text
+    assert 'sd_http_request_duration_seconds_bucket{route="/api/v1/status",le="0.0025"} 1' in text
+
+
+def test_scrape_while_workers_add_routes():
+    metrics = Metrics()
+    # Switch threads as often as possible so scrapes land mid-insert
+    previous = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    done = threading.Event()
+
+    def record():
+        # Every request a new route and label: the shard's dicts keep growing
+        for i in range(20000):
+            metrics.observe_request(f"/route/{i}", 200 + i % 3, 0.001)
+        done.set()
+
+    thread = threading.Thread(target=record)
+    try:
+        thread.start()
+        while not done.is_set():
+            metrics.render()
+    finally:
+        thread.join()
+        sys.setswitchinterval(previous)
+    assert len(metrics.totals()["requests"]) == 20000
+
+
+def test_profiling_writes_requested_profiles_to_a_bounded_ring(api, tmp_path):
+    ring = ProfileRing(str(tmp_path / "profiles"), keep=2)
+    client = Client(ProfilingMiddleware(api.app.wsgi_app, ring, token="secret"))
+
+    response = client.get('/api/v1/nodes/ord/wireguard')
+    assert 'X-SD-Profile-File' not in response.headers
+    assert ring.profiles() == []
+    # A wrong token is treated like no header
+    client.get('/api/v1/nodes/ord/wireguard', headers={'X-SD-Profile': 'guess'})
+    assert ring.profiles() == []
+
+    names = []
+    for _ in range(3):
+        response = client.get('/api/v1/nodes/ord/wg0.conf', headers={'X-SD-Profile': 'secret'})
+        assert response.status_code == 200
+        names.append(response.headers['X-SD-Profile-File'])
+        response.close()
+    assert ring.profiles() == names[1:]
+    stats = pstats.Stats(os.path.join(ring.directory, names[-1]))
+    assert any(function == 'get_wg_conf' for _, _, function in stats.stats)
+
+    sampled = Client(ProfilingMiddleware(api.app.wsgi_app, ring, fmt="collapsed", sample_rate=1.0))
+    response = sampled.post('/api/v1/nodes/register', json={"external_ip": "198.51.100.1"})
+    name = response.headers['X-SD-Profile-File']
+    response.close()
+    assert name.endswith('-POST-api_v1_nodes_register.folded')
+    with open(os.path.join(ring.directory, name)) as f:
+        for line in f:
+            stack, count = line.rsplit(" ", 1)
+            assert int(count) > 0 and ";" in stack
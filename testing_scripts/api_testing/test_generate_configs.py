@@ -0,0 +1,188 @@
+"""
+Tests for the offline BIRD config generator (development_tools/bird_configs)
+"""
+
+import importlib.util
+import json
+import os
+import sys
+
+import pytest
+
+from conftest import REPO_ROOT, SCHEMA_FILE
+from service_discovery import bird
+
+
+def load_generator():
+    spec = importlib.util.spec_from_file_location(
+        "generate_configs", REPO_ROOT / "development_tools" / "bird_configs" / "generate_configs.py")
+    module = importlib.util.module_from_spec(spec)
+    # Registered so pool workers can unpickle references to its functions
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def generator():
+    return load_generator()
+
+
+@pytest.fixture
+def bgp_config():
+    with open(REPO_ROOT / "bgp_config.json") as f:
+        return json.load(f)
+
+
+def test_template_renders_in_one_pass_and_checks_placeholders():
+    template = bird.Template("t", "protocol {\n  neighbor {IP} as {ASN};\n}\n# {IP}", {"IP", "ASN"})
+    assert template.fields == ["IP", "ASN", "IP"]
+    assert template.render({"IP": "10.0.0.1", "ASN": 64512}) == \
+        "protocol {\n  neighbor 10.0.0.1 as 64512;\n}\n# 10.0.0.1"
+
+    with pytest.raises(bird.TemplateError, match="unknown placeholders NAME; unused variables ASN"):
+        bird.Template("t", "{NAME} {IP}", {"IP", "ASN"})
+    # Optional variables may go unused
+    bird.Template("t", "{IP}", {"IP"}, {"ASN"})
+
+
+def test_bgp_config_agrees_with_the_discovery_schema(bgp_config):
+    """The two configs the generator and the API render from must not drift"""
+    with open(SCHEMA_FILE) as f:
+        discovery_bgp = json.load(f)["bgp_config"]
+    assert bgp_config["global"]["ibgp"] == discovery_bgp["ibgp"]
+    for key in ("our_asn", "vultr_asn", "announcements"):
+        assert bgp_config["global"][key] == discovery_bgp["global"][key], key
+    # Every template the renderer needs comes from bgp_config.json
+    assert set(bird.TEMPLATE_VARIABLES) <= set(bgp_config["templates"])
+    assert bird.DEFAULT_TEMPLATES == bgp_config["templates"]
+
+
+def test_stock_templates_compile_and_fill_every_placeholder(generator, bgp_config):
+    fleet = generator.Fleet(bgp_config)
+    for node_name in bgp_config["nodes"]:
+        for rendered in (generator.generate_static_config(fleet),
+                         generator.generate_vultr_config(fleet, node_name),
+                         generator.generate_ibgp_config(fleet, node_name),
+                         generator.generate_bird_config(fleet, node_name),
+                         generator.generate_filters_config(fleet, node_name)):
+            assert bird.PLACEHOLDER.search(rendered) is None
+    assert "define ORD_WG_IP = 10.10.10.2;" in generator.generate_ibgp_config(fleet, "ord")
+
+    # A config's templates override the stock ones by name
+    bgp_config["templates"] = {
+        "bird_base": bird.DEFAULT_TEMPLATES["bird_base"].replace("{VULTR_IP}", "{ROUTER_ID}"),
+        "static_routes": "{PREFIX}",
+    }
+    with pytest.raises(bird.TemplateError) as error:
+        bird.compile_templates(bgp_config)
+    assert str(error.value).splitlines() == [
+        "template static_routes: unknown placeholders PREFIX",
+        "template bird_base: unknown placeholders ROUTER_ID; unused variables VULTR_IP",
+    ]
+
+
+def fleet_config(bgp_config, size):
+    """bgp_config with lax plus size-1 client nodes"""
+    nodes = {"lax": bgp_config["nodes"]["lax"]}
+    for i in range(1, size):
+        nodes[f"n{i:04d}"] = dict(bgp_config["nodes"]["ord"], vultr_ip=f"198.18.{i // 256}.{i % 256}",
+                                  wireguard_ipv4=f"10.10.{11 + i // 254}.{i % 254 + 1}")
+    return dict(bgp_config, nodes=nodes)
+
+
+def output_mtimes(output_dir):
+    return {os.path.relpath(os.path.join(root, name), output_dir): os.stat(os.path.join(root, name)).st_mtime_ns
+            for root, _, names in os.walk(output_dir) for name in names}
+
+
+def test_incremental_generation_touches_only_changed_outputs(generator, bgp_config, tmp_path):
+    fleet = generator.Fleet(fleet_config(bgp_config, 1000))
+    config = fleet.config
+    output_dir = str(tmp_path / "fleet")
+
+    assert generator.generate_configs(fleet, list(config["nodes"]), output_dir) == (5000, 0, 0)
+    before = output_mtimes(output_dir)
+    assert generator.generate_configs(fleet, list(config["nodes"]), output_dir) == (0, 5000, 0)
+
+    config["nodes"]["n0500"] = dict(config["nodes"]["n0500"], vultr_ip="203.0.113.5")
+    assert generator.generate_configs(fleet, list(config["nodes"]), output_dir) == (2, 4998, 0)
+    after = output_mtimes(output_dir)
+    changed = {path for path in after if after[path] != before.get(path)}
+    # ibgp.conf does not use VULTR_IP, so only two outputs and the manifest move
+    assert changed == {"n0500/vultr.conf", "n0500/bird.conf", generator.MANIFEST_FILE}
+    with open(os.path.join(output_dir, "n0500", "bird.conf")) as f:
+        assert "router id 203.0.113.5;" in f.read()
+
+    # A deleted output is regenerated even though its inputs are unchanged
+    os.unlink(os.path.join(output_dir, "n0001", "ibgp.conf"))
+    assert generator.generate_configs(fleet, ["n0001"], output_dir) == (1, 4, 0)
+
+
+def test_removed_nodes_lose_their_outputs(generator, bgp_config, tmp_path):
+    fleet = generator.Fleet(fleet_config(bgp_config, 10))
+    config = fleet.config
+    output_dir = str(tmp_path / "fleet")
+    generator.generate_configs(fleet, list(config["nodes"]), output_dir)
+    # Not written by the generator, so left alone
+    with open(os.path.join(output_dir, "n0003", "notes.txt"), "w") as f:
+        f.write("keep")
+
+    for node_name in ("n0003", "n0007"):
+        del config["nodes"][node_name]
+    fleet = generator.Fleet(config)
+    # Pruned even when only one node is rendered
+    assert generator.generate_configs(fleet, ["n0001"], output_dir) == (0, 5, 10)
+
+    outputs = output_mtimes(output_dir)
+    assert not any(path.startswith("n0007") for path in outputs)
+    assert not os.path.exists(os.path.join(output_dir, "n0007"))
+    assert [path for path in outputs if path.startswith("n0003")] == [os.path.join("n0003", "notes.txt")]
+    manifest = generator.load_manifest(output_dir)
+    assert len(manifest) == 40
+    assert not any(path.startswith(("n0003/", "n0007/")) for path in manifest)
+    # The route reflector lost two client sessions; nothing else changed
+    before = output_mtimes(output_dir)
+    assert generator.generate_configs(fleet, list(config["nodes"]), output_dir) == (1, 39, 0)
+    after = output_mtimes(output_dir)
+    assert {path for path in after if after[path] != before[path]} == {
+        os.path.join("lax", "ibgp.conf"), generator.MANIFEST_FILE}
+
+
+def test_parallel_generation_matches_serial(generator, bgp_config, tmp_path, monkeypatch):
+    fleet = generator.Fleet(fleet_config(bgp_config, 40))
+    config = fleet.config
+    generator.generate_configs(fleet, list(config["nodes"]), str(tmp_path / "serial"))
+    monkeypatch.setattr(generator, "PARALLEL_MIN_NODES", 8)
+    assert generator.generate_configs(fleet, list(config["nodes"]), str(tmp_path / "parallel"),
+                                      jobs=2) == (200, 0, 0)
+
+    for path in output_mtimes(str(tmp_path / "serial")):
+        with open(tmp_path / "serial" / path) as serial, open(tmp_path / "parallel" / path) as parallel:
+            assert serial.read() == parallel.read()
+
+
+def test_ibgp_config_follows_the_topology(generator, bgp_config):
+    config = fleet_config(bgp_config, 200)
+    for i, node in enumerate(config["nodes"].values()):
+        node["region"] = f"r{i % 4}"
+    config["global"]["ibgp"] = {"topology": "regional-rr", "reflectors_per_region": 2}
+    fleet = generator.Fleet(config)
+    assert fleet.topology.summary()["sessions"] == 192 * 2 + 8 * 7 // 2
+
+    # Region r0 holds lax, n0004, n0008, ...; lax is the preferred reflector and n0004 the second
+    client = generator.generate_ibgp_config(fleet, "n0012")
+    assert client.count("protocol bgp ") == 2
+    assert "neighbor LAX_WG_IP as SELF_ASN;" in client and "neighbor N0004_WG_IP as SELF_ASN;" in client
+    assert "rr client" not in client
+    assert "# n0012 is a route reflector client in the regional-rr topology (iBGP sessions: 2," in client
+
+    reflector = generator.generate_ibgp_config(fleet, "n0004")
+    assert reflector.count("protocol bgp ") == 48 + 7
+    assert reflector.count("  rr client;\n  rr cluster id 1;\n") == 48
+    assert "define N0008_WG_IP = 10.10.11.9;" in reflector
+    assert bird.PLACEHOLDER.search(reflector) is None
+
+    config["global"]["ibgp"]["topology"] = "hub"
+    with pytest.raises(ValueError, match="unknown iBGP topology 'hub'"):
+        generator.Fleet(config)
@@ -0,0 +1,227 @@
+"""
+Concurrency and crash-safety tests for the journaled registration store
+"""
+
+import json
+import os
+import threading
+
+import pytest
+
+from conftest import add_open_slots, write_schema
+from service_discovery.shared import SharedSnapshotStore
+from service_discovery.store import RegistrationStore, write_json_atomic
+from service_discovery.validation import ConfigValidationError, ConfigValidator, compile_schema
+
+
+def node_endpoints(store):
+    assignments = store.current().config["wireguard_config"]["node_assignments"]
+    return {node_id: node["vultr_endpoint"] for node_id, node in assignments.items()}
+
+
+def test_concurrent_registrations_lose_no_updates(api, schema_file):
+    with open(schema_file) as f:
+        config = json.load(f)
+    write_schema(schema_file, add_open_slots(config, 61))
+    api.config_store = RegistrationStore(schema_file, compact_threshold=16)
+
+    # 3 placeholder slots in the stock schema plus 61 added ones
+    ips = [f"203.0.113.{i}" for i in range(1, 65)]
+    results = {}
+
+    def register(batch):
+        client = api.app.test_client()
+        for ip in batch:
+            response = client.post('/api/v1/nodes/register', json={"external_ip": ip})
+            results[ip] = (response.status_code, response.get_json())
+
+    threads = [threading.Thread(target=register, args=(ips[i::8],)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(status == 200 for status, _ in results.values())
+    assigned = [body["node_id"] for _, body in results.values()]
+    assert len(set(assigned)) == len(ips)
+
+    # A fresh store (e.g. after a restart) replays the same state from disk
+    endpoints = node_endpoints(RegistrationStore(schema_file))
+    for ip, (_, body) in results.items():
+        assert endpoints[body["node_id"]] == f"{ip}:51820"
+
+
+def test_two_stores_share_one_file(schema_file):
+    # Two worker processes each hold their own store over the same file
+    first = RegistrationStore(schema_file)
+    second = RegistrationStore(schema_file)
+
+    def claim(store, ip):
+        def plan(snapshot):
+            node_id = snapshot.index.open_slots[0]
+            return {node_id: {"vultr_endpoint": f"{ip}:51820"}}, node_id
+        return store.transact(plan)[0]
+
+    claimed = [claim(first, "198.51.100.1"), claim(second, "198.51.100.2"),
+               claim(first, "198.51.100.3")]
+    assert claimed == ["ord", "mia", "ewr"]
+    assert node_endpoints(first) == node_endpoints(second)
+
+
+def test_torn_journal_tail_is_ignored_and_truncated(schema_file):
+    store = RegistrationStore(schema_file)
+    store.transact(lambda snapshot: ({"ord": {"vultr_endpoint": "198.51.100.1:51820"}}, None))
+    with open(store.journal_file, "ab") as f:
+        f.write(b'{"seq": 2, "nodes": {"mia": {"vultr_end')
+
+    recovered = RegistrationStore(schema_file)
+    assert node_endpoints(recovered)["ord"] == "198.51.100.1:51820"
+    assert node_endpoints(recovered)["mia"] == "0.0.0.0:51820"
+
+    recovered.transact(lambda snapshot: ({"mia": {"vultr_endpoint": "198.51.100.2:51820"}}, None))
+    with open(store.journal_file) as f:
+        lines = [json.loads(line) for line in f]
+    assert [line["seq"] for line in lines] == [1, 2]
+
+
+def test_compaction_folds_journal_into_schema(schema_file):
+    store = RegistrationStore(schema_file, compact_threshold=2)
+    store.transact(lambda snapshot: ({"ord": {"vultr_endpoint": "198.51.100.1:51820"}}, None))
+    assert store.journal_entries == 1
+    store.transact(lambda snapshot: ({"mia": {"vultr_endpoint": "198.51.100.2:51820"}}, None))
+    assert store.journal_entries == 0
+
+    with open(schema_file) as f:
+        on_disk = json.load(f)["wireguard_config"]["node_assignments"]
+    assert on_disk["ord"]["vultr_endpoint"] == "198.51.100.1:51820"
+    assert on_disk["mia"]["vultr_endpoint"] == "198.51.100.2:51820"
+    with open(store.journal_file) as f:
+        assert f.read() == ""
+
+
+@pytest.mark.parametrize("crash_at", ["rename", "truncate"])
+def test_save_survives_a_crash_before_the_journal_is_truncated(schema_file, monkeypatch, crash_at):
+    store = RegistrationStore(schema_file)
+    store.transact(lambda snapshot: ({"ord": {"vultr_endpoint": "198.51.100.1:51820"}}, None))
+    config = json.loads(json.dumps(store.current().config))
+    config["wireguard_config"]["node_assignments"]["ord"]["vultr_endpoint"] = "198.51.100.9:51820"
+    config["wireguard_config"]["node_assignments"]["mia"]["vultr_endpoint"] = "198.51.100.2:51820"
+
+    def crash(*args):
+        raise SystemExit("crashed")
+
+    if crash_at == "rename":
+        monkeypatch.setattr("service_discovery.store.write_json_atomic", crash)
+    else:
+        # The new base is in place but the old journal entry is still there
+        monkeypatch.setattr(store, "_compact", lambda config: write_json_atomic(schema_file, config) or crash())
+    with pytest.raises(SystemExit):
+        store.save(config)
+    monkeypatch.undo()
+
+    # Replay ends on the saved config, not on the old entry
+    recovered = RegistrationStore(schema_file)
+    assert node_endpoints(recovered)["ord"] == "198.51.100.9:51820"
+    assert node_endpoints(recovered)["mia"] == "198.51.100.2:51820"
+    recovered.transact(lambda snapshot: ({"ewr": {"vultr_endpoint": "198.51.100.3:51820"}}, None))
+    assert node_endpoints(RegistrationStore(schema_file))["ord"] == "198.51.100.9:51820"
+
+
+def test_shared_snapshot_agrees_across_workers(schema_file):
+    first = SharedSnapshotStore(schema_file)
+    second = SharedSnapshotStore(schema_file)
+    start = first.current().generation
+    assert second.current().generation == start
+
+    first.transact(lambda snapshot: ({"ord": {"vultr_endpoint": "198.51.100.1:51820"}}, None))
+    second.transact(lambda snapshot: ({"mia": {"vultr_endpoint": "198.51.100.2:51820"}}, None))
+
+    assert first.current().generation == second.current().generation == start + 2
+    assert node_endpoints(first) == node_endpoints(second)
+    # Both workers can answer a delta from the same starting generation
+    assert set(first.changes.changes_since(start)) == {"ord", "mia"}
+    assert set(second.changes.changes_since(start)) == {"ord", "mia"}
+
+    # A restarted worker adopts the shared generation instead of starting at 1
+    assert SharedSnapshotStore(schema_file).current().generation == start + 2
+
+
+def test_shared_snapshot_reload_locks_only_for_a_new_generation(schema_file, monkeypatch):
+    first = SharedSnapshotStore(schema_file)
+    second = SharedSnapshotStore(schema_file)
+    snapshot = second.current()
+
+    def no_lock():
+        raise AssertionError("took the cross-process lock")
+
+    monkeypatch.setattr(second, "_exclusive", no_lock)
+    # Rewritten but still the same generation: adopted from the header alone
+    stat = os.stat(second.snapshot_file)
+    os.utime(second.snapshot_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert second.current() is snapshot
+    assert second.reload() is snapshot
+
+    first.transact(lambda snapshot: ({"ord": {"vultr_endpoint": "198.51.100.1:51820"}}, None))
+    with pytest.raises(AssertionError, match="cross-process lock"):
+        second.current()
+    monkeypatch.undo()
+    assert second.current().generation == snapshot.generation + 1
+
+
+def test_invalid_writes_are_rejected_before_the_journal(api, schema_file):
+    client = api.app.test_client()
+    generation = api.config_store.current().generation
+
+    response = client.post('/api/v1/nodes/register', json={"external_ip": "not-an-ip"})
+    assert response.status_code == 422
+    assert response.get_json()["details"][0]["path"] == "wireguard_config.node_assignments.ord.vultr_endpoint"
+    # Taking another node's mesh address is caught by the cross-node check
+    with pytest.raises(ConfigValidationError, match="10.10.10.1 is already used by lax"):
+        api.config_store.transact(lambda snapshot: ({"ord": {"ipv4": "10.10.10.1"}}, None))
+    # A node's private key, when the API holds one, must be a real WireGuard key
+    with pytest.raises(ConfigValidationError, match="private_key"):
+        api.config_store.transact(lambda snapshot: ({"ord": {"private_key": ""}}, None))
+    assert not os.path.exists(api.config_store.journal_file)
+    assert api.config_store.current().generation == generation
+
+    assert client.post('/api/v1/nodes/register', json={"external_ip": "198.51.100.1"}).status_code == 200
+
+
+def test_invalid_schema_file_keeps_last_good_snapshot(api, schema_file, monkeypatch):
+    good = api.config_store.current()
+    with open(schema_file) as f:
+        config = json.load(f)
+    valid = json.loads(json.dumps(config))
+    del config["wireguard_config"]["node_assignments"]["mia"]["region"]
+    config["bgp_config"]["global"]["our_asn"] = "27218"
+    write_schema(schema_file, config)
+    reads = []
+    read = api.config_store._read
+    monkeypatch.setattr(api.config_store, "_read", lambda: reads.append(1) or read())
+
+    # Read and rejected once, not again on every request
+    client = api.app.test_client()
+    for _ in range(5):
+        assert api.config_store.current() is good
+        assert client.get('/api/v1/nodes/lax/wireguard').status_code == 200
+    assert len(reads) == 1
+    response = client.post('/api/v1/admin/reload')
+    assert response.status_code == 500
+    assert len(reads) == 2
+    error = response.get_json()["error"]
+    assert "node_assignments.mia: missing required field 'region'" in error
+    assert "bgp_config.global.our_asn: expected integer, got str" in error
+    with pytest.raises(ConfigValidationError):
+        api.config_store.save(config)
+    with pytest.raises(ValueError, match="unsupported schema keywords: oneOf"):
+        compile_schema({"oneOf": [{"type": "string"}]})
+    # A fresh process refuses to start on it
+    store = RegistrationStore(schema_file)
+    store.validator = ConfigValidator.from_file()
+    with pytest.raises(ConfigValidationError):
+        store.current()
+
+    # Fixing the file is picked up on the next request
+    valid["service_info"]["version"] = "9.9.9"
+    write_schema(schema_file, valid)
+    assert api.config_store.current().config["service_info"]["version"] == "9.9.9"
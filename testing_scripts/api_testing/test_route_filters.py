@@ -0,0 +1,132 @@
+"""
+Route filter compiler tests
+"""
+
+import ipaddress
+import json
+import random
+
+import pytest
+
+from conftest import SCHEMA_FILE
+from service_discovery.aggregate import aggregate_networks
+from service_discovery.filters import compile_route_filter, rule_action
+from service_discovery.validation import ConfigValidationError, ConfigValidator
+
+
+def random_net(rng, version):
+    bits = 32 if version == 4 else 128
+    length = rng.randint(0, bits)
+    address = rng.getrandbits(bits)
+    return ipaddress.ip_network((address, length), strict=False)
+
+
+def nets_near(route_filter, rng, count):
+    """Routes at, inside and around every rule prefix, plus random ones"""
+    nets = []
+    for rule in route_filter["rules"]:
+        for prefix in rule["prefixes"] if "prefixes" in rule else [rule["prefix"]]:
+            if prefix == "default":
+                continue
+            network = ipaddress.ip_network(prefix)
+            nets.append(network)
+            if network.prefixlen:
+                nets.append(network.supernet())
+            for length in range(network.prefixlen + 1, min(network.prefixlen + 8, network.max_prefixlen) + 1):
+                nets.append(next(network.subnets(new_prefix=length)))
+    nets.extend(random_net(rng, rng.choice((4, 6))) for _ in range(count))
+    return nets
+
+
+def customer_filter(count):
+    """Reject defaults and bogons, accept our prefixes and count customer /24s (up to /28s inside them)"""
+    return {
+        "description": "customers",
+        "rules": [
+            {"action": "reject", "prefix": "0.0.0.0/0"},
+            {"action": "reject", "prefix": "::/0"},
+            {"action": "reject", "prefix": "10.0.0.0/8", "le": 32},
+            {"action": "accept", "prefix": "192.30.120.0/23"},
+            {"action": "accept", "prefix": "2620:71:4000::/48", "ge": 48, "le": 64},
+            {"action": "accept", "prefixes": [f"100.{i // 256}.{i % 256}.0/24" for i in range(count)],
+             "ge": 24, "le": 28},
+            # Carved out of an accepted customer range: already accepted above
+            {"action": "reject", "prefix": "100.0.5.0/25"},
+            {"action": "accept", "prefix": "10.1.0.0/16"},
+            {"action": "reject", "prefix": "default"},
+            {"action": "accept", "prefix": "203.0.113.0/24"},
+        ]
+    }
+
+
+def test_aggregation_covers_exactly_the_same_addresses():
+    rng = random.Random(3)
+    for _ in range(50):
+        # Random host routes and small blocks inside one /24, so every address can be checked
+        cidrs = [f"192.0.2.{rng.randrange(0, 256, 1 << bits)}/{32 - bits}"
+                 for bits in (rng.choice((0, 0, 1, 2, 3)) for _ in range(rng.randint(1, 60)))]
+        aggregated = aggregate_networks(cidrs)
+        assert len(aggregated) <= len(cidrs)
+        covered = lambda networks, address: any(address in ipaddress.ip_network(n) for n in networks)
+        for host in range(256):
+            address = ipaddress.ip_address(f"192.0.2.{host}")
+            assert covered(cidrs, address) == covered(aggregated, address)
+        # Minimal: no two results overlap or could merge into their parent
+        for a in aggregated:
+            for b in aggregated:
+                assert a == b or not (a.overlaps(b) or (a.prefixlen == b.prefixlen and a.supernet() == b.supernet()))
+
+    assert aggregate_networks(["2001:db8::/33", "10.0.0.1/32", "2001:db8:8000::/33", "10.0.0.0/32"]) == [
+        ipaddress.ip_network("10.0.0.0/31"), ipaddress.ip_network("2001:db8::/32")]
+
+
+def test_compiled_filters_decide_like_the_rules():
+    rng = random.Random(7)
+    with open(SCHEMA_FILE) as f:
+        route_filters = json.load(f)["bgp_config"]["route_filters"]
+    route_filters["customers"] = customer_filter(40)
+
+    for name, route_filter in route_filters.items():
+        compiled = compile_route_filter(name, route_filter)
+        for net in nets_near(route_filter, rng, 500):
+            assert compiled.action(net) == rule_action(route_filter, net), (name, net)
+
+    customers = route_filters["customers"]
+    assert rule_action(customers, "100.0.5.0/25") == "accept"
+    assert rule_action(customers, "100.0.5.0/29") == "reject"
+    assert rule_action(customers, "10.1.0.0/16") == "reject"
+    assert rule_action(customers, "203.0.113.0/24") == "reject"
+    assert rule_action(customers, "2620:71:4000:1::/64") == "accept"
+
+
+def test_filter_cost_stays_flat_as_prefix_lists_grow():
+    small = compile_route_filter("customers", customer_filter(2))
+    large = compile_route_filter("customers", customer_filter(4000))
+
+    # One set test per change of action, however many prefixes
+    text = large.render()
+    assert text.count("if net ~ ") == small.render().count("if net ~ ") == 6
+    # 4000 consecutive customer /24s aggregate without widening what they match
+    assert "define CUSTOMERS_V4_2 = [\n  192.30.120.0/23,\n  100.0.0.0/13{24,28},\n  100.8.0.0/14{24,28}," in text
+    assert "  100.15.128.0/19{24,28}\n];" in text
+    assert large.prefix_counts == {"before": 4007, "after": 13}
+    assert "define CUSTOMERS_V6_2 = [ 2620:71:4000::/48{48,64} ];" in text
+    assert "define CUSTOMERS_V4_1 = [\n  0.0.0.0/0,\n  10.0.0.0/8+\n];" in text
+    assert "203.0.113.0/24" not in text
+    assert text.endswith("  }\n  reject;\n}\n")
+    assert [action for _, _, action in large.sets[4]] == ["reject", "accept", "reject", "accept"]
+
+
+def test_bad_route_filters_fail_validation():
+    with open(SCHEMA_FILE) as f:
+        config = json.load(f)
+    validator = ConfigValidator.from_file()
+    validator.validate(config)
+
+    config["bgp_config"]["route_filters"]["ibgp_import"]["rules"][2]["ge"] = 16
+    config["bgp_config"]["route_filters"]["ibgp_export"]["rules"][0]["prefix"] = "not-a-prefix"
+    with pytest.raises(ConfigValidationError) as error:
+        validator.validate(config)
+    assert [path for path, _ in error.value.errors] == ["bgp_config.route_filters.ibgp_import",
+                                                        "bgp_config.route_filters.ibgp_export"]
+    assert "rule 2: 192.30.120.0/23: lengths must satisfy 23 <= ge <= le <= 32" in error.value.errors[0][1]
@@ -0,0 +1,127 @@
+"""
+iBGP topology engine tests
+"""
+
+import json
+
+import pytest
+
+from conftest import SCHEMA_FILE
+from service_discovery.topology import (FULL_MESH, HUB_SPOKE, K_NEAREST, REGIONAL_RR, ROUTE_REFLECTOR, IBGPPeer,
+                                        build_ibgp_topology, build_mesh_topology, build_tunnel_topology)
+
+
+def regional_nodes(regions, per_region):
+    return [(f"{region}-{i}", region, False) for region in regions for i in range(per_region)]
+
+
+def test_full_mesh_and_single_reflector():
+    nodes = [("lax", "lax", True), ("ord", "ord", False), ("mia", "mia", False), ("ewr", "ewr", False)]
+
+    mesh = build_ibgp_topology(nodes, FULL_MESH)
+    assert mesh.session_count == 6
+    assert [peer.node_id for peer in mesh.peers["mia"]] == ["lax", "ord", "ewr"]
+    assert not mesh.cluster_ids
+
+    rr = build_ibgp_topology(nodes, ROUTE_REFLECTOR)
+    assert rr.session_count == 3
+    assert rr.cluster_ids == {"lax": 1}
+    assert rr.peers["lax"] == [IBGPPeer("ord", "client", 1), IBGPPeer("mia", "client", 1),
+                               IBGPPeer("ewr", "client", 1)]
+    assert rr.peers["ord"] == [IBGPPeer("lax", "reflector", None)]
+    assert sorted(rr.sessions()) == sorted(("lax", peer) for peer in rr.peers["lax"])
+
+    # Without a preferred reflector the first node reflects
+    assert build_ibgp_topology([(n, r, False) for n, r, _ in nodes]).cluster_ids == {"lax": 1}
+    with pytest.raises(ValueError, match="unknown iBGP topology"):
+        build_ibgp_topology(nodes, "ring")
+
+
+def test_regional_reflector_pairs_bound_sessions_per_node():
+    nodes = regional_nodes(["ewr", "lax", "ord"], 10)
+    # A preferred reflector is picked ahead of node order
+    nodes[25] = ("ord-5", "ord", True)
+    topology = build_ibgp_topology(nodes, REGIONAL_RR)
+
+    # Clusters are numbered in sorted region order, two reflectors each
+    assert topology.cluster_ids == {"ewr-0": 1, "ewr-1": 1, "lax-0": 2, "lax-1": 2, "ord-5": 3, "ord-0": 3}
+    assert topology.peers["lax-7"] == [IBGPPeer("lax-0", "reflector", None), IBGPPeer("lax-1", "reflector", None)]
+    assert [peer for peer in topology.peers["ord-5"] if peer.relation == "client"] == \
+        [IBGPPeer(f"ord-{i}", "client", 3) for i in range(1, 10) if i != 5]
+    # Every reflector peers with the five others
+    assert sum(peer.relation == "peer" for peer in topology.peers["ewr-1"]) == 5
+
+    # 24 clients with two sessions each, plus a full mesh of 6 reflectors
+    summary = topology.summary()
+    assert summary == {"topology": REGIONAL_RR, "nodes": 30, "reflectors": 6, "sessions": 24 * 2 + 15,
+                       "full_mesh_sessions": 435, "max_sessions_per_node": 8 + 5}
+    assert len(list(topology.sessions())) == summary["sessions"]
+    assert sum(len(peers) for peers in topology.peers.values()) == 2 * summary["sessions"]
+
+
+def test_regional_reflectors_scale_with_regions_not_nodes():
+    topology = build_ibgp_topology(regional_nodes([f"r{i:02d}" for i in range(20)], 100), REGIONAL_RR)
+    summary = topology.summary()
+    assert summary["sessions"] == 20 * 98 * 2 + 40 * 39 // 2
+    assert summary["full_mesh_sessions"] == 2000 * 1999 // 2
+    assert max(len(topology.peers[f"r00-{i}"]) for i in range(2, 100)) == 2
+
+    # A region with a single node has just one reflector
+    topology = build_ibgp_topology([("a", "x", False), ("b", "y", False), ("c", "y", False)], REGIONAL_RR,
+                                   reflectors_per_region=1)
+    assert topology.cluster_ids == {"a": 1, "b": 2}
+    assert topology.session_count == 2
+
+
+def test_tunnels_carry_every_ibgp_session():
+    nodes = regional_nodes(["ewr", "ord", "lax", "sea"], 6)
+    ibgp = build_ibgp_topology(nodes, REGIONAL_RR)
+    sessions = {frozenset((node_id, peer.node_id)) for node_id, peer in ibgp.sessions()}
+    pairs = [(node_id, region) for node_id, region, _ in nodes]
+
+    # Hub-and-spoke is exactly the session graph: clients reach their two reflectors
+    hub = build_tunnel_topology(pairs, HUB_SPOKE, ibgp)
+    assert hub.peers("ord-3") == ["ord-0", "ord-1"]
+    assert {frozenset((a, b)) for a in hub.node_ids for b in hub.peers(a)} == sessions
+    assert hub.summary()["tunnels"] == ibgp.session_count
+
+    nearest = build_tunnel_topology(pairs, K_NEAREST, ibgp, k=2)
+    linked = {frozenset((a, b)) for a in nearest.node_ids for b in nearest.peers(a)}
+    assert sessions <= linked
+    # Each region's nodes walk the region from their own position, so no
+    # node collects everyone's extra tunnels
+    summary = nearest.summary()
+    assert summary["max_peers_per_node"] <= ibgp.summary()["max_sessions_per_node"] + 2 * 2
+    assert summary["tunnels"] < summary["full_mesh_tunnels"]
+
+    full = build_tunnel_topology(pairs, FULL_MESH, ibgp)
+    assert full.summary()["tunnels"] == 24 * 23 // 2
+    assert full.peers("nope") == [] and hub.peers("nope") == []
+
+
+def test_k_nearest_prefers_close_regions():
+    pairs = [("e", "ewr"), ("o", "ord"), ("m", "mia"), ("l", "lax"), ("x", "unknown")]
+    nearest = build_tunnel_topology(pairs, K_NEAREST, k=1)
+    # Chicago is nearest to Newark and Los Angeles, Newark to Miami and
+    # Chicago; the unmapped region takes the first node in order. Tunnels
+    # go both ways, so Newark also carries the ones picked towards it.
+    assert nearest.peers("e") == ["o", "m", "x"]
+    assert nearest.peers("o") == ["e", "l"]
+    assert nearest.peers("m") == ["e"]
+    assert nearest.peers("l") == ["o"]
+    assert nearest.summary()["tunnels"] == 4
+    with pytest.raises(ValueError, match="unknown tunnel topology"):
+        build_tunnel_topology(pairs, "star")
+
+
+def test_mesh_topology_skips_unregistered_slots():
+    with open(SCHEMA_FILE) as f:
+        config = json.load(f)
+    # Only lax has a real endpoint in the checked-in schema
+    ibgp, tunnels = build_mesh_topology(config)
+    assert tunnels.node_ids == ["lax"] and ibgp.session_count == 0
+
+    config["wireguard_config"]["node_assignments"]["ord"]["vultr_endpoint"] = "198.51.100.1:51820"
+    ibgp, tunnels = build_mesh_topology(config, HUB_SPOKE)
+    assert tunnels.peers("ord") == ["lax"] and tunnels.peers("mia") == []
+    assert ibgp.cluster_ids == {"lax": 1}
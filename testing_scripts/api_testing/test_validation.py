@@ -0,0 +1,110 @@
+"""
+Schema compiler tests, one per supported keyword and format
+"""
+
+import pytest
+
+from service_discovery.validation import compile_schema
+
+
+def errors_for(schema, value):
+    errors = []
+    compile_schema(schema)(value, "", errors)
+    return errors
+
+
+def test_ref_recursion_checks_every_level():
+    tree = {
+        "definitions": {
+            "tree": {
+                "type": "object",
+                "required": ["name"],
+                "properties": {
+                    "name": {"type": "string"},
+                    "children": {"type": "array", "items": {"$ref": "#/definitions/tree"}},
+                },
+            },
+        },
+        "$ref": "#/definitions/tree",
+    }
+    leaf = {"name": "leaf"}
+    assert errors_for(tree, {"name": "root", "children": [{"name": "a", "children": [leaf]}]}) == []
+    assert errors_for(tree, {"name": "root", "children": [{"name": "a", "children": [{"name": 3}, {}]}]}) == [
+        ("children[0].children[0].name", "expected string, got int"),
+        ("children[0].children[1]", "missing required field 'name'"),
+    ]
+
+    with pytest.raises(ValueError, match="only local"):
+        compile_schema({"$ref": "other.json#/definitions/tree"})
+
+
+def test_additional_properties_false_rejects_unknown_fields():
+    closed = {"type": "object", "properties": {"ipv4": {"type": "string"}}, "additionalProperties": False}
+    assert errors_for(closed, {"ipv4": "10.10.10.1"}) == []
+    assert errors_for(closed, {"ipv4": "10.10.10.1", "ipv5": "x"}) == [("ipv5", "unexpected field")]
+
+    # Without properties every field is checked against additionalProperties
+    mapping = {"type": "object", "additionalProperties": {"type": "integer"}}
+    assert errors_for(mapping, {"a": 1, "b": "2"}) == [("b", "expected integer, got str")]
+    assert errors_for({"type": "object", "additionalProperties": False}, {"a": 1}) == [("a", "unexpected field")]
+
+
+def test_enum_allows_only_listed_values():
+    roles = {"enum": ["primary", "secondary", "route_reflector"]}
+    assert errors_for(roles, "primary") == []
+    assert errors_for(roles, "tertiary") == [
+        ("", "'tertiary' is not one of ['primary', 'secondary', 'route_reflector']")]
+
+
+def test_pattern_searches_strings_only():
+    node_id = {"type": "string", "pattern": "^[a-z]+-[0-9]+$"}
+    assert errors_for(node_id, "lax-1") == []
+    assert errors_for(node_id, "LAX-1") == [("", "'LAX-1' does not match '^[a-z]+-[0-9]+$'")]
+    # Non-strings are left to type
+    assert errors_for({"pattern": "^a"}, 5) == []
+
+
+@pytest.mark.parametrize("value, errors", [
+    (1, []),
+    (65535, []),
+    (0, [("", "0 is less than 1")]),
+    (65536, [("", "65536 is greater than 65535")]),
+    (True, [("", "expected integer, got bool")]),
+])
+def test_minimum_and_maximum_are_inclusive(value, errors):
+    assert errors_for({"type": "integer", "minimum": 1, "maximum": 65535}, value) == errors
+
+
+@pytest.mark.parametrize("value, valid", [
+    ("192.0.2.1:51820", True),
+    ("[2001:db8::1]:51820", True),
+    ("192.0.2.1", False),
+    ("192.0.2.1:0", False),
+    ("192.0.2.1:65536", False),
+    ("192.0.2.1:port", False),
+    ("host.example:51820", False),
+    ("192.0.2.256:51820", False),
+])
+def test_endpoint_format(value, valid):
+    expected = [] if valid else [("", f"{value!r} is not a valid endpoint")]
+    assert errors_for({"type": "string", "format": "endpoint"}, value) == expected
+
+
+@pytest.mark.parametrize("value, valid", [
+    ("2026-10-17T12:30:00", True),
+    ("2026-10-17T12:30:00Z", True),
+    ("2026-10-17T12:30:00.123456+02:00", True),
+    ("2026-10-17", True),
+    ("2026-13-01T00:00:00", False),
+    ("yesterday", False),
+])
+def test_date_time_format(value, valid):
+    expected = [] if valid else [("", f"{value!r} is not a valid date-time")]
+    assert errors_for({"type": "string", "format": "date-time"}, value) == expected
+
+
+def test_unknown_keywords_and_formats_fail_to_compile():
+    with pytest.raises(ValueError, match="unsupported schema keywords: oneOf"):
+        compile_schema({"oneOf": [{"type": "string"}]})
+    with pytest.raises(ValueError, match="unsupported format 'uri'"):
+        compile_schema({"type": "string", "format": "uri"})
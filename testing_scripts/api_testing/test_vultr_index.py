@@ -0,0 +1,162 @@
+"""
+Vultr instance index tests against a local stub of the Vultr API
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from service_discovery.vultr import MISS_REFRESH_INTERVAL, InstanceIndex, VultrAPIError
+
+
+class StubVultrAPI:
+    """Serves /v2/instances with cursor pagination, like api.vultr.com"""
+
+    def __init__(self, instances):
+        self.instances = instances
+        self.requests = []
+        self.delay = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                stub.requests.append((url.path, query, self.headers.get("Authorization")))
+                time.sleep(stub.delay)
+                per_page = int(query.get("per_page", ["100"])[0])
+                start = int(query.get("cursor", ["0"])[0])
+                page = stub.instances[start:start + per_page]
+                more = start + per_page < len(stub.instances)
+                body = json.dumps({
+                    "instances": page,
+                    "meta": {"total": len(stub.instances),
+                             "links": {"next": str(start + per_page) if more else "", "prev": ""}}
+                }).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+def instance(ip, region):
+    return {"id": f"id-{ip}", "main_ip": ip, "region": region, "label": f"node-{ip}"}
+
+
+@pytest.fixture
+def vultr():
+    stub = StubVultrAPI([instance(f"198.51.100.{i}", "ord" if i % 2 else "mia")
+                         for i in range(1, 6)])
+    yield stub
+    stub.server.shutdown()
+    stub.server.server_close()
+
+
+def test_index_follows_cursor_pagination(vultr):
+    index = InstanceIndex("test-key", vultr.url, page_size=2)
+    assert index.region_of("198.51.100.5") == "ord"
+    assert index.region_of("198.51.100.4") == "mia"
+    assert len(index) == 5
+    # Three pages, fetched once and reused for the second lookup
+    assert [query.get("cursor") for _, query, _ in vultr.requests] == [None, ["2"], ["4"]]
+    assert {auth for _, _, auth in vultr.requests} == {"Bearer test-key"}
+
+
+def test_concurrent_cold_lookups_share_one_fetch(vultr):
+    vultr.delay = 0.2
+    index = InstanceIndex("test-key", vultr.url)
+    regions = []
+    threads = [threading.Thread(target=lambda: regions.append(index.region_of("198.51.100.1")))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert regions == ["ord"] * 8
+    assert len(vultr.requests) == 1
+
+
+def test_ttl_and_miss_refreshes(vultr):
+    now = [0.0]
+    index = InstanceIndex("test-key", vultr.url, ttl=300, clock=lambda: now[0])
+    index.region_of("198.51.100.1")
+
+    # A new instance is not looked for again until MISS_REFRESH_INTERVAL passes
+    vultr.instances.append(instance("198.51.100.9", "ewr"))
+    assert index.region_of("198.51.100.9") is None
+    now[0] += 20
+    assert index.region_of("198.51.100.9") == "ewr"
+    assert len(vultr.requests) == 2
+
+    # Hits are served from the index until the TTL runs out
+    vultr.instances[0] = instance("198.51.100.1", "lax")
+    now[0] += 100
+    assert index.region_of("198.51.100.1") == "ord"
+    now[0] += 300
+    assert index.region_of("198.51.100.1") == "lax"
+    assert len(vultr.requests) == 3
+
+
+def test_unreachable_api_is_not_retried_by_every_lookup(vultr):
+    now = [0.0]
+    index = InstanceIndex("test-key", vultr.url, clock=lambda: now[0])
+    fetch_all = index.fetch_all
+    attempts = []
+
+    def unreachable():
+        attempts.append(now[0])
+        time.sleep(0.2)
+        raise VultrAPIError("Error querying Vultr API: timed out")
+    index.fetch_all = unreachable
+
+    # One cold fetch fails; the lookups queued behind it answer unknown
+    # without trying again
+    regions = []
+    threads = [threading.Thread(target=lambda: regions.append(index.region_of("198.51.100.1")))
+               for _ in range(8)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert regions == [None] * 8
+    assert len(attempts) == 1
+    assert time.monotonic() - started < 1
+    assert "timed out" in index.last_error
+
+    now[0] += MISS_REFRESH_INTERVAL - 1
+    assert index.region_of("198.51.100.1") is None
+    assert len(attempts) == 1
+
+    # Tried again once the interval has passed
+    index.fetch_all = fetch_all
+    now[0] += 1
+    assert index.region_of("198.51.100.1") == "ord"
+    assert index.last_error is None
+
+
+def test_registration_prefers_slot_in_instance_region(api, vultr):
+    api.vultr_index = InstanceIndex("test-key", vultr.url)
+    client = api.app.test_client()
+
+    # 198.51.100.2 is in mia, so it skips the first open slot (ord)
+    response = client.post('/api/v1/nodes/register', json={"external_ip": "198.51.100.2"})
+    assert response.get_json()["node_id"] == "mia"
+    response = client.post('/api/v1/nodes/register', json={"external_ip": "198.51.100.3"})
+    assert response.get_json()["node_id"] == "ord"
+
+    geography = client.get('/api/v1/admin/geography').get_json()
+    assert geography["corrections_needed"] == []
+    assert geography["not_found_in_vultr"] == ["lax"]
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+Bootstrap-storm benchmark for the service discovery API.
+
+For each mesh size a synthetic service-discovery-schema.json is generated
+(the stock lax node plus N-1 unregistered slots spread over the four
+regions) and every slot is bootstrapped the way cloud-init does it, with
+many nodes at once: register, discover, wireguard, cloud-init, wg0.conf,
+heartbeat. Each thread walks its nodes through that sequence one node at a
+time, so the endpoints are exercised concurrently, in one mixed run. Each
+endpoint (and all of them together) reports p50/p95/p99 latency,
+throughput and peak RSS.
+
+Modes:
+    client  Flask test client in a separate process per mesh size
+            (app cost only; RSS is that process)
+    serve   local gunicorn `serve` instance over HTTP (RSS is the largest
+            worker's peak); afterwards each worker's resident and private
+            memory is reported, since every worker holds its own copy of
+            the config
+
+Usage: bench_bootstrap_storm.py [--nodes 4,64,512,4096] [--concurrency 32]
+                                [--mode client|serve] [--workers 4] [--json out.json]
+
+Compare two versions by running both with --json and diffing the files.
+"""
+
+import argparse
+import base64
+import hashlib
+import http.client
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+from bench_serving import prepare_tree, start_server, stop_server
+
+REGIONS = ["lax", "ord", "ewr", "mia"]
+
+# Bootstrap calls in the order a node makes them
+PHASES = ["register", "discover", "wireguard", "cloud-init", "wg0.conf", "heartbeat"]
+
+
+def placeholder_key(seed):
+    """A well-formed (44-character base64) WireGuard key derived from seed"""
+    return base64.b64encode(hashlib.sha256(seed.encode()).digest()).decode()
+
+
+def synthetic_schema(base, nodes):
+    """Stock schema with its nodes replaced by lax plus nodes-1 open slots"""
+    config = json.loads(json.dumps(base))
+    wg_config = config["wireguard_config"]
+    # A /24 runs out at 254 nodes; slots start above lax's 10.10.10.1
+    wg_config["mesh_networks"]["ipv4_subnet"] = "10.10.0.0/16"
+    geographic = config["network_allocation"]["geographic_allocation"]
+    assignments = {"lax": wg_config["node_assignments"]["lax"]}
+    for i in range(1, nodes):
+        region = REGIONS[i % len(REGIONS)]
+        node_id = f"{region}{i:04d}"
+        assignments[node_id] = {
+            "ipv4": f"10.10.{11 + i // 254}.{i % 254 + 1}",
+            "ipv6": f"fd00:10:10::{i + 1:x}",
+            "public_key": placeholder_key(f"{node_id}-public"),
+            "private_key": placeholder_key(f"{node_id}-private"),
+            "vultr_endpoint": "0.0.0.0:51820",
+            "role": "secondary",
+            "announced_ip": geographic[region]["vultr_primary"],
+            "region": region,
+            "provider": "vultr"
+        }
+    wg_config["node_assignments"] = assignments
+    return config
+
+
+def external_ip(i):
+    # 198.18.0.0/15 is reserved for benchmarking
+    return f"198.18.{i // 256}.{i % 256}"
+
+
+def percentile_ms(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return round(sorted_values[index] * 1000, 3)
+
+
+def latency_stats(latencies, errors, elapsed):
+    """Request count, errors, throughput and percentiles for one endpoint"""
+    merged = sorted(latencies)
+    return {
+        "requests": len(merged),
+        "errors": errors,
+        "throughput_rps": round(len(merged) / elapsed, 1) if elapsed else None,
+        "p50_ms": percentile_ms(merged, 0.50),
+        "p95_ms": percentile_ms(merged, 0.95),
+        "p99_ms": percentile_ms(merged, 0.99),
+    }
+
+
+def bootstrap_request(i, node_id, phase):
+    """The request a node bootstrapping from external_ip(i) makes in a phase"""
+    if phase == "register":
+        return "POST", "/api/v1/nodes/register", {"external_ip": external_ip(i)}
+    if phase == "discover":
+        return "POST", "/api/v1/nodes/discover", {"external_ip": external_ip(i)}
+    if phase == "heartbeat":
+        return "POST", f"/api/v1/nodes/{node_id}/heartbeat", None
+    return "GET", f"/api/v1/nodes/{node_id}/{phase}", None
+
+
+def storm(count, concurrency, make_caller, peak_rss):
+    """Bootstrap count nodes from concurrency threads, every phase in one mixed run.
+
+    Each thread takes a share of the nodes and walks each one through the
+    whole call sequence before starting the next, the way cloud-init does.
+    Threads are at different points of their sequences, so registrations
+    overlap with config fetches and heartbeats as in a real storm.
+    Latencies are reported per endpoint (phase) and for all calls together.
+    """
+    latencies = {phase: [[] for _ in range(concurrency)] for phase in PHASES}
+    errors = {phase: [0] * concurrency for phase in PHASES}
+    failed_registrations = [0] * concurrency
+
+    def worker(slot):
+        call = make_caller()
+        for i in range(slot, count, concurrency):
+            node_id = None
+            for phase in PHASES:
+                started = time.perf_counter()
+                status, data = call(*bootstrap_request(i, node_id, phase))
+                latencies[phase][slot].append(time.perf_counter() - started)
+                if status != 200:
+                    errors[phase][slot] += 1
+                if phase == "register":
+                    if status != 200:
+                        # Nothing to fetch for a node that got no slot
+                        failed_registrations[slot] += 1
+                        break
+                    node_id = json.loads(data)["node_id"]
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(slot,)) for slot in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    if sum(failed_registrations):
+        print(f"warning: {sum(failed_registrations)} registrations failed; "
+              "their later calls were skipped", file=sys.stderr)
+    peak_rss_mb = round(peak_rss() / 1024, 1)
+    results = {}
+    for phase in PHASES:
+        results[phase] = latency_stats([latency for per_thread in latencies[phase] for latency in per_thread],
+                                       sum(errors[phase]), elapsed)
+    results["all"] = latency_stats([latency for per_phase in latencies.values()
+                                    for per_thread in per_phase for latency in per_thread],
+                                   sum(sum(per_phase) for per_phase in errors.values()), elapsed)
+    for stats in results.values():
+        stats["peak_rss_mb"] = peak_rss_mb
+    return results
+
+
+def client_caller_factory(app):
+    def make_caller():
+        client = app.test_client()
+
+        def call(method, path, body):
+            response = client.open(path, method=method, json=body)
+            data = response.get_data()
+            response.close()
+            return response.status_code, data
+        return call
+    return make_caller
+
+
+def http_caller_factory(port):
+    def make_caller():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+
+        def call(method, path, body):
+            nonlocal conn
+            payload = json.dumps(body) if body is not None else None
+            headers = {"Content-Type": "application/json"} if body is not None else {}
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+                return None, None
+            return response.status, data
+        return call
+    return make_caller
+
+
+def own_peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def tree_peak_rss_kb(pid):
+    """Largest VmHWM among pid and its descendants (Linux /proc)"""
+    peak = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        peak = max(peak, int(line.split()[1]))
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return peak
+
+
+def worker_memory(pid):
+    """Rss and private (unshared) memory in MB of each child of pid (Linux /proc)"""
+    workers = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children") as f:
+            children = [int(child) for child in f.read().split()]
+        for child in children:
+            fields = {}
+            try:
+                with open(f"/proc/{child}/smaps_rollup") as f:
+                    for line in f:
+                        name, _, value = line.partition(":")
+                        if value.strip().endswith("kB"):
+                            fields[name] = int(value.split()[0])
+            except OSError:
+                continue
+            workers.append({
+                "pid": child,
+                "rss_mb": round(fields.get("Rss", 0) / 1024, 1),
+                "private_mb": round((fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)) / 1024, 1),
+            })
+    return workers
+
+
+def prepare_workdir(nodes):
+    workdir = prepare_tree()
+    schema_path = workdir / "service-discovery-schema.json"
+    with open(schema_path) as f:
+        base = json.load(f)
+    with open(schema_path, "w") as f:
+        json.dump(synthetic_schema(base, nodes), f, indent=2)
+    return workdir
+
+
+def run_client_child(workdir, count, concurrency):
+    """Entry point of the per-size child process in client mode"""
+    sys.argv = [str(workdir / "service-discovery-api.py")]
+    sys.path.insert(0, str(workdir))
+    os.chdir(workdir)
+    import runpy
+    module = runpy.run_path("service-discovery-api.py", run_name="service_discovery_api")
+    app = module["app"]
+    return storm(count, concurrency, client_caller_factory(app), own_peak_rss_kb)
+
+
+def run_size(nodes, args):
+    count = nodes - 1
+    workdir = prepare_workdir(nodes)
+    try:
+        if args.mode == "client":
+            output = subprocess.run(
+                [sys.executable, __file__, "--child", str(workdir), "--count", str(count),
+                 "--concurrency", str(args.concurrency)],
+                check=True, capture_output=True, text=True).stdout
+            return json.loads(output), None
+        proc = start_server("serve", workdir, args.port, args.workers)
+        try:
+            results = storm(count, args.concurrency, http_caller_factory(args.port),
+                            lambda: tree_peak_rss_kb(proc.pid))
+            return results, worker_memory(proc.pid)
+        finally:
+            stop_server(proc)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--nodes", default="4,64,512,4096",
+                        help="comma-separated mesh sizes")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mode", choices=["client", "serve"], default="client")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=5098)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--count", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        json.dump(run_client_child(Path(args.child), args.count, args.concurrency), sys.stdout)
+        return
+
+    report = {
+        "mode": args.mode,
+        "concurrency": args.concurrency,
+        "workers": args.workers if args.mode == "serve" else None,
+        "python": sys.version.split()[0],
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "results": {},
+        "worker_memory": {},
+    }
+    for nodes in (int(n) for n in args.nodes.split(",")):
+        results, workers = run_size(nodes, args)
+        report["results"][str(nodes)] = results
+        print(f"\n{nodes} nodes ({args.mode}, {args.concurrency} concurrent)")
+        print(f"  {'endpoint':<11} {'req':>6} {'err':>4} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} "
+              f"{'p99 ms':>8} {'rss MB':>7}")
+        for phase, stats in results.items():
+            print(f"  {phase:<11} {stats['requests']:>6} {stats['errors']:>4} "
+                  f"{stats['throughput_rps']:>9} {stats['p50_ms']:>8} {stats['p95_ms']:>8} "
+                  f"{stats['p99_ms']:>8} {stats['peak_rss_mb']:>7}")
+        if workers is not None:
+            report["worker_memory"][str(nodes)] = workers
+            print("  workers: " + ", ".join(f"{worker['rss_mb']} MB rss / {worker['private_mb']} MB private"
+                                            for worker in workers))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
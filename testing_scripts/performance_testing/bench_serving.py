@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Compare requests/second of the service discovery API under the Werkzeug
+development server and the production `serve` mode (gunicorn).
+
+Each server runs from a scratch copy of the repo files on a local port so
+the real schema file is never touched. Load is a GET mix of status,
+wireguard, cloud-init and node config over keep-alive connections.
+
+Usage: bench_serving.py [--duration 10] [--clients 16] [--workers 4] [--json out.json]
+"""
+
+import argparse
+import http.client
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+
+PATHS = [
+    "/api/v1/status",
+    "/api/v1/nodes/lax/wireguard",
+    "/api/v1/nodes/ord/cloud-init",
+    "/api/v1/nodes/mia/config",
+]
+
+
+def prepare_tree():
+    """Copy the API, its schema and the BIRD templates into a scratch directory"""
+    workdir = Path(tempfile.mkdtemp(prefix="sd-bench-"))
+    shutil.copy(REPO_ROOT / "service-discovery-api.py", workdir)
+    shutil.copy(REPO_ROOT / "service-discovery-schema.json", workdir)
+    shutil.copy(REPO_ROOT / "bgp_config.json", workdir)
+    shutil.copytree(REPO_ROOT / "service_discovery", workdir / "service_discovery",
+                    ignore=shutil.ignore_patterns("__pycache__"))
+    return workdir
+
+
+def start_server(mode, workdir, port, workers):
+    env = dict(os.environ)
+    if mode == "dev":
+        # Same as production today, minus the debugger reloader's second process
+        code = ("import runpy, sys; sys.argv = ['service-discovery-api.py'];"
+                "mod = runpy.run_path('service-discovery-api.py', run_name='sd');"
+                f"mod['app'].run(host='127.0.0.1', port={port}, debug=True, use_reloader=False)")
+        cmd = [sys.executable, "-c", code]
+    else:
+        env.update(SD_BIND=f"127.0.0.1:{port}", SD_WORKERS=str(workers))
+        cmd = [sys.executable, "service-discovery-api.py", "serve"]
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/api/v1/status")
+            if conn.getresponse().status == 200:
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    stop_server(proc)
+    raise RuntimeError(f"{mode} server did not start on port {port}")
+
+
+def stop_server(proc):
+    os.killpg(proc.pid, signal.SIGTERM)
+    proc.wait(timeout=30)
+
+
+def run_load(port, clients, duration):
+    counts = [0] * clients
+    errors = [0] * clients
+    stop_at = time.monotonic() + duration
+
+    def client(slot):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        i = slot
+        while time.monotonic() < stop_at:
+            try:
+                conn.request("GET", PATHS[i % len(PATHS)])
+                response = conn.getresponse()
+                response.read()
+                if response.status == 200:
+                    counts[slot] += 1
+                else:
+                    errors[slot] += 1
+            except (OSError, http.client.HTTPException):
+                errors[slot] += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+            i += 1
+
+    threads = [threading.Thread(target=client, args=(slot,)) for slot in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {
+        "requests": sum(counts),
+        "errors": sum(errors),
+        "rps": round(sum(counts) / duration, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for mode in ("dev", "serve"):
+        workdir = prepare_tree()
+        proc = start_server(mode, workdir, args.port, args.workers)
+        try:
+            results[mode] = run_load(args.port, args.clients, args.duration)
+        finally:
+            stop_server(proc)
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(f"{mode:>5}: {results[mode]['rps']:>9} req/s  "
+              f"({results[mode]['requests']} ok, {results[mode]['errors']} errors)")
+
+    if results["dev"]["rps"]:
+        print(f"speedup: {results['serve']['rps'] / results['dev']['rps']:.2f}x")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"clients": args.clients, "workers": args.workers,
+                       "duration": args.duration, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()